@@ -15,10 +15,14 @@ class AddrALU(Elaboratable):
     is added.
 
     When ADDR_ALU is no longer being read, carry is reset to 0.
+
+    Without gated, the low byte of the result is always on dataBusOut,
+    rather than only while ADDR_ALU is read.
     """
 
-    def __init__(self):
+    def __init__(self, gated=True):
         self.controls = SequencerControls()
+        self.gated = gated
 
         self.input = Signal(8)
         self.dataBusIn = Signal(8)
@@ -53,10 +57,13 @@ class AddrALU(Elaboratable):
 
         m.d.comb += self.result.eq(self.input2 + self.input + self.carry)
 
-        with m.If(self.controls.readRegister8 == Register8.ADDR_ALU):
+        if self.gated:
+            with m.If(self.controls.readRegister8 == Register8.ADDR_ALU):
+                m.d.comb += self.dataBusOut.eq(self.result[0:8])
+            with m.Else():
+                m.d.comb += self.dataBusOut.eq(0)
+        else:
             m.d.comb += self.dataBusOut.eq(self.result[0:8])
-        with m.Else():
-            m.d.comb += self.dataBusOut.eq(0)
 
         if platform == "formal":
             self.formal(m)
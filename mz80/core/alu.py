@@ -6,10 +6,12 @@ from ..z80fi.z80fi import *
 
 
 class ALU(Elaboratable):
-    def __init__(self, include_z80fi=False):
+    def __init__(self, include_z80fi=False, gated=True):
         self.dataBusIn = Signal(8)
         self.dataBusOut = Signal(8)
         self.controls = SequencerControls()
+        # Whether dataBusOut is 0 unless A, F or TMP is read.
+        self.gated = gated
 
         self.include_z80fi = include_z80fi
         if self.include_z80fi:
@@ -40,7 +42,7 @@ class ALU(Elaboratable):
                 m.d.comb += self.dataBusOut.eq(A[self.controls.registerSet])
             with m.Case(Register8.F):
                 m.d.comb += self.dataBusOut.eq(F[self.controls.registerSet])
-            with m.Case(Register8.TMP):
+            with m.Case(Register8.TMP) if self.gated else m.Default():
                 m.d.comb += self.dataBusOut.eq(TMP)
 
         if self.include_z80fi:
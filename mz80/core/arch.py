@@ -6,15 +6,52 @@ from .muxing import *
 from ..z80fi.z80fi import *
 
 
+# The 16-bit pairs that are kept in two banks, in order: their index in a
+# memory-backed register file.
+BANKED_PAIRS = [Register16.WZ, Register16.BC, Register16.DE, Register16.HL]
+
+# The banked 8-bit registers, as (index of their pair, whether they are
+# the high byte).
+BANKED_HALVES = {
+    Register8.W: (0, 1),
+    Register8.Z: (0, 0),
+    Register8.B: (1, 1),
+    Register8.C: (1, 0),
+    Register8.D: (2, 1),
+    Register8.E: (2, 0),
+    Register8.H: (3, 1),
+    Register8.L: (3, 0),
+}
+
+# The ways of storing the banked registers.
+REGISTER_FILES = ("ff", "memory")
+
+
 class Registers(Elaboratable):
     """Main registers.
 
     Consists of the standard B, C, D, E, H, L registers and their
     secondary counterparts, and the IX, IY, SP, and PC registers.
+
+    register_file chooses how the two banks of WZ, BC, DE and HL are
+    stored. With "ff", each register is a Signal. With "memory", they are
+    a Memory of 16-bit pairs addressed by {registerSet, pair}, which maps
+    to LUT RAM where the FPGA has it. Swapping banks is then just a
+    different registerSet. The memory has one write port, so an 8-bit and
+    a 16-bit write to banked registers in the same cycle can't both
+    happen; the 16-bit write wins. The sequencer never does that.
     """
 
-    def __init__(self, include_z80fi=False):
+    def __init__(self, include_z80fi=False, gated=True, register_file="ff"):
+        if register_file not in REGISTER_FILES:
+            raise ValueError("Unknown register file {!r}, expected one of {}"
+                             .format(register_file,
+                                     ", ".join(REGISTER_FILES)))
         self.controls = SequencerControls()
+        # Whether dataBusOut is 0 unless one of these registers is read.
+        # Without it, something else has to select this unit's output.
+        self.gated = gated
+        self.register_file = register_file
 
         # registerSet chooses whether we use the W set or the W2 set.
         # self.registerSet = Signal()
@@ -28,30 +65,33 @@ class Registers(Elaboratable):
 
         self.addrALUInput = Signal(8)
 
-        self.W1 = Signal(8)
-        self.W2 = Signal(8)
-        self.W = Array([self.W1, self.W2])
-        self.Z1 = Signal(8)
-        self.Z2 = Signal(8)
-        self.Z = Array([self.Z1, self.Z2])
-        self.B1 = Signal(8)
-        self.B2 = Signal(8)
-        self.B = Array([self.B1, self.B2])
-        self.C1 = Signal(8)
-        self.C2 = Signal(8)
-        self.C = Array([self.C1, self.C2])
-        self.D1 = Signal(8)
-        self.D2 = Signal(8)
-        self.D = Array([self.D1, self.D2])
-        self.E1 = Signal(8)
-        self.E2 = Signal(8)
-        self.E = Array([self.E1, self.E2])
-        self.H1 = Signal(8)
-        self.H2 = Signal(8)
-        self.H = Array([self.H1, self.H2])
-        self.L1 = Signal(8)
-        self.L2 = Signal(8)
-        self.L = Array([self.L1, self.L2])
+        if self.register_file == "memory":
+            self.banks = Memory(width=16, depth=2 * len(BANKED_PAIRS))
+        else:
+            self.W1 = Signal(8)
+            self.W2 = Signal(8)
+            self.W = Array([self.W1, self.W2])
+            self.Z1 = Signal(8)
+            self.Z2 = Signal(8)
+            self.Z = Array([self.Z1, self.Z2])
+            self.B1 = Signal(8)
+            self.B2 = Signal(8)
+            self.B = Array([self.B1, self.B2])
+            self.C1 = Signal(8)
+            self.C2 = Signal(8)
+            self.C = Array([self.C1, self.C2])
+            self.D1 = Signal(8)
+            self.D2 = Signal(8)
+            self.D = Array([self.D1, self.D2])
+            self.E1 = Signal(8)
+            self.E2 = Signal(8)
+            self.E = Array([self.E1, self.E2])
+            self.H1 = Signal(8)
+            self.H2 = Signal(8)
+            self.H = Array([self.H1, self.H2])
+            self.L1 = Signal(8)
+            self.L2 = Signal(8)
+            self.L = Array([self.L1, self.L2])
         self.IXh = Signal(8)
         self.IXl = Signal(8)
         self.IYh = Signal(8)
@@ -79,89 +119,89 @@ class Registers(Elaboratable):
             | ((self.controls.writeRegister16 == Register16.HL) & self.
                controls.writeRegister8.matches(Register8.H, Register8.L)))
 
+        if self.register_file == "memory":
+            m.submodules.banks_wr = self.banks_wr = self.banks.write_port(
+                domain="pos", granularity=8)
+        # The banked registers as seen by each reader: the data bus, the
+        # address bus and the address ALU.
+        read8 = self.bankedRead8(m, self.controls.readRegister8)
+        addr16 = self.bankedRead16(m, self.controls.readRegister16)
+        alu16 = self.bankedRead16(m, self.controls.addrALUInput)
+
         with m.Switch(self.controls.readRegister8):
             with m.Case(Register8.W):
-                m.d.comb += self.dataBusOut.eq(self.W[self.controls.registerSet])
+                m.d.comb += self.dataBusOut.eq(read8[Register8.W])
             with m.Case(Register8.Z):
-                m.d.comb += self.dataBusOut.eq(self.Z[self.controls.registerSet])
+                m.d.comb += self.dataBusOut.eq(read8[Register8.Z])
             with m.Case(Register8.B):
-                m.d.comb += self.dataBusOut.eq(self.B[self.controls.registerSet])
+                m.d.comb += self.dataBusOut.eq(read8[Register8.B])
             with m.Case(Register8.C):
-                m.d.comb += self.dataBusOut.eq(self.C[self.controls.registerSet])
+                m.d.comb += self.dataBusOut.eq(read8[Register8.C])
             with m.Case(Register8.D):
-                m.d.comb += self.dataBusOut.eq(self.D[self.controls.registerSet])
+                m.d.comb += self.dataBusOut.eq(read8[Register8.D])
             with m.Case(Register8.E):
-                m.d.comb += self.dataBusOut.eq(self.E[self.controls.registerSet])
+                m.d.comb += self.dataBusOut.eq(read8[Register8.E])
             with m.Case(Register8.H):
                 with m.If(self.controls.useIX):
                     m.d.comb += self.dataBusOut.eq(self.IXh)
                 with m.Elif(self.controls.useIY):
                     m.d.comb += self.dataBusOut.eq(self.IYh)
                 with m.Else():
-                    m.d.comb += self.dataBusOut.eq(
-                        self.H[self.controls.registerSet])
-            with m.Case(Register8.L):
+                    m.d.comb += self.dataBusOut.eq(read8[Register8.H])
+            with m.Case(Register8.L) if self.gated else m.Default():
                 with m.If(self.controls.useIX):
                     m.d.comb += self.dataBusOut.eq(self.IXl)
                 with m.Elif(self.controls.useIY):
                     m.d.comb += self.dataBusOut.eq(self.IYl)
                 with m.Else():
-                    m.d.comb += self.dataBusOut.eq(
-                        self.L[self.controls.registerSet])
-            with m.Default():
-                m.d.comb += self.dataBusOut.eq(0)
+                    m.d.comb += self.dataBusOut.eq(read8[Register8.L])
+            if self.gated:
+                with m.Default():
+                    m.d.comb += self.dataBusOut.eq(0)
 
         with m.If(~conflict):
             with m.Switch(self.controls.writeRegister8):
                 with m.Case(Register8.W):
-                    m.d.pos += self.W[self.controls.registerSet].eq(
-                        self.dataBusIn)
+                    self.bankedWrite8(m, Register8.W, self.dataBusIn)
                 with m.Case(Register8.Z):
-                    m.d.pos += self.Z[self.controls.registerSet].eq(
-                        self.dataBusIn)
+                    self.bankedWrite8(m, Register8.Z, self.dataBusIn)
                 with m.Case(Register8.B):
-                    m.d.pos += self.B[self.controls.registerSet].eq(
-                        self.dataBusIn)
+                    self.bankedWrite8(m, Register8.B, self.dataBusIn)
                 with m.Case(Register8.C):
-                    m.d.pos += self.C[self.controls.registerSet].eq(
-                        self.dataBusIn)
+                    self.bankedWrite8(m, Register8.C, self.dataBusIn)
                 with m.Case(Register8.D):
-                    m.d.pos += self.D[self.controls.registerSet].eq(
-                        self.dataBusIn)
+                    self.bankedWrite8(m, Register8.D, self.dataBusIn)
                 with m.Case(Register8.E):
-                    m.d.pos += self.E[self.controls.registerSet].eq(
-                        self.dataBusIn)
+                    self.bankedWrite8(m, Register8.E, self.dataBusIn)
                 with m.Case(Register8.H):
                     with m.If(self.controls.useIX):
                         m.d.pos += self.IXh.eq(self.dataBusIn)
                     with m.Elif(self.controls.useIY):
                         m.d.pos += self.IYh.eq(self.dataBusIn)
                     with m.Else():
-                        m.d.pos += self.H[self.controls.registerSet].eq(
-                            self.dataBusIn)
+                        self.bankedWrite8(m, Register8.H, self.dataBusIn)
                 with m.Case(Register8.L):
                     with m.If(self.controls.useIX):
                         m.d.pos += self.IXl.eq(self.dataBusIn)
                     with m.Elif(self.controls.useIY):
                         m.d.pos += self.IYl.eq(self.dataBusIn)
                     with m.Else():
-                        m.d.pos += self.L[self.controls.registerSet].eq(
-                            self.dataBusIn)
+                        self.bankedWrite8(m, Register8.L, self.dataBusIn)
 
         with m.Switch(self.controls.readRegister16):
             with m.Case(Register16.WZ):
-                m.d.comb += self.addrBusOut.eq(self.WZ)
+                m.d.comb += self.addrBusOut.eq(addr16[Register16.WZ])
             with m.Case(Register16.BC):
-                m.d.comb += self.addrBusOut.eq(self.BC)
+                m.d.comb += self.addrBusOut.eq(addr16[Register16.BC])
             with m.Case(Register16.DE):
-                m.d.comb += self.addrBusOut.eq(self.DE)
+                m.d.comb += self.addrBusOut.eq(addr16[Register16.DE])
             with m.Case(Register16.HL):
                 with m.If(self.controls.useIX):
                     m.d.comb += self.addrBusOut.eq(self.IX)
                 with m.Elif(self.controls.useIY):
                     m.d.comb += self.addrBusOut.eq(self.IY)
                 with m.Else():
-                    m.d.comb += self.addrBusOut.eq(self.HL)
+                    m.d.comb += self.addrBusOut.eq(addr16[Register16.HL])
             with m.Case(Register16.SP):
                 m.d.comb += self.addrBusOut.eq(self.SP)
             with m.Case(Register16.PC):
@@ -172,18 +212,18 @@ class Registers(Elaboratable):
         addrALUInput16 = Signal(16)
         with m.Switch(self.controls.addrALUInput):
             with m.Case(Register16.WZ):
-                m.d.comb += addrALUInput16.eq(self.WZ)
+                m.d.comb += addrALUInput16.eq(alu16[Register16.WZ])
             with m.Case(Register16.BC):
-                m.d.comb += addrALUInput16.eq(self.BC)
+                m.d.comb += addrALUInput16.eq(alu16[Register16.BC])
             with m.Case(Register16.DE):
-                m.d.comb += addrALUInput16.eq(self.DE)
+                m.d.comb += addrALUInput16.eq(alu16[Register16.DE])
             with m.Case(Register16.HL):
                 with m.If(self.controls.useIX):
                     m.d.comb += addrALUInput16.eq(self.IX)
                 with m.Elif(self.controls.useIY):
                     m.d.comb += addrALUInput16.eq(self.IY)
                 with m.Else():
-                    m.d.comb += addrALUInput16.eq(self.HL)
+                    m.d.comb += addrALUInput16.eq(alu16[Register16.HL])
             with m.Case(Register16.SP):
                 m.d.comb += addrALUInput16.eq(self.SP)
             with m.Case(Register16.PC):
@@ -199,48 +239,137 @@ class Registers(Elaboratable):
         with m.If(~conflict):
             with m.Switch(self.controls.writeRegister16):
                 with m.Case(Register16.WZ):
-                    m.d.pos += self.WZ.eq(self.input16)
+                    self.bankedWrite16(m, Register16.WZ, self.input16)
                 with m.Case(Register16.BC):
-                    m.d.pos += self.BC.eq(self.input16)
+                    self.bankedWrite16(m, Register16.BC, self.input16)
                 with m.Case(Register16.DE):
-                    m.d.pos += self.DE.eq(self.input16)
+                    self.bankedWrite16(m, Register16.DE, self.input16)
                 with m.Case(Register16.HL):
                     with m.If(self.controls.useIX):
                         m.d.pos += self.IX.eq(self.input16)
                     with m.Elif(self.controls.useIY):
                         m.d.pos += self.IY.eq(self.input16)
                     with m.Else():
-                        m.d.pos += self.HL.eq(self.input16)
+                        self.bankedWrite16(m, Register16.HL, self.input16)
                 with m.Case(Register16.SP):
                     m.d.pos += self.SP.eq(self.input16)
                 with m.Case(Register16.PC):
                     m.d.pos += self.PC.eq(self.input16)
 
         if self.include_z80fi:
-            m.d.comb += self.copy_regs()
+            m.d.comb += self.copy_regs(m)
 
         return m
 
-    def copy_regs(self):
+    def bankedRead8(self, m, reg8):
+        """Returns a dict from each banked Register8 to its value in the
+        current bank. With a memory, the values are only valid for the
+        register named by reg8."""
+        rs = self.controls.registerSet
+        if self.register_file == "ff":
+            return {
+                Register8.W: self.W[rs],
+                Register8.Z: self.Z[rs],
+                Register8.B: self.B[rs],
+                Register8.C: self.C[rs],
+                Register8.D: self.D[rs],
+                Register8.E: self.E[rs],
+                Register8.H: self.H[rs],
+                Register8.L: self.L[rs],
+            }
+        pair = Signal(2)
+        high = Signal()
+        with m.Switch(reg8):
+            for reg, (index, is_high) in BANKED_HALVES.items():
+                with m.Case(reg):
+                    m.d.comb += [pair.eq(index), high.eq(is_high)]
+        data = self.bankReadPort(m, Cat(pair, rs))
+        value = Mux(high, data[8:], data[:8])
+        return {reg: value for reg in BANKED_HALVES}
+
+    def bankedRead16(self, m, reg16):
+        """Returns a dict from each banked Register16 to its value in the
+        current bank. With a memory, the values are only valid for the
+        register named by reg16."""
+        if self.register_file == "ff":
+            return {
+                Register16.WZ: self.WZ,
+                Register16.BC: self.BC,
+                Register16.DE: self.DE,
+                Register16.HL: self.HL,
+            }
+        pair = Signal(2)
+        with m.Switch(reg16):
+            for index, reg in enumerate(BANKED_PAIRS):
+                with m.Case(reg):
+                    m.d.comb += pair.eq(index)
+        data = self.bankReadPort(m, Cat(pair, self.controls.registerSet))
+        return {reg: data for reg in BANKED_PAIRS}
+
+    def bankReadPort(self, m, addr):
+        """Adds an asynchronous read port on the banks, and returns its
+        data."""
+        port = self.banks.read_port(domain="comb")
+        m.submodules += port
+        m.d.comb += port.addr.eq(addr)
+        return port.data
+
+    def bankedWrite8(self, m, reg8, value):
+        rs = self.controls.registerSet
+        if self.register_file == "ff":
+            m.d.pos += getattr(self, reg8.name)[rs].eq(value)
+            return
+        index, high = BANKED_HALVES[reg8]
+        m.d.comb += [
+            self.banks_wr.addr.eq(Cat(Const(index, 2), rs)),
+            self.banks_wr.data.eq(Cat(value, value)),
+            self.banks_wr.en.eq(0b10 if high else 0b01),
+        ]
+
+    def bankedWrite16(self, m, reg16, value):
+        if self.register_file == "ff":
+            m.d.pos += getattr(self, reg16.name).eq(value)
+            return
+        index = BANKED_PAIRS.index(reg16)
+        m.d.comb += [
+            self.banks_wr.addr.eq(Cat(Const(index, 2),
+                                      self.controls.registerSet)),
+            self.banks_wr.data.eq(value),
+            self.banks_wr.en.eq(0b11),
+        ]
+
+    def copy_regs(self, m):
         regs = self.z80fi
-        return [
-            regs.eq(0),
-            regs.W1.eq(self.W[self.controls.registerSet]),
-            regs.W2.eq(self.W[~self.controls.registerSet]),
-            regs.Z1.eq(self.Z[self.controls.registerSet]),
-            regs.Z2.eq(self.Z[~self.controls.registerSet]),
-            regs.B1.eq(self.B[self.controls.registerSet]),
-            regs.B2.eq(self.B[~self.controls.registerSet]),
-            regs.C1.eq(self.C[self.controls.registerSet]),
-            regs.C2.eq(self.C[~self.controls.registerSet]),
-            regs.D1.eq(self.D[self.controls.registerSet]),
-            regs.D2.eq(self.D[~self.controls.registerSet]),
-            regs.E1.eq(self.E[self.controls.registerSet]),
-            regs.E2.eq(self.E[~self.controls.registerSet]),
-            regs.H1.eq(self.H[self.controls.registerSet]),
-            regs.H2.eq(self.H[~self.controls.registerSet]),
-            regs.L1.eq(self.L[self.controls.registerSet]),
-            regs.L2.eq(self.L[~self.controls.registerSet]),
+        rs = self.controls.registerSet
+        if self.register_file == "memory":
+            banked = []
+            for index, reg in enumerate(BANKED_PAIRS):
+                for bank, suffix in ((rs, "1"), (~rs, "2")):
+                    data = self.bankReadPort(m, Cat(Const(index, 2), bank))
+                    banked += [
+                        getattr(regs, reg.name[0] + suffix).eq(data[8:]),
+                        getattr(regs, reg.name[1] + suffix).eq(data[:8]),
+                    ]
+        else:
+            banked = [
+                regs.W1.eq(self.W[rs]),
+                regs.W2.eq(self.W[~rs]),
+                regs.Z1.eq(self.Z[rs]),
+                regs.Z2.eq(self.Z[~rs]),
+                regs.B1.eq(self.B[rs]),
+                regs.B2.eq(self.B[~rs]),
+                regs.C1.eq(self.C[rs]),
+                regs.C2.eq(self.C[~rs]),
+                regs.D1.eq(self.D[rs]),
+                regs.D2.eq(self.D[~rs]),
+                regs.E1.eq(self.E[rs]),
+                regs.E2.eq(self.E[~rs]),
+                regs.H1.eq(self.H[rs]),
+                regs.H2.eq(self.H[~rs]),
+                regs.L1.eq(self.L[rs]),
+                regs.L2.eq(self.L[~rs]),
+            ]
+        return [regs.eq(0)] + banked + [
             regs.IX.eq(self.IX),
             regs.IY.eq(self.IY),
             regs.SP.eq(self.SP),
@@ -0,0 +1,159 @@
+from enum import Enum, unique
+from nmigen import *
+from nmigen.cli import main
+from nmigen.hdl.rec import *
+
+from .muxing import *
+
+
+@unique
+class InstrClass(Enum):
+    # Not implemented yet. The sequencer does nothing.
+    NONE = 0
+    PREFIX_IX = 1
+    PREFIX_IY = 2
+    NOP = 3
+    HALT = 4
+    # LD r,r'
+    LD_R_R = 5
+    # LD r,(HL)
+    LD_R_HL = 6
+    # LD (HL),r
+    LD_HL_R = 7
+    # LD r,(IX+d) and LD r,(IY+d)
+    LD_R_IDX = 8
+    # LD (IX+d),r and LD (IY+d),r
+    LD_IDX_R = 9
+    # LD r,n
+    LD_R_N = 10
+    # LD (HL),n
+    LD_HL_N = 11
+    # LD (IX+d),n and LD (IY+d),n
+    LD_IDX_N = 12
+
+
+# The r-encoding of an opcode's register fields, as in Register8.r().
+_R = [
+    Register8.B, Register8.C, Register8.D, Register8.E, Register8.H,
+    Register8.L, Register8.NONE, Register8.A
+]
+
+
+class DecodedInstr(Record):
+    def __init__(self, name=None):
+        super().__init__(
+            Layout([
+                ("klass", InstrClass, DIR_FANOUT),
+                # The registers in the r fields at bits 0-2 and 3-5.
+                ("src", Register8, DIR_FANOUT),
+                ("dst", Register8, DIR_FANOUT),
+            ]),
+            name=name)
+
+
+def instr_class(indexed, opcode):
+    """Returns the InstrClass of an opcode, with or without a DD/FD prefix
+    in effect."""
+    if opcode == 0xDD:
+        return InstrClass.PREFIX_IX
+    if opcode == 0xFD:
+        return InstrClass.PREFIX_IY
+    if opcode == 0x00:
+        return InstrClass.NOP
+    if opcode & 0xC0 == 0x40:
+        dst_hl = (opcode >> 3) & 7 == 6
+        src_hl = opcode & 7 == 6
+        if dst_hl and src_hl:
+            return InstrClass.HALT
+        if not dst_hl and not src_hl:
+            return InstrClass.LD_R_R
+        if src_hl:
+            return InstrClass.LD_R_IDX if indexed else InstrClass.LD_R_HL
+        return InstrClass.LD_IDX_R if indexed else InstrClass.LD_HL_R
+    if opcode & 0xC7 == 0x06:
+        if (opcode >> 3) & 7 != 6:
+            return InstrClass.LD_R_N
+        return InstrClass.LD_IDX_N if indexed else InstrClass.LD_HL_N
+    return InstrClass.NONE
+
+
+def decode(indexed, opcode):
+    """Returns the attributes of an opcode as a dict of DecodedInstr
+    fields."""
+    klass = instr_class(indexed, opcode)
+    return {
+        "klass": klass,
+        "src": _R[opcode & 7],
+        "dst": _R[(opcode >> 3) & 7],
+    }
+
+
+def matches(pattern, opcode):
+    """Returns whether an opcode matches a pattern as in Value.matches(),
+    e.g. "00---110"."""
+    bits = pattern.replace(" ", "")
+    return all(bit == "-" or int(bit) == (opcode >> (7 - i)) & 1
+               for i, bit in enumerate(bits))
+
+
+def opcode_classes(pattern):
+    """Returns the set of InstrClasses an opcode matching pattern can
+    decode to, with or without a DD/FD prefix, along with the prefixes
+    themselves."""
+    return {
+        instr_class(indexed, opcode)
+        for indexed in (0, 1) for opcode in range(256)
+        if matches(pattern, opcode) or opcode in (0xDD, 0xFD)
+    }
+
+
+def _pack(layout, fields):
+    word = 0
+    shift = 0
+    for name, (shape, _) in layout.fields.items():
+        value = fields[name]
+        word |= (value.value if isinstance(value, Enum) else value) << shift
+        shift += Shape.cast(shape).width
+    return word
+
+
+class Decoder(Elaboratable):
+    """Looks up an opcode's DecodedInstr in a table built at elaboration
+    time, one entry per opcode with and without a DD/FD prefix.
+
+    The lookup is combinational; the Sequencer registers the result once
+    per opcode fetch, so nothing downstream decodes the opcode itself.
+    """
+
+    def __init__(self):
+        self.opcode = Signal(8)
+        self.indexed = Signal()
+        self.decoded = DecodedInstr(name="decoded")
+
+        layout = self.decoded.layout
+        self.table = Memory(
+            width=len(self.decoded),
+            depth=512,
+            init=[
+                _pack(layout, decode(indexed, opcode))
+                for indexed in (0, 1) for opcode in range(256)
+            ])
+
+    def ports(self):
+        return [self.opcode, self.indexed] + list(self.decoded.fields.values())
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.table = table = self.table.read_port(domain="comb")
+        m.d.comb += table.addr.eq(Cat(self.opcode, self.indexed))
+        m.d.comb += self.decoded.eq(table.data)
+        return m
+
+
+if __name__ == "__main__":
+    decoder = Decoder()
+
+    m = Module()
+    m.submodules.decoder = decoder
+
+    main(m, ports=decoder.ports())
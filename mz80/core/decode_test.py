@@ -0,0 +1,80 @@
+from enum import Enum
+
+from nmigen import *
+from nmigen.back import pysim
+from nmigen.back.pysim import Delay
+
+from mz80.core.decode import (Decoder, InstrClass, decode, instr_class,
+                              matches, opcode_classes)
+from mz80.insn_spec.ld_reg_n import ld_reg_n
+from mz80.insn_spec.ld_reg_reg import ld_reg_reg
+
+
+def _unpack(layout, word):
+    fields = {}
+    for name, (shape, _) in layout.fields.items():
+        width = Shape.cast(shape).width
+        fields[name] = word & ((1 << width) - 1)
+        word >>= width
+    return fields
+
+
+def _values(fields):
+    return {
+        name: value.value if isinstance(value, Enum) else value
+        for name, value in fields.items()
+    }
+
+
+def _table(decoder):
+    """Returns the decoder's table as {(indexed, opcode): fields}."""
+    layout = decoder.decoded.layout
+    return {(i // 256, i % 256): _unpack(layout, word)
+            for i, word in enumerate(decoder.table.init)}
+
+
+def test_table():
+    table = _table(Decoder())
+    assert len(table) == 512
+    for (indexed, opcode), fields in table.items():
+        assert fields == _values(decode(indexed, opcode))
+        assert InstrClass(fields["klass"]) == instr_class(indexed, opcode)
+
+
+def test_lookup():
+    decoder = Decoder()
+    cases = [
+        (0, 0x00, InstrClass.NOP),
+        (0, 0xDD, InstrClass.PREFIX_IX),
+        (1, 0xFD, InstrClass.PREFIX_IY),
+        (0, 0x46, InstrClass.LD_R_HL),
+        (1, 0x46, InstrClass.LD_R_IDX),
+        (1, 0x41, InstrClass.LD_R_R),
+        (0, 0x76, InstrClass.HALT),
+        (1, 0x36, InstrClass.LD_IDX_N),
+        (0, 0xF0, InstrClass.NONE),
+    ]
+    seen = []
+
+    def process():
+        for indexed, opcode, _ in cases:
+            yield decoder.indexed.eq(indexed)
+            yield decoder.opcode.eq(opcode)
+            yield Delay(1e-9)
+            seen.append(InstrClass((yield decoder.decoded.klass)))
+
+    with pysim.Simulator(decoder) as sim:
+        sim.add_process(process())
+        sim.run()
+    assert seen == [klass for _, _, klass in cases]
+
+
+def test_opcode_classes():
+    table = _table(Decoder())
+    for spec in (ld_reg_n, ld_reg_reg):
+        classes = {
+            InstrClass(fields["klass"]) for (_, opcode), fields in table.items()
+            if matches(spec.OPCODES, opcode) or opcode in (0xDD, 0xFD)
+        }
+        assert classes == opcode_classes(spec.OPCODES)
+        assert InstrClass.NONE not in classes
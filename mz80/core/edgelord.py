@@ -58,11 +58,24 @@ class Edgelord(Elaboratable):
     def formal(self, m):
         cycle = Signal(8, reset_less=True)
         rst = ResetSignal("pos")
-        clk = ClockSignal("pos")
 
         m.d.pos += cycle.eq(cycle + (cycle != 255))
 
         m.d.comb += Assume(rst == (cycle < 2))
+        self.invariants(m)
+
+    def invariants(self, m):
+        """Asserts what holds of pos and neg in every reachable state.
+
+        pos toggles on the rising edge and neg follows it on the falling
+        edge, so out of reset they're equal exactly while the clock is high.
+        That needs the two edges to be told apart, as with multiclock on.
+        Where both domains step together, as in the instruction proofs,
+        every pair of values is reachable and there's nothing to assert.
+        """
+        rst = ResetSignal("pos")
+        clk = ClockSignal("pos")
+
         with m.If(rst == 0):
             m.d.comb += Assert(clk == self.clk_state)
 
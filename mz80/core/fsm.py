@@ -0,0 +1,28 @@
+from nmigen import *
+
+# The state encodings that encode_fsm() knows.
+FSM_ENCODINGS = ("binary", "gray", "one-hot")
+
+
+def encode_fsm(fsm, states, encoding):
+    """Sets up the state encoding of an FSM. Call it first thing inside the
+    FSM's with block.
+
+    states is every state of the FSM, in order. With "binary", nMigen
+    numbers the states itself, in order of first use. With "gray", state N
+    gets the Nth Gray code, so that stepping through states in order flips
+    one bit at a time. "one-hot" is left to synthesis: the state register
+    is marked for yosys' fsm pass to recode. Otherwise that pass leaves
+    nMigen's FSMs alone, since their state registers have an init value.
+    Simulation and formal see the binary encoding in that case.
+    """
+    if encoding not in FSM_ENCODINGS:
+        raise ValueError("Unknown FSM encoding {!r}, expected one of {}"
+                         .format(encoding, ", ".join(FSM_ENCODINGS)))
+    if encoding == "gray":
+        # Every state has to be given here: any left out would get codes
+        # that may collide with the Gray codes.
+        fsm.encoding.update(
+            (name, n ^ (n >> 1)) for n, name in enumerate(states))
+    elif encoding == "one-hot":
+        fsm.state.attrs["fsm_encoding"] = "one-hot"
@@ -4,8 +4,10 @@ from .muxing import *
 
 
 class IR(Elaboratable):
-    def __init__(self):
+    def __init__(self, gated=True):
         self.controls = SequencerControls()
+        # Whether dataBusOut is 0 unless I or R is read.
+        self.gated = gated
 
         self.I = Signal(8)
         self.R = Signal(7)
@@ -16,12 +18,17 @@ class IR(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        with m.If(self.controls.readRegister8 == Register8.I):
-            m.d.comb += self.dataBusOut.eq(self.I)
-        with m.Elif(self.controls.readRegister8 == Register8.R):
-            m.d.comb += self.dataBusOut.eq(self.R)
-        with m.Else():
-            m.d.comb += self.dataBusOut.eq(0)
+        if self.gated:
+            with m.If(self.controls.readRegister8 == Register8.I):
+                m.d.comb += self.dataBusOut.eq(self.I)
+            with m.Elif(self.controls.readRegister8 == Register8.R):
+                m.d.comb += self.dataBusOut.eq(self.R)
+            with m.Else():
+                m.d.comb += self.dataBusOut.eq(0)
+        else:
+            m.d.comb += self.dataBusOut.eq(
+                Mux(self.controls.readRegister8 == Register8.R, self.R,
+                    self.I))
 
         with m.If(self.controls.readRegister16 == Register16.R):
             m.d.comb += self.addrBusOut.eq(self.R)
@@ -4,11 +4,27 @@ from nmigen.cli import main
 from nmigen.asserts import *
 
 from .edgelord import Edgelord
+from .fsm import encode_fsm
 from .muxing import *
 
 
 class MCycler(Elaboratable):
-    def __init__(self):
+    # Every state of the FSM, in order. See encode_fsm().
+    STATES = [
+        "RESET", "M1_1", "M1_2", "M1_3", "M1_4", "M1_EXT", "MEMRD_1",
+        "MEMRD_2", "MEMRD_3", "MEMRD_EXT", "MEMWR_1", "MEMWR_2", "MEMWR_WAIT",
+        "MEMWR_3", "MEMWR_EXT", "IORD_1", "IORD_2", "IORD_WAIT", "IORD_3",
+        "IORD_EXT", "IOWR_1", "IOWR_2", "IOWR_WAIT", "IOWR_3", "IOWR_EXT",
+        "INTERNAL", "BUSRELEASE", "BUSTAKE", "INTM1_1", "INTM1_2",
+        "INTM1_2W1", "INTM1_2W2", "INTM1_3", "INTM1_4"
+    ]
+
+    def __init__(self, fsm_encoding="one-hot", gated=True, invariants=False):
+        self.fsm_encoding = fsm_encoding
+        # Whether to assert invariants(), for induction proofs.
+        self.invariants_on = invariants
+        # Whether dataBusOut is 0 unless MCYCLER_RDATA is read.
+        self.gated = gated
         self.LATCHING = Const(0)
 
         self.controls = SequencerControls()
@@ -95,6 +111,10 @@ class MCycler(Elaboratable):
         self.pos_latched_Din = Signal(8)
 
         self.cycle_to_start = Signal.enum(MCycle)
+        # The cycle that was due when the bus was released. The sequencer
+        # only asks for it at the end of the cycle before, so it's kept
+        # here until the bus is taken back.
+        self.released_cycle = Signal.enum(MCycle)
 
         self.latched_addr = Signal(16)
         self.latched_refresh_addr = Signal(16)
@@ -132,12 +152,20 @@ class MCycler(Elaboratable):
                 self.latched_wdata.eq(self.dataBusIn),
             ]
 
-        with m.If(self.controls.readRegister8 == Register8.MCYCLER_RDATA):
+        if self.gated:
+            with m.If(self.controls.readRegister8 == Register8.MCYCLER_RDATA):
+                m.d.comb += self.dataBusOut.eq(self.rdata)
+            with m.Else():
+                m.d.comb += self.dataBusOut.eq(0)
+        else:
             m.d.comb += self.dataBusOut.eq(self.rdata)
-        with m.Else():
-            m.d.comb += self.dataBusOut.eq(0)
 
         with m.FSM(domain="pos", reset="RESET") as fsm:
+            encode_fsm(fsm, self.STATES, self.fsm_encoding)
+            # Harnesses decode the state through fsm.decoding, which is
+            # only filled in once this has been elaborated.
+            self.fsm = fsm
+
             # Defaults
             m.d.comb += [
                 self.mcycle_done.eq(0),
@@ -482,7 +510,7 @@ class MCycler(Elaboratable):
                     self.hiz.eq(1),
                     self.busack.eq(self.c),
                 ]
-                self.endCycle(m, self.cycle)
+                self.endCycle(m, self.released_cycle)
 
             with m.State("INTM1_1"):
                 m.d.comb += [
@@ -562,10 +590,37 @@ class MCycler(Elaboratable):
                 m.d.comb += self.rdata.eq(self.pos_latched_Din),
                 self.endCycle(m, self.cycle)
 
+        if self.invariants_on:
+            self.invariants(m, fsm)
         if platform == "formal":
             self.formal(m)
         return m
 
+    def invariants(self, m, fsm):
+        """Asserts what holds of the state registers in every reachable
+        state, so that an induction proof can't start from any other.
+
+        tcycles always trails the T-state being run: each state of a
+        memory cycle sets it to its own T-state for the next one.
+        """
+        with m.If(fsm.ongoing("M1_2")):
+            m.d.comb += Assert(self.tcycles == 1)
+        with m.If(fsm.ongoing("M1_3")):
+            m.d.comb += Assert(self.tcycles == 2)
+        with m.If(fsm.ongoing("M1_4")):
+            m.d.comb += Assert(self.tcycles == 3)
+        with m.If(fsm.ongoing("MEMRD_2")):
+            m.d.comb += Assert((self.tcycles == 1) | (self.tcycles == 2))
+        with m.If(fsm.ongoing("MEMRD_3")):
+            m.d.comb += Assert(self.tcycles == 2)
+        # Within the Z80, the sequencer only ever asks for these cycles, so
+        # they're all the bus can be released from.
+        m.d.comb += Assert((self.released_cycle == MCycle.NONE)
+                           | (self.released_cycle == MCycle.M1)
+                           | (self.released_cycle == MCycle.MEMRD)
+                           | (self.released_cycle == MCycle.MEMWR)
+                           | (self.released_cycle == MCycle.INTERNAL))
+
     def endCycle(self, m, next):
         m.d.pos += self.tcycles.eq(self.tcycles + 1)
         with m.If(self.extend &
@@ -592,6 +647,7 @@ class MCycler(Elaboratable):
                 self.mcycle_done.eq(~self.c),
                 self.cycle_to_start.eq(MCycle.BUSRELEASE),
             ]
+            m.d.pos += self.released_cycle.eq(next)
             m.next = "BUSRELEASE"
         with m.Elif(self.intrequested & self.last_cycle):
             m.d.comb += [
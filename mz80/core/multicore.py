@@ -0,0 +1,166 @@
+from nmigen import *
+from nmigen.cli import main
+
+from .z80 import Z80
+
+# The pins of a Z80 that MultiZ80 brings out for each core.
+PINS = [
+    "A", "Din", "Dout", "hiz", "nM1", "nMREQ", "nIORQ", "nRD", "nWR",
+    "nBUSRQ", "nBUSAK", "nINTRQ", "nWAIT"
+]
+
+# The pins of the shared bus, which come from whichever core owns it.
+BUS_OUTPUTS = ["A", "Dout", "hiz", "nM1", "nMREQ", "nIORQ", "nRD", "nWR"]
+
+
+class MultiZ80(Elaboratable):
+    """Several Z80 cores in one design.
+
+    Without shared_bus, the cores are independent: each one has its own
+    pins, on cores[i], and its own memory behind them.
+
+    With shared_bus, the cores take turns on a single bus, whose pins are
+    attributes of MultiZ80 itself. The core that owns the bus, owner, has
+    nBUSRQ high, and every other core has it low, so they float the bus and
+    assert nBUSAK. Once the owner has had the bus for quantum T-states, its
+    nBUSRQ goes low too, and when it answers with nBUSAK, ownership moves
+    on to the next core. The bus pins, and mcycle and tcycle, are those of
+    the owner. Only the owner sees nWAIT. nINTRQ is still per core.
+
+    A core out of reset fetches its first opcode before it samples nBUSRQ,
+    so with shared_bus every core but core 0 is held in reset until it
+    first owns the bus, as with the secondary CPUs of a multiprocessor
+    board. For that, each core is clocked by its own pos and neg domains,
+    named posN and negN, which follow pos and neg. pysim only triggers one
+    domain per clock signal, so only a compiled simulator can run that.
+
+    Any other keyword arguments are passed on to each Z80.
+    """
+
+    def __init__(self, cores=2, shared_bus=False, quantum=64, **core_options):
+        if cores < 1:
+            raise ValueError("Need at least one core, not {}".format(cores))
+        if quantum < 1:
+            raise ValueError("quantum must be at least 1, not {}".format(
+                quantum))
+        self.shared_bus = shared_bus
+        self.quantum = quantum
+        self.cores = [Z80(**core_options) for _ in range(cores)]
+
+        if self.shared_bus:
+            self.A = Signal(16)
+            self.Din = Signal(8)
+            self.Dout = Signal(8)
+            self.hiz = Signal()
+            self.nM1 = Signal()
+            self.nMREQ = Signal()
+            self.nIORQ = Signal()
+            self.nRD = Signal()
+            self.nWR = Signal()
+            self.nWAIT = Signal(reset=1)
+            self.mcycle = Signal.like(self.cores[0].mcycler.mcycle)
+            self.tcycle = Signal.like(self.cores[0].mcycler.tcycle)
+            self.owner = Signal(range(cores))
+
+    def ports(self):
+        if not self.shared_bus:
+            return [
+                getattr(core, name) for core in self.cores for name in PINS
+            ]
+        return [getattr(self, name) for name in BUS_OUTPUTS] + [
+            self.Din, self.nWAIT, self.owner
+        ] + [core.nINTRQ for core in self.cores]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if not self.shared_bus:
+            for i, core in enumerate(self.cores):
+                m.submodules["core{}".format(i)] = core
+            return m
+
+        n = len(self.cores)
+        # Which cores have been let out of reset. Changes on the falling
+        # edge, like a reset released by a harness between T-states.
+        started = Signal(n, reset=1)
+
+        for i, core in enumerate(self.cores):
+            pos = ClockDomain("pos{}".format(i), local=True)
+            neg = ClockDomain("neg{}".format(i), clk_edge="neg", local=True)
+            m.domains += [pos, neg]
+            m.d.neg += started[i].eq(started[i] | (self.owner == i))
+            m.d.comb += [
+                pos.clk.eq(ClockSignal("pos")),
+                pos.rst.eq(ResetSignal("pos") | ~started[i]),
+                neg.clk.eq(ClockSignal("neg")),
+                neg.rst.eq(ResetSignal("neg") | ~started[i]),
+            ]
+            m.submodules["core{}".format(i)] = DomainRenamer({
+                "pos": pos.name,
+                "neg": neg.name
+            })(core)
+
+        for name in BUS_OUTPUTS:
+            pins = Array(getattr(core, name) for core in self.cores)
+            m.d.comb += getattr(self, name).eq(pins[self.owner])
+        m.d.comb += [
+            self.mcycle.eq(
+                Array(core.mcycler.mcycle for core in self.cores)[self.owner]),
+            self.tcycle.eq(
+                Array(core.mcycler.tcycle for core in self.cores)[self.owner]),
+        ]
+        for i, core in enumerate(self.cores):
+            m.d.comb += [
+                core.Din.eq(self.Din),
+                core.nWAIT.eq(self.nWAIT | (self.owner != i)),
+            ]
+
+        if n == 1:
+            m.d.comb += self.cores[0].nBUSRQ.eq(1)
+            return m
+
+        # T-states the owner has had the bus for, and whether it has been
+        # asked to give it up.
+        held = Signal(range(self.quantum))
+        releasing = Signal()
+        has_bus = Array(core.nBUSAK for core in self.cores)[self.owner]
+        with m.If(releasing):
+            with m.If(~has_bus):
+                m.d.pos += [
+                    self.owner.eq(Mux(self.owner == n - 1, 0,
+                                      self.owner + 1)),
+                    releasing.eq(0),
+                    held.eq(0),
+                ]
+        with m.Elif(has_bus):
+            with m.If(held == self.quantum - 1):
+                m.d.pos += releasing.eq(1)
+            with m.Else():
+                m.d.pos += held.eq(held + 1)
+
+        for i, core in enumerate(self.cores):
+            m.d.comb += core.nBUSRQ.eq((self.owner == i) & ~releasing)
+
+        return m
+
+
+if __name__ == "__main__":
+    clk = Signal()
+    rst = Signal()
+
+    pos = ClockDomain()
+    pos.clk = clk
+    pos.rst = rst
+
+    neg = ClockDomain(clk_edge="neg")
+    neg.clk = clk
+    neg.rst = rst
+
+    multi = MultiZ80(shared_bus=True)
+
+    m = Module()
+    m.domains.pos = pos
+    m.domains.neg = neg
+    m.submodules.multi = multi
+
+    main(m, ports=multi.ports())
@@ -75,6 +75,37 @@ class Register8(Enum):
         ])[value]
 
 
+@unique
+class BusUnit(Enum):
+    """The units that can drive the data bus."""
+    REGISTERS = 0
+    ALU = 1
+    ADDR_ALU = 2
+    MCYCLER = 3
+    IR = 4
+
+
+# The unit that drives the data bus when a Register8 is read. Reading any
+# other Register8 leaves the bus at 0.
+BUS_UNITS = {
+    Register8.I: BusUnit.IR,
+    Register8.R: BusUnit.IR,
+    Register8.W: BusUnit.REGISTERS,
+    Register8.Z: BusUnit.REGISTERS,
+    Register8.B: BusUnit.REGISTERS,
+    Register8.C: BusUnit.REGISTERS,
+    Register8.D: BusUnit.REGISTERS,
+    Register8.E: BusUnit.REGISTERS,
+    Register8.H: BusUnit.REGISTERS,
+    Register8.L: BusUnit.REGISTERS,
+    Register8.A: BusUnit.ALU,
+    Register8.F: BusUnit.ALU,
+    Register8.TMP: BusUnit.ALU,
+    Register8.ADDR_ALU: BusUnit.ADDR_ALU,
+    Register8.MCYCLER_RDATA: BusUnit.MCYCLER,
+}
+
+
 @unique
 class Register16(Enum):
     NONE = 0
@@ -5,21 +5,61 @@ from nmigen.asserts import *
 
 from .muxing import *
 from .arch import Registers
+from .decode import Decoder, DecodedInstr, InstrClass, opcode_classes
+from .fsm import encode_fsm
 from .mcycler import *
+from .steps import Microsequencer, Step
 from .transparent_latch import TransparentLatch
-from ..z80fi.z80fi import Z80fiInterface
+from ..z80fi.z80fi import Z80fiInterface, z80fi_parts
 
 
 class Sequencer(Elaboratable):
-    def __init__(self, include_z80fi=False):
+    """Sequences the M-cycles of each instruction, and drives the controls.
+
+    The opcode is decoded once, by table lookup (see decode.py), and the
+    result registered at M1_T2 along with the opcode itself. Everything
+    after that works from the registered decode.
+
+    With microcoded, each instruction's steps come from a microcode ROM
+    (see steps.py) instead of the hand-written steps in execute(). Both
+    give the same cycle-by-cycle behavior.
+
+    fsm_encoding is the state encoding of the FSM, see encode_fsm().
+
+    include_z80fi is anything z80fi_parts() takes. Only the parts it names
+    are recorded, and with none, nothing of z80fi is built at all.
+
+    opcodes, if given, is a pattern as in Value.matches(), and only the
+    instructions matching it, and the DD/FD prefixes, are built into
+    execute(). Any other opcode does nothing, so it's only for formal
+    harnesses that assume no other opcode is ever fetched. The microcode
+    ROM isn't pruned.
+    """
+
+    # Every state of the FSM, in order. See encode_fsm().
+    STATES = [
+        "RESET", "M1_T1", "M1_T2", "M1_T3", "M1_T4", "EXTENDED",
+        "RDOPERAND_T1", "RDOPERAND_T2", "RDOPERAND_T3", "RDMEM_T1",
+        "RDMEM_T2", "RDMEM_T3", "WRMEM_T1", "WRMEM_T2", "WRMEM_T3",
+        "INTERNAL_T1", "INTERNAL_T2", "INTERNAL_T3", "HALT"
+    ]
+
+    def __init__(self, include_z80fi=False, microcoded=False,
+                 fsm_encoding="one-hot", invariants=False, opcodes=None):
         self.cycle_num = Signal.range(0, 10)
 
         self.dataBusIn = Signal(8)
 
         self.controls = SequencerControls(name="ctrls")
+        # One-hot, by BusUnit: the unit that drives the data bus, decoded
+        # from controls.readRegister8.
+        self.dataBusSource = Signal(len(BusUnit))
         self.extended_cycle_controls = SequencerControls(name="extcyc_ctrls")
 
         self.instr = TransparentLatch(8)
+        self.decoder = Decoder()
+        # The decoded instruction, registered when the opcode is read.
+        self.decoded = DecodedInstr(name="decoded")
         # During M1, whether this is the beginning of the instruction.
         self.start_insn = Signal()
 
@@ -46,11 +86,25 @@ class Sequencer(Elaboratable):
         # Tells the sequencer that all the actions it set up are to be
         # registered on the positive edge of the clock.
         self.act = Signal()
+        # The MCycler's cycle and T-state, only looked at by invariants().
+        self.mcycle = Signal.enum(MCycle)
+        self.tcycle = Signal(4)
 
-        self.include_z80fi = include_z80fi
+        # Whether to assert invariants(), for induction proofs.
+        self.invariants_on = invariants
+
+        self.z80fi_parts = z80fi_parts(include_z80fi)
+        self.include_z80fi = bool(self.z80fi_parts)
         if self.include_z80fi:
             self.z80fi = Z80fiInterface()
 
+        self.microcoded = microcoded
+        self.fsm_encoding = fsm_encoding
+        # The InstrClasses execute() handles, or None for all of them.
+        self.classes = None if opcodes is None else opcode_classes(opcodes)
+        if self.microcoded:
+            self.microsequencer = Microsequencer()
+
     def ports(self):
         ps = [
             self.extend, self.last_cycle, self.cycle, self.dataBusIn, self.act,
@@ -59,6 +113,10 @@ class Sequencer(Elaboratable):
         #     ps.extend(self.z80fi.ports())
         return ps
 
+    def recording(self, part):
+        """Returns whether the z80fi part named is built in."""
+        return part in self.z80fi_parts
+
     def elaborate(self, platform):
         m = Module()
 
@@ -66,9 +124,33 @@ class Sequencer(Elaboratable):
         m.submodules.instr = self.instr
         m.d.comb += self.instr.input.eq(self.dataBusIn)
 
+        with m.Switch(self.controls.readRegister8):
+            for reg, unit in BUS_UNITS.items():
+                with m.Case(reg):
+                    m.d.comb += self.dataBusSource.eq(1 << unit.value)
+
+        m.submodules.decoder = self.decoder
+        m.d.comb += self.decoder.opcode.eq(self.instr.input)
+        m.d.comb += self.decoder.indexed.eq(self.controls.useIX
+                                            | self.controls.useIY)
+
+        if self.microcoded:
+            m.submodules.microsequencer = useq = self.microsequencer
+            m.d.comb += [
+                useq.klass.eq(self.decoded.klass),
+                useq.src.eq(self.decoded.src),
+                useq.dst.eq(self.decoded.dst),
+                useq.cycle_num.eq(self.cycle_num),
+            ]
+
         # When the MCycler is waitstated, there will be no act. In any other
         # case, every state transition leads to an act.
         with m.FSM(domain="pos", reset="RESET") as fsm:
+            encode_fsm(fsm, self.STATES, self.fsm_encoding)
+            # Harnesses decode the state through fsm.decoding, which is
+            # only filled in once this has been elaborated.
+            self.fsm = fsm
+
             # defaults
             m.d.comb += self.controls.eq(0)
             m.d.comb += self.controls.useIX.eq(self.useIX)
@@ -110,7 +192,8 @@ class Sequencer(Elaboratable):
                         # load up the state going in to this instruction on the
                         # next cycle.
                         m.d.comb += self.z80fi.control.set_valid.eq(1)
-                        m.d.comb += self.z80fi.control.save_registers_out.eq(1)
+                        if self.recording("registers"):
+                            m.d.comb += self.z80fi.control.save_registers_out.eq(1)
 
                 m.next = "M1_T2"
 
@@ -125,6 +208,7 @@ class Sequencer(Elaboratable):
                         IncDecSetting.INC)
                     m.d.comb += self.controls.writeRegister16.eq(Register16.PC)
                     m.d.pos += self.instr.en.eq(0)
+                    m.d.pos += self.decoded.eq(self.decoder.decoded)
 
                     # Take a snapshot of the state. This is the state going
                     # in to this instruction. Also the instruction register.
@@ -133,20 +217,22 @@ class Sequencer(Elaboratable):
                     # otherwise we'd have to allow infinite prefixes!
                     if self.include_z80fi:
                         m.d.comb += [
-                            self.z80fi.control.save_registers_in.eq(1),
                             self.z80fi.control.clear.eq(1),
-                            self.z80fi.control.add_mcycle.eq(MCycle.M1),
                             self.z80fi.control.save_instruction.eq(1),
                             self.z80fi.control.instr.eq(self.instr.input),
                             self.z80fi.control.useIX.eq(self.controls.useIX),
                             self.z80fi.control.useIY.eq(self.controls.useIY),
                         ]
+                    if self.recording("registers"):
+                        m.d.comb += self.z80fi.control.save_registers_in.eq(1)
+                    if self.recording("cycles"):
+                        m.d.comb += self.z80fi.control.add_mcycle.eq(MCycle.M1)
 
                     m.next = "M1_T3"
 
             with m.State("M1_T3"):
                 m.d.comb += self.controls.readRegister16.eq(Register16.R)
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                 m.next = "M1_T4"
 
@@ -154,13 +240,13 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.readRegister16.eq(Register16.R)
                 m.d.comb += self.controls.incR.eq(1)
                 m.d.pos += self.start_insn.eq(0)
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                 self.execute(m)
 
             with m.State("EXTENDED"):
                 m.d.comb += self.controls.eq(self.extended_cycle_controls)
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                 self.execute(m)
 
@@ -168,7 +254,7 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.readRegister16.eq(Register16.PC)
                 m.d.comb += self.controls.readRegister8.eq(
                     Register8.MCYCLER_RDATA)
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_mcycle.eq(MCycle.MEMRD)
                 m.next = "RDOPERAND_T2"
 
@@ -178,7 +264,7 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.readRegister8.eq(
                     Register8.MCYCLER_RDATA)
                 with m.If(self.act):
-                    if self.include_z80fi:
+                    if self.recording("cycles"):
                         m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                     m.next = "RDOPERAND_T3"
 
@@ -192,17 +278,18 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.writeRegister8.eq(self.memrd_dest)
                 self.execute(m)
 
-                if self.include_z80fi:
+                if self.recording("bus"):
                     m.d.comb += self.z80fi.control.add_operand.eq(1)
                     m.d.comb += self.z80fi.control.data.eq(self.z80fi.bus.data)
                     m.d.comb += self.z80fi.control.addr.eq(self.z80fi.bus.addr)
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
 
             with m.State("RDMEM_T1"):
                 m.d.comb += self.controls.readRegister16.eq(self.memrd_addr)
                 m.d.comb += self.controls.readRegister8.eq(
                     Register8.MCYCLER_RDATA)
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_mcycle.eq(MCycle.MEMRD)
                 m.next = "RDMEM_T2"
 
@@ -212,7 +299,7 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.readRegister8.eq(
                     Register8.MCYCLER_RDATA)
                 with m.If(self.act):
-                    if self.include_z80fi:
+                    if self.recording("cycles"):
                         m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                     m.next = "RDMEM_T3"
 
@@ -223,16 +310,17 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.writeRegister8.eq(self.memrd_dest)
                 self.execute(m)
 
-                if self.include_z80fi:
+                if self.recording("bus"):
                     m.d.comb += self.z80fi.control.add_memrd_access.eq(1)
                     m.d.comb += self.z80fi.control.data.eq(self.z80fi.bus.data)
                     m.d.comb += self.z80fi.control.addr.eq(self.z80fi.bus.addr)
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
 
             with m.State("WRMEM_T1"):
                 m.d.comb += self.controls.readRegister16.eq(self.memwr_addr)
                 m.d.comb += self.controls.readRegister8.eq(self.memwr_src)
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_mcycle.eq(MCycle.MEMWR)
                 m.next = "WRMEM_T2"
 
@@ -241,7 +329,7 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.readRegister16.eq(self.memwr_addr)
                 m.d.comb += self.controls.readRegister8.eq(self.memwr_src)
                 with m.If(self.act):
-                    if self.include_z80fi:
+                    if self.recording("cycles"):
                         m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                     m.next = "WRMEM_T3"
 
@@ -250,36 +338,95 @@ class Sequencer(Elaboratable):
                 m.d.comb += self.controls.readRegister8.eq(self.memwr_src)
                 self.execute(m)
 
-                if self.include_z80fi:
+                if self.recording("bus"):
                     m.d.comb += self.z80fi.control.add_memwr_access.eq(1)
                     m.d.comb += self.z80fi.control.data.eq(self.z80fi.bus.data)
                     m.d.comb += self.z80fi.control.addr.eq(self.z80fi.bus.addr)
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
 
             with m.State("INTERNAL_T1"):
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_mcycle.eq(MCycle.INTERNAL)
                 m.next = "INTERNAL_T2"
                 m.d.comb += self.cycle.eq(MCycle.INTERNAL)
                 self.execute(m)
 
             with m.State("INTERNAL_T2"):
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                 m.next = "INTERNAL_T3"
                 m.d.comb += self.cycle.eq(MCycle.INTERNAL)
                 self.execute(m)
 
             with m.State("INTERNAL_T3"):
-                if self.include_z80fi:
+                if self.recording("cycles"):
                     m.d.comb += self.z80fi.control.add_tcycle.eq(1)
                 self.execute(m)
 
             with m.State("HALT"):
                 m.next = "HALT"
 
+        if self.invariants_on:
+            self.invariants(m, fsm)
+
         return m
 
+    # The MCycler's cycle and T-state in each state of the sequencer, which
+    # runs in step with it. A T-state of None is any. In the first T-state
+    # of a cycle, the sequencer is also held while the bus is released.
+    LOCKSTEP = {
+        "RESET": (MCycle.NONE, None),
+        "M1_T1": (MCycle.M1, 1),
+        "M1_T2": (MCycle.M1, 2),
+        "M1_T3": (MCycle.M1, 3),
+        "M1_T4": (MCycle.M1, 4),
+        "RDOPERAND_T1": (MCycle.MEMRD, 1),
+        "RDOPERAND_T2": (MCycle.MEMRD, 2),
+        "RDOPERAND_T3": (MCycle.MEMRD, 3),
+        "RDMEM_T1": (MCycle.MEMRD, 1),
+        "RDMEM_T2": (MCycle.MEMRD, 2),
+        "RDMEM_T3": (MCycle.MEMRD, 3),
+        "WRMEM_T1": (MCycle.MEMWR, 1),
+        "WRMEM_T2": (MCycle.MEMWR, 2),
+        "WRMEM_T3": (MCycle.MEMWR, 3),
+        "INTERNAL_T1": (MCycle.INTERNAL, None),
+        "INTERNAL_T2": (MCycle.INTERNAL, None),
+        "INTERNAL_T3": (MCycle.INTERNAL, None),
+    }
+
+    def invariants(self, m, fsm):
+        """Asserts what holds of the state registers in every reachable
+        state, so that an induction proof can't start from any other.
+
+        Besides the sequencer's own state, that's LOCKSTEP, which needs
+        mcycle and tcycle connected to the MCycler's. Interrupts aren't
+        sequenced yet, so it only holds until one is taken, or until an
+        opcode that isn't implemented is fetched.
+        """
+        m.d.comb += Assert(~(self.useIX & self.useIY))
+        # start_insn is set with the fetch of an instruction's first
+        # opcode, and cleared as that M1 cycle ends.
+        with m.If(self.start_insn):
+            m.d.comb += Assert(
+                fsm.ongoing("M1_T1") | fsm.ongoing("M1_T2")
+                | fsm.ongoing("M1_T3") | fsm.ongoing("M1_T4"))
+
+        for state, (mcycle, tcycle) in self.LOCKSTEP.items():
+            in_step = self.mcycle == mcycle
+            if tcycle is not None:
+                in_step &= self.tcycle == tcycle
+            if state.endswith("_T1"):
+                in_step |= self.mcycle == MCycle.BUSRELEASE
+            with m.If(fsm.ongoing(state)):
+                m.d.comb += Assert(in_step)
+        # Only these cycles are ever extended.
+        with m.If(fsm.ongoing("EXTENDED")):
+            m.d.comb += Assert((self.mcycle == MCycle.M1)
+                               | (self.mcycle == MCycle.MEMRD)
+                               | (self.mcycle == MCycle.MEMWR)
+                               | (self.mcycle == MCycle.INTERNAL))
+
     def initiateInstructionFetch(self, m):
         """Initiates an M1 cycle for the first byte in an instruction.
 
@@ -385,27 +532,82 @@ class Sequencer(Elaboratable):
 
     def execute(self, m):
         m.d.pos += self.cycle_num.eq(self.cycle_num + 1)
-        with m.Switch(self.instr.output):
-            with m.Case(0xDD):
+        if self.microcoded:
+            self.executeMicrocode(m)
+            return
+
+        with m.Switch(self.decoded.klass):
+            with m.Case(InstrClass.PREFIX_IX):
                 m.d.pos += self.useIX.eq(1)
                 m.d.pos += self.useIY.eq(0)
                 m.d.pos += self.cycle_num.eq(0)
                 self.initiateOpcodeFetch(m)
 
-            with m.Case(0xFD):
+            with m.Case(InstrClass.PREFIX_IY):
                 m.d.pos += self.useIX.eq(0)
                 m.d.pos += self.useIY.eq(1)
                 m.d.pos += self.cycle_num.eq(0)
                 self.initiateOpcodeFetch(m)
 
-            with m.Case("00000000"):
-                self.NOP(m)
+            handlers = [
+                ([InstrClass.NOP], self.NOP),
+                ([InstrClass.HALT, InstrClass.LD_R_R, InstrClass.LD_R_HL,
+                  InstrClass.LD_HL_R, InstrClass.LD_R_IDX,
+                  InstrClass.LD_IDX_R], self.LD_REG_REG),
+                ([InstrClass.LD_R_N, InstrClass.LD_HL_N,
+                  InstrClass.LD_IDX_N], self.LD_REG_N),
+            ]
+            for classes, handler in handlers:
+                if self.classes is not None:
+                    classes = [c for c in classes if c in self.classes]
+                if classes:
+                    with m.Case(*classes):
+                        handler(m)
+
+    def executeMicrocode(self, m):
+        """Carries out the microword for the current step."""
+        useq = self.microsequencer
+        with m.Switch(useq.step):
+            with m.Case(Step.PREFIX_IX):
+                m.d.pos += self.useIX.eq(1)
+                m.d.pos += self.useIY.eq(0)
+                m.d.pos += self.cycle_num.eq(0)
+                self.initiateOpcodeFetch(m)
+
+            with m.Case(Step.PREFIX_IY):
+                m.d.pos += self.useIX.eq(0)
+                m.d.pos += self.useIY.eq(1)
+                m.d.pos += self.cycle_num.eq(0)
+                self.initiateOpcodeFetch(m)
+
+            with m.Case(Step.FETCH):
+                self.initiateInstructionFetch(m)
+
+            with m.Case(Step.COPY_REG8):
+                self.setDataBusSource(m, useq.a)
+                self.writeRegister8(m, useq.b)
+                self.initiateInstructionFetch(m)
+
+            with m.Case(Step.HALT):
+                m.next = "HALT"
 
-            with m.Case("01------"):
-                self.LD_REG_REG(m)
+            with m.Case(Step.OPERAND):
+                self.initiateOperandReadInto(m, useq.a)
 
-            with m.Case("00---110"):
-                self.LD_REG_N(m)
+            with m.Case(Step.MEM_RD):
+                self.initiateMemRead(m, useq.reg16, useq.a)
+
+            with m.Case(Step.MEM_WR):
+                self.initiateMemWrite(m, useq.reg16, useq.a)
+
+            with m.Case(Step.INTERNAL):
+                self.initiateInternalOperation(m)
+
+            with m.Case(Step.ADDR_ALU_ADD_LO):
+                self.aluAddrAddLow(m, useq.reg16, useq.a)
+
+            with m.Case(Step.ADDR_ALU_ADD_HI):
+                self.aluAddrAddHigh(m, useq.reg16, useq.a)
 
     def NOP(self, m):
         self.initiateInstructionFetch(m)
@@ -446,31 +648,31 @@ class Sequencer(Elaboratable):
         ]
 
     def LD_REG_REG(self, m):
-        dst_r = self.instr.output[3:6]
-        src_r = self.instr.output[0:3]
-        dst_hl = (dst_r == 6)
-        src_hl = (src_r == 6)
-        indexed = self.controls.useIX | self.controls.useIY
+        src = self.decoded.src
+        dst = self.decoded.dst
 
-        with m.If(~dst_hl & ~src_hl):
-            self.setDataBusSource(m, Register8.r(src_r))
-            self.writeRegister8(m, Register8.r(dst_r))
-            self.initiateInstructionFetch(m)
-        with m.Elif(dst_hl & src_hl):
-            m.next = "HALT"
-        with m.Elif(~indexed):
-            with m.If(src_hl):
+        with m.Switch(self.decoded.klass):
+            with m.Case(InstrClass.LD_R_R):
+                self.setDataBusSource(m, src)
+                self.writeRegister8(m, dst)
+                self.initiateInstructionFetch(m)
+
+            with m.Case(InstrClass.HALT):
+                m.next = "HALT"
+
+            with m.Case(InstrClass.LD_R_HL):
                 with m.If(self.cycle_num == 0):
-                    self.initiateMemRead(m, Register16.HL, Register8.r(dst_r))
+                    self.initiateMemRead(m, Register16.HL, dst)
                 with m.Else():
                     self.initiateInstructionFetch(m)
-            with m.Else():
+
+            with m.Case(InstrClass.LD_HL_R):
                 with m.If(self.cycle_num == 0):
-                    self.initiateMemWrite(m, Register16.HL, Register8.r(src_r))
+                    self.initiateMemWrite(m, Register16.HL, src)
                 with m.Else():
                     self.initiateInstructionFetch(m)
-        with m.Else():
-            with m.If(src_hl):
+
+            with m.Case(InstrClass.LD_R_IDX):
                 with m.If(self.cycle_num == 0):
                     self.initiateOperandReadInto(m, Register8.OFFSET)
                 with m.Elif(self.cycle_num == 1):
@@ -484,10 +686,11 @@ class Sequencer(Elaboratable):
                 with m.Elif(self.cycle_num == 5):
                     self.aluAddrAddHigh(m, Register16.HL, Register8.W)
                 with m.Elif(self.cycle_num == 6):
-                    self.initiateMemRead(m, Register16.WZ, Register8.r(dst_r))
+                    self.initiateMemRead(m, Register16.WZ, dst)
                 with m.Else():
                     self.initiateInstructionFetch(m)
-            with m.Else():
+
+            with m.Case(InstrClass.LD_IDX_R):
                 with m.If(self.cycle_num == 0):
                     self.initiateOperandReadInto(m, Register8.OFFSET)
                 with m.Elif(self.cycle_num == 1):
@@ -501,41 +704,39 @@ class Sequencer(Elaboratable):
                 with m.Elif(self.cycle_num == 5):
                     self.aluAddrAddHigh(m, Register16.HL, Register8.W)
                 with m.Elif(self.cycle_num == 6):
-                    self.initiateMemWrite(m, Register16.WZ, Register8.r(src_r))
+                    self.initiateMemWrite(m, Register16.WZ, src)
                 with m.Else():
                     self.initiateInstructionFetch(m)
 
     def LD_REG_N(self, m):
-        r = self.instr.output[3:6]
-
-        with m.If(r != 6):
-            with m.If(self.cycle_num == 0):
-                self.initiateOperandReadInto(m, Register8.r(r))
-            with m.Else():
-                self.initiateInstructionFetch(m)
-
-        with m.Elif(~self.controls.useIX & ~self.controls.useIY):
-            with m.If(self.cycle_num == 0):
-                self.initiateOperandReadInto(m, Register8.TMP)
-            with m.Elif(self.cycle_num == 1):
-                self.initiateMemWrite(m, Register16.HL, Register8.TMP)
-            with m.Else():
-                self.initiateInstructionFetch(m)
+        with m.Switch(self.decoded.klass):
+            with m.Case(InstrClass.LD_R_N):
+                with m.If(self.cycle_num == 0):
+                    self.initiateOperandReadInto(m, self.decoded.dst)
+                with m.Else():
+                    self.initiateInstructionFetch(m)
 
-        with m.Else():
-            with m.If(self.cycle_num == 0):
-                self.initiateOperandReadInto(m, Register8.OFFSET)
-            with m.Elif(self.cycle_num == 1):
-                self.initiateOperandReadInto(m, Register8.TMP)
-            with m.Elif(self.cycle_num == 2):
-                self.aluAddrAddLow(m, Register16.HL, Register8.Z)
-            with m.Elif(self.cycle_num == 3):
-                self.aluAddrAddHigh(m, Register16.HL, Register8.W)
-            with m.Elif(self.cycle_num == 4):
-                self.initiateMemWrite(m, Register16.WZ, Register8.TMP)
-            with m.Else():
-                self.initiateInstructionFetch(m)
+            with m.Case(InstrClass.LD_HL_N):
+                with m.If(self.cycle_num == 0):
+                    self.initiateOperandReadInto(m, Register8.TMP)
+                with m.Elif(self.cycle_num == 1):
+                    self.initiateMemWrite(m, Register16.HL, Register8.TMP)
+                with m.Else():
+                    self.initiateInstructionFetch(m)
 
+            with m.Case(InstrClass.LD_IDX_N):
+                with m.If(self.cycle_num == 0):
+                    self.initiateOperandReadInto(m, Register8.OFFSET)
+                with m.Elif(self.cycle_num == 1):
+                    self.initiateOperandReadInto(m, Register8.TMP)
+                with m.Elif(self.cycle_num == 2):
+                    self.aluAddrAddLow(m, Register16.HL, Register8.Z)
+                with m.Elif(self.cycle_num == 3):
+                    self.aluAddrAddHigh(m, Register16.HL, Register8.W)
+                with m.Elif(self.cycle_num == 4):
+                    self.initiateMemWrite(m, Register16.WZ, Register8.TMP)
+                with m.Else():
+                    self.initiateInstructionFetch(m)
 
 if __name__ == "__main__":
     clk = Signal()
@@ -1,142 +1,227 @@
+from enum import Enum, unique
 from nmigen import *
 from nmigen.cli import main
 from nmigen.asserts import *
 
+from .decode import InstrClass
 from .muxing import *
-from .arch import Registers
-from .mcycler import *
-from .transparent_latch import TransparentLatch
-from ..z80fi.z80fi import Z80fiInterface
+
 
 @unique
 class Step(Enum):
-    # Copy Register8 to another Register8. Args: src (reg8), dest (reg8)
-    COPY_REG8 = 0
-    HALT = 1
-    # Do a memory read cycle. Args: addr (reg16), dest (reg8)
-    MEM_RD = 2
-    # Do a memory write cycle. Args: addr (reg16), src (reg8)
-    MEM_WR = 3
-    # Add using addr ALU, low. Args: addr (reg16), dest (reg8)
-    ADDR_ALU_ADD_LO = 4
-    # Add using addr ALU, high. Args: addr (reg16), dest (reg8)
-    ADDR_ALU_ADD_HI = 5
+    # Nothing happens; the M-cycle in progress carries on.
+    NONE = 0
+    # Fetch the next instruction.
+    FETCH = 1
+    # Copy Register8 to another Register8, and fetch the next instruction.
+    # Args: src (reg8 a), dest (reg8 b)
+    COPY_REG8 = 2
+    HALT = 3
+    # Read an operand. Args: dest (reg8 a)
+    OPERAND = 4
+    # Do a memory read cycle. Args: addr (reg16), dest (reg8 a)
+    MEM_RD = 5
+    # Do a memory write cycle. Args: addr (reg16), src (reg8 a)
+    MEM_WR = 6
+    # Do an internal cycle.
+    INTERNAL = 7
+    # Add using addr ALU, low. Args: addr (reg16), dest (reg8 a)
+    ADDR_ALU_ADD_LO = 8
+    # Add using addr ALU, high. Args: addr (reg16), dest (reg8 a)
+    ADDR_ALU_ADD_HI = 9
+    # DD and FD prefixes: fetch the opcode that follows.
+    PREFIX_IX = 10
+    PREFIX_IY = 11
+
 
 @unique
 class Arg(Enum):
-    NONE = 0
-    # Translate a register r-encoding to Register8
-    REG8_R = 1
-    # Register 16
-    REG16 = 2
-    HL = 3
-    PC = 4
-    OFFSET = 5
+    # The Register8 in the microword.
+    REG8 = 0
+    # The decoded register in bits 0-2 of the opcode
+    SRC_R = 1
+    # The decoded register in bits 3-5 of the opcode
+    DST_R = 2
+
+
+class Microword(object):
+    """One step of a microprogram, run at the end of an M-cycle."""
+
+    def __init__(self, step, reg16=Register16.NONE, a=Register8.NONE,
+                 b=Register8.NONE):
+        self.step = step
+        self.reg16 = reg16
+        self.a = a
+        self.b = b
+
+    @staticmethod
+    def _arg(value):
+        if isinstance(value, Arg):
+            return Register8.NONE.value, value.value
+        return value.value, Arg.REG8.value
+
+    def encode(self):
+        a, a_sel = self._arg(self.a)
+        b, b_sel = self._arg(self.b)
+        fields = [(self.step.value, STEP_BITS),
+                  (self.reg16.value, REG16_BITS), (a, REG8_BITS),
+                  (a_sel, ARG_BITS), (b, REG8_BITS), (b_sel, ARG_BITS)]
+        word = 0
+        shift = 0
+        for value, bits in fields:
+            word |= value << shift
+            shift += bits
+        return word
+
+
+STEP_BITS = Shape.cast(Step).width
+REG16_BITS = Shape.cast(Register16).width
+REG8_BITS = Shape.cast(Register8).width
+ARG_BITS = Shape.cast(Arg).width
+WORD_BITS = STEP_BITS + REG16_BITS + 2 * (REG8_BITS + ARG_BITS)
+
+# The microprograms. Step N of a program runs at the end of the instruction's
+# Nth M-cycle (or extended cycle), counting the opcode fetch as 0; this is
+# the cycle_num of the hand-written sequencer.
+PROGRAMS = {
+    InstrClass.NONE: [Microword(Step.NONE)],
+    InstrClass.PREFIX_IX: [Microword(Step.PREFIX_IX)],
+    InstrClass.PREFIX_IY: [Microword(Step.PREFIX_IY)],
+    InstrClass.NOP: [Microword(Step.FETCH)],
+    InstrClass.HALT: [Microword(Step.HALT)],
+    InstrClass.LD_R_R: [Microword(Step.COPY_REG8, a=Arg.SRC_R, b=Arg.DST_R)],
+    InstrClass.LD_R_HL: [
+        Microword(Step.MEM_RD, Register16.HL, Arg.DST_R),
+        Microword(Step.FETCH),
+    ],
+    InstrClass.LD_HL_R: [
+        Microword(Step.MEM_WR, Register16.HL, Arg.SRC_R),
+        Microword(Step.FETCH),
+    ],
+    InstrClass.LD_R_IDX: [
+        Microword(Step.OPERAND, a=Register8.OFFSET),
+        Microword(Step.INTERNAL),
+        Microword(Step.NONE),
+        Microword(Step.NONE),
+        Microword(Step.ADDR_ALU_ADD_LO, Register16.HL, Register8.Z),
+        Microword(Step.ADDR_ALU_ADD_HI, Register16.HL, Register8.W),
+        Microword(Step.MEM_RD, Register16.WZ, Arg.DST_R),
+        Microword(Step.FETCH),
+    ],
+    InstrClass.LD_IDX_R: [
+        Microword(Step.OPERAND, a=Register8.OFFSET),
+        Microword(Step.INTERNAL),
+        Microword(Step.NONE),
+        Microword(Step.NONE),
+        Microword(Step.ADDR_ALU_ADD_LO, Register16.HL, Register8.Z),
+        Microword(Step.ADDR_ALU_ADD_HI, Register16.HL, Register8.W),
+        Microword(Step.MEM_WR, Register16.WZ, Arg.SRC_R),
+        Microword(Step.FETCH),
+    ],
+    InstrClass.LD_R_N: [
+        Microword(Step.OPERAND, a=Arg.DST_R),
+        Microword(Step.FETCH),
+    ],
+    InstrClass.LD_HL_N: [
+        Microword(Step.OPERAND, a=Register8.TMP),
+        Microword(Step.MEM_WR, Register16.HL, Register8.TMP),
+        Microword(Step.FETCH),
+    ],
+    InstrClass.LD_IDX_N: [
+        Microword(Step.OPERAND, a=Register8.OFFSET),
+        Microword(Step.OPERAND, a=Register8.TMP),
+        Microword(Step.ADDR_ALU_ADD_LO, Register16.HL, Register8.Z),
+        Microword(Step.ADDR_ALU_ADD_HI, Register16.HL, Register8.W),
+        Microword(Step.MEM_WR, Register16.WZ, Register8.TMP),
+        Microword(Step.FETCH),
+    ],
+}
+
+
+def build_rom():
+    """Lays out PROGRAMS in a microcode ROM.
+
+    Returns (entries, words): entries[klass.value] is the address of the
+    InstrClass's program in words, the encoded microwords. Every
+    program is padded to the longest, so that stepping past the end of a
+    short program (which the sequencer never does) lands on NONE.
+    """
+    length = max(len(program) for program in PROGRAMS.values())
+    words = []
+    entries = []
+    for klass in InstrClass:
+        program = PROGRAMS[klass]
+        entries.append(len(words))
+        padded = program + [Microword(Step.NONE)] * (length - len(program))
+        words.extend(word.encode() for word in padded)
+    return entries, words
+
 
 class Microsequencer(Elaboratable):
+    """Looks up the microword for an instruction's current step.
+
+    The entry point comes from the instruction's decoded InstrClass (see
+    decode.py), and the step is the cycle number past that. Register
+    arguments come from the decoded src and dst, so the opcode itself is
+    never looked at here.
+    """
+
     def __init__(self):
-        self.controls = SequencerControls(name="ctrls")
-        self.microPC = Signal(16)
-        self.advance = Signal()
-        self.pgm = Array([])
-        self.op1 = Signal(16)
-        self.op2 = Signal(16)
-
-        self.memrd_addr = Signal.enum(Register16)
-        self.memrd_dest = Signal.enum(Register8)
-        self.memwr_addr = Signal.enum(Register16)
-        self.memwr_src = Signal.enum(Register8)
+        self.klass = Signal.enum(InstrClass)
+        self.src = Signal.enum(Register8)
+        self.dst = Signal.enum(Register8)
+        self.cycle_num = Signal.range(0, 10)
+
+        self.step = Signal.enum(Step)
+        self.reg16 = Signal.enum(Register16)
+        self.a = Signal.enum(Register8)
+        self.b = Signal.enum(Register8)
+
+        entries, words = build_rom()
+        self.entries = Memory(width=Shape.cast(range(len(words))).width,
+                              depth=len(entries), init=entries)
+        self.rom = Memory(width=WORD_BITS, depth=len(words), init=words)
+
+    def ports(self):
+        return [
+            self.klass, self.src, self.dst, self.cycle_num, self.step,
+            self.reg16, self.a, self.b
+        ]
 
     def elaborate(self, platform):
         m = Module()
-
-        step = self.pgm[microPC]
-        arg1 = self.pgm[microPC+1]
-        arg2 = self.pgm[microPC+2]
-        mcycle = self.pgm[microPC+3]
-        next_microPC = self.pgm[microPC+4]
-
-        op1 = Signal(16)
-        op2 = Signal(16)
-
-        m.d.comb += self.cycle.eq(mcycle)
-        with m.If(self.advance):
-            m.d.pos += self.microPC.eq(next_microPC)
-
-        with m.Switch(arg1):
-            with m.Case(Arg.REGISTER8_R):
-                m.d.comb += op1.eq(Register8.r(self.op1))
-            with m.Case(Arg.Register16):
-                m.d.comb += op1.eq(self.op1)
-
-        with m.Switch(arg2):
-            with m.Case(Arg.REGISTER8_R):
-                m.d.comb += op2.eq(Register8.r(self.op2))
-            with m.Case(Arg.Register16):
-                m.d.comb += op2.eq(self.op2)
-
-        with m.Switch(step):
-            with m.Case(Step.COPY_REG8):
-                m.d.comb += self.controls.readRegister8.eq(op1)
-                m.d.comb += self.controls.writeRegister8.eq(op2)
-            with m.Case(Step.HALT):
-                pass
-            with m.Case(Step.MEM_RD):
-                m.d.pos += self.memrd_addr.eq(op1)
-                m.d.pos += self.memrd_dest.eq(op2)
-            with m.Case(Step.MEM_WR):
-                m.d.pos += self.memwr_addr.eq(op1)
-                m.d.pos += self.memwr_src.eq(op2)
-            with m.Case(Step.ADDR_ALU_ADD_LO):
-                m.d.pos += self.addrALUInput.eq(op1)
-                m.d.pos += self.addrALUInputByte.eq(0)
-                m.d.comb += self.controls.readRegister8.eq(Register8.ADDR_ALU)
-                m.d.comb += self.controls.writeRegister8.eq(op2)
-            with m.Case(Step.ADDR_ALU_ADD_HI):
-                m.d.pos += self.addrALUInput.eq(op1)
-                m.d.pos += self.addrALUInputByte.eq(1)
-                m.d.comb += self.controls.readRegister8.eq(Register8.ADDR_ALU)
-                m.d.comb += self.controls.writeRegister8.eq(op2)
-
+        m.submodules.entries = entries = self.entries.read_port(domain="comb")
+        m.submodules.rom = rom = self.rom.read_port(domain="comb")
+
+        m.d.comb += entries.addr.eq(self.klass)
+        m.d.comb += rom.addr.eq(entries.data + self.cycle_num)
+
+        word = rom.data
+        fields = []
+        shift = 0
+        for bits in [STEP_BITS, REG16_BITS, REG8_BITS, ARG_BITS, REG8_BITS,
+                     ARG_BITS]:
+            fields.append(word[shift:shift + bits])
+            shift += bits
+        step, reg16, a, a_sel, b, b_sel = fields
+
+        m.d.comb += [
+            self.step.eq(step),
+            self.reg16.eq(reg16),
+            self.a.eq(self._arg(a, a_sel, self.src, self.dst)),
+            self.b.eq(self._arg(b, b_sel, self.src, self.dst)),
+        ]
         return m
 
-class CopyReg(Object):
-    def __init__(self, src=None, dest=None):
-        self.src = src
-        self.dest = dest
+    @staticmethod
+    def _arg(reg8, sel, src, dst):
+        return Mux(sel == Arg.SRC_R, src, Mux(sel == Arg.DST_R, dst, reg8))
 
-    def elaborate(self, seq):
-        seq.m.d.comb += seq.controls.readRegister8.eq(self.src)
-        seq.m.d.comb += seq.controls.writeRegister8.eq(self.dest)
 
-class Halt(Object):
-    def __init__(self):
-        pass
-
-    def elaborate(self, seq):
-        seq.m.next = "HALT"
-
-class MemRd(Object):
-    def __init__(self, addr=None, dest=None):
-        self.addr = addr
-        self.dest = dest
-
-    def elaborate(self, seq):
-        seq.m.next = "RDMEM_T1"
-        seq.m.d.comb += seq.cycle.eq(MCycle.MEMRD)
-        seq.m.d.pos += seq.memrd_addr.eq(self.addr)
-        seq.m.d.pos += seq.memrd_dest.eq(self.dest)
-        seq.m.d.pos += seq.instr.en.eq(0)
-
-class MemWr(Object):
-    def __init__(self, addr=None, src=None):
-        self.addr = addr
-        self.src = src
-
-    def elaborate(self, seq):
-        seq.m.next = "WRMEM_T1"
-        seq.m.d.comb += seq.cycle.eq(MCycle.MEMWR)
-        seq.m.d.pos += seq.memwr_addr.eq(self.addr)
-        seq.m.d.pos += seq.memwr_src.eq(self.src)
-        seq.m.d.pos += seq.instr.en.eq(0)
+if __name__ == "__main__":
+    microsequencer = Microsequencer()
+
+    m = Module()
+    m.submodules.microsequencer = microsequencer
 
+    main(m, ports=microsequencer.ports())
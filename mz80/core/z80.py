@@ -1,10 +1,9 @@
 from nmigen import *
 from nmigen.asserts import *
 from nmigen.hdl.ast import *
-from nmigen.back import pysim
 
 from .sequencer import Sequencer
-from .arch import Registers
+from .arch import REGISTER_FILES, Registers
 from .alu import ALU
 from .incdec import IncDec
 from .mcycler import MCycler
@@ -14,8 +13,56 @@ from .ir import IR
 from ..z80fi.z80fi import *
 
 
+# The ways of forming the data bus from its drivers.
+DATA_BUSES = ("or", "mux")
+
+
 class Z80(Elaboratable):
-    def __init__(self, include_z80fi=False):
+    """The Z80 core.
+
+    data_bus chooses how the data bus is formed. With "or", every unit
+    decodes readRegister8 itself and drives 0 unless read, and the bus is
+    the OR of them all. With "mux", the units drive their outputs
+    ungated, and a mux picks one using the sequencer's one-hot
+    dataBusSource. data_bus_pipeline additionally registers that select on
+    the falling clock edge. The select only depends on state that changes
+    on the rising edge, so the bus is still right by the next rising edge,
+    when it is sampled. Only the first half of each T-state, when nothing
+    samples the bus, sees the previous select.
+
+    register_file chooses how Registers stores the two banks of WZ, BC, DE
+    and HL: "ff" for flip-flops, "memory" for a small RAM.
+
+    invariants asserts the invariants of the Sequencer and MCycler, for
+    induction proofs. They include the two running in step, which only
+    holds while no interrupt is taken.
+
+    include_z80fi is anything z80fi_parts() takes: True, a profile such as
+    "registers" or "bus" for a cheaper debug build, or the parts to record.
+    With none of them, no trace of z80fi is built, so the netlist is that
+    of a core that never had it (see flow/equiv.py).
+
+    opcodes slices the Sequencer down to the instructions matching a
+    pattern, see Sequencer. Only for formal harnesses that assume nothing
+    else is fetched.
+    """
+
+    def __init__(self, include_z80fi=False, microcoded=False,
+                 fsm_encoding="one-hot", data_bus="or",
+                 data_bus_pipeline=False, register_file="ff",
+                 invariants=False, opcodes=None):
+        if data_bus not in DATA_BUSES:
+            raise ValueError("Unknown data bus {!r}, expected one of {}"
+                             .format(data_bus, ", ".join(DATA_BUSES)))
+        if data_bus_pipeline and data_bus != "mux":
+            raise ValueError("data_bus_pipeline needs data_bus=\"mux\"")
+        if register_file not in REGISTER_FILES:
+            raise ValueError("Unknown register file {!r}, expected one of {}"
+                             .format(register_file,
+                                     ", ".join(REGISTER_FILES)))
+        self.data_bus = data_bus
+        self.data_bus_pipeline = data_bus_pipeline
+        self.register_file = register_file
         self.A = Signal(16)
         self.Din = Signal(8)
         self.Dout = Signal(8)
@@ -29,19 +76,28 @@ class Z80(Elaboratable):
         self.nBUSRQ = Signal()
         self.nBUSAK = Signal()
         self.nINTRQ = Signal()
+        self.nWAIT = Signal(reset=1)
 
-        self.include_z80fi = include_z80fi
+        self.z80fi_parts = z80fi_parts(include_z80fi)
+        self.include_z80fi = bool(self.z80fi_parts)
         if self.include_z80fi:
             self.z80fi = Z80fiInterface()
 
-        self.mcycler = MCycler()
-        self.sequencer = Sequencer(include_z80fi=self.include_z80fi)
+        self.invariants = invariants
+        self.mcycler = MCycler(fsm_encoding=fsm_encoding,
+                               gated=data_bus == "or",
+                               invariants=invariants)
+        self.sequencer = Sequencer(include_z80fi=self.z80fi_parts,
+                                   microcoded=microcoded,
+                                   fsm_encoding=fsm_encoding,
+                                   invariants=invariants,
+                                   opcodes=opcodes)
 
     def ports(self):
         return [
             self.A, self.Din, self.Dout, self.hiz, self.nM1, self.nMREQ,
             self.nIORQ, self.nRD, self.nWR, self.nBUSRQ, self.nBUSAK,
-            self.nINTRQ,
+            self.nINTRQ, self.nWAIT,
         ] + self.sequencer.ports() + self.mcycler.ports()
 
     def elaborate(self, platform):
@@ -50,14 +106,25 @@ class Z80(Elaboratable):
         # controls = SequencerControls()
 
         m = Module()
-        m.submodules.sequencer = self.sequencer
+        # The sequencer steps through the first T-state of a cycle without
+        # waiting for an act, so it has to be held while the bus is
+        # released. Otherwise it's a T-state ahead of the MCycler when the
+        # bus comes back.
+        m.submodules.sequencer = EnableInserter({
+            "pos": self.mcycler.mcycle != MCycle.BUSRELEASE
+        })(self.sequencer)
+        gated = self.data_bus == "or"
+        # Only the register snapshots need the registers brought out.
+        snapshots = "registers" in self.z80fi_parts
         m.submodules.registers = registers = Registers(
-            include_z80fi=self.include_z80fi)
+            include_z80fi=snapshots, gated=gated,
+            register_file=self.register_file)
         m.submodules.mcycler = self.mcycler
         m.submodules.incdec = incdec = IncDec(16)
-        m.submodules.alu = alu = ALU(include_z80fi=self.include_z80fi)
-        m.submodules.addrALU = addrALU = AddrALU()
-        m.submodules.ir = ir = IR()
+        m.submodules.alu = alu = ALU(include_z80fi=snapshots,
+                                     gated=gated)
+        m.submodules.addrALU = addrALU = AddrALU(gated=gated)
+        m.submodules.ir = ir = IR(gated=gated)
 
         mcycler = self.mcycler
         controls = self.sequencer.controls
@@ -66,6 +133,11 @@ class Z80(Elaboratable):
             self.sequencer.act.eq(mcycler.act),
             self.sequencer.dataBusIn.eq(dataBus),
         ]
+        if self.invariants:
+            m.d.comb += [
+                self.sequencer.mcycle.eq(mcycler.mcycle),
+                self.sequencer.tcycle.eq(mcycler.tcycle),
+            ]
 
         m.d.comb += [
             registers.input16.eq(incdec.busOut),
@@ -78,6 +150,7 @@ class Z80(Elaboratable):
             mcycler.cycle.eq(self.sequencer.cycle),
             mcycler.extend.eq(self.sequencer.extend),
             mcycler.busreq.eq(~self.nBUSRQ),
+            mcycler.buswait.eq(~self.nWAIT),
             mcycler.Din.eq(self.Din),
             mcycler.dataBusIn.eq(dataBus),
             mcycler.controls.eq(controls),
@@ -117,11 +190,30 @@ class Z80(Elaboratable):
         ]
 
         m.d.comb += addrBus.eq(registers.addrBusOut | ir.addrBusOut)
-        m.d.comb += dataBus.eq(registers.dataBusOut | alu.dataBusOut
-                               | addrALU.dataBusOut | mcycler.dataBusOut
-                               | ir.dataBusOut)
-
-        if self.include_z80fi:
+        if self.data_bus == "or":
+            m.d.comb += dataBus.eq(registers.dataBusOut | alu.dataBusOut
+                                   | addrALU.dataBusOut | mcycler.dataBusOut
+                                   | ir.dataBusOut)
+        else:
+            drivers = {
+                BusUnit.REGISTERS: registers.dataBusOut,
+                BusUnit.ALU: alu.dataBusOut,
+                BusUnit.ADDR_ALU: addrALU.dataBusOut,
+                BusUnit.MCYCLER: mcycler.dataBusOut,
+                BusUnit.IR: ir.dataBusOut,
+            }
+            select = self.sequencer.dataBusSource
+            if self.data_bus_pipeline:
+                select = Signal.like(select, name="dataBusSource_neg")
+                m.d.neg += select.eq(self.sequencer.dataBusSource)
+            with m.Switch(select):
+                for unit, driver in drivers.items():
+                    pattern = ["-"] * len(BusUnit)
+                    pattern[-1 - unit.value] = "1"
+                    with m.Case("".join(pattern)):
+                        m.d.comb += dataBus.eq(driver)
+
+        if snapshots:
             z80registers = Record(
                 RegRecordLayout(DIR_FANIN), name="z80_registers")
 
@@ -131,9 +223,16 @@ class Z80(Elaboratable):
             m.d.comb += self.sequencer.z80fi.registers.eq(z80registers)
             # z80registers -> self.z80fi.registers
             m.d.comb += self.z80fi.registers.eq(z80registers)
-            # sequencer.z80fi.control -> self.z80fi.control
-            m.d.comb += self.sequencer.z80fi.control.connect(
-                self.z80fi.control),
+
+        if self.include_z80fi:
+            # sequencer.z80fi.control -> self.z80fi.control, except while
+            # the bus is released, when the held sequencer would go on
+            # recording the T-state it's stuck in.
+            with m.If(self.mcycler.mcycle != MCycle.BUSRELEASE):
+                m.d.comb += self.sequencer.z80fi.control.connect(
+                    self.z80fi.control)
+
+        if "bus" in self.z80fi_parts:
             # self.z80fi.bus -> sequencer.z80fi.bus
             m.d.comb += self.z80fi.bus.connect(self.sequencer.z80fi.bus),
             m.d.comb += self.z80fi.bus.data.eq(dataBus),
@@ -143,64 +242,29 @@ class Z80(Elaboratable):
 
 
 if __name__ == "__main__":
-    m = Module()
-
-    clk = Signal()
-    rst = Signal()
-
-    pos = ClockDomain()
-    pos.clk = clk
-    pos.rst = rst
-
-    neg = ClockDomain(clk_edge="neg")
-    neg.clk = clk
-    neg.rst = rst
-
-    m.domains.pos = pos
-    m.domains.neg = neg
-
-    m.submodules.z80 = z80 = Z80(include_z80fi=True)
-    m.submodules.state = state = Z80fiInstrState()
-    z80state = Z80fiState()
-
-    m.d.comb += z80.z80fi.connect(state.iface)
-    m.d.comb += z80state.connect(state.data)
-
-    with m.If(~z80.nRD & ~z80.nMREQ):
-        with m.Switch(z80.A):
-            with m.Case(0):
-                m.d.comb += z80.Din.eq(0xDD)
-            with m.Case(1):
-                m.d.comb += z80.Din.eq(0x36)
-            with m.Case(2):
-                m.d.comb += z80.Din.eq(0x01)
-            with m.Case(3):
-                m.d.comb += z80.Din.eq(0x02)
-            with m.Default():
-                m.d.comb += z80.Din.eq(0x00)
-
-    m.d.comb += z80.nBUSRQ.eq(1)
-
-    with pysim.Simulator(
-            m,
-            vcd_file=open("z80.vcd", "w"),
-            gtkw_file=open("z80.gtkw", "w"),
-            traces=[
-                z80state.valid, z80state.instr, z80state.operands.num,
-                z80state.operands.data0, z80state.operands.data1,
-                z80state.useIX, z80state.useIY, z80.mcycler.mcycle,
-                z80.mcycler.tcycle, z80.mcycler.extend
-            ]) as sim:
-        sim.add_clock(1e-9, domain="pos")
-        sim.add_clock(1e-9, domain="neg")
-
-        # sim.add_clock(1e-9)
-
-        def process():
-            for i in range(0, 30):
-                yield Tick(domain="pos")
-                yield Tick(domain="neg")
-
-        # sim.add_sync_process(process(), domain="pos")
-        sim.add_process(process())
-        sim.run()
+    from ..sim.memory import Bus
+    from ..sim.pysim_z80 import PysimZ80
+    from ..sim.top import SimTop
+
+    top = SimTop(include_z80fi=True, split_clocks=True)
+    z80 = top.z80
+    z80state = top.z80fi
+
+    mem = bytearray(0x10000)
+    mem[0:4] = bytes([0xDD, 0x36, 0x01, 0x02])
+    bus = Bus(mem)
+
+    sim = PysimZ80(
+        top,
+        vcd_file=open("z80.vcd", "w"),
+        gtkw_file=open("z80.gtkw", "w"),
+        traces=[
+            z80state.valid, z80state.instr, z80state.operands.num,
+            z80state.operands.data0, z80state.operands.data1,
+            z80state.useIX, z80state.useIY, z80.mcycler.mcycle,
+            z80.mcycler.tcycle, z80.mcycler.extend
+        ])
+    for i in range(0, 60):
+        bus.serve(sim)
+        sim.edge()
+    sim.close()
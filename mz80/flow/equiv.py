@@ -0,0 +1,181 @@
+import argparse
+import collections
+import json
+import os
+import re
+import subprocess
+import sys
+
+from ..sim.cxxrtl import YOSYS
+from ..z80fi.z80fi import Z80FI_PROFILES
+from . import pool
+from .rtlil_cache import RTLILCache
+from .synth import module_rtlil, parse_option
+
+# Checks that an instrumented core, with its z80fi record left unconnected,
+# is the uninstrumented core: equivalent, register for register, and just
+# as many cells once both are optimized the same way. A profile that costs
+# cells has instrumentation leaking into the core's own logic.
+EQUIV_SCRIPT = """\
+read_ilang {gold}.il
+prep -flatten -top top
+memory_map
+opt
+tee -q -o {gold}.stat.json stat -json
+rename top gold
+design -stash gold
+read_ilang {gate}.il
+prep -flatten -top top
+memory_map
+opt
+tee -q -o {gate}.stat.json stat -json
+rename top gate
+design -stash gate
+design -copy-from gold -as gold gold
+design -copy-from gate -as gate gate
+equiv_make gold gate equiv
+hierarchy -top equiv
+async2sync
+equiv_simple -seq 5
+equiv_induct -seq 5
+equiv_status -assert
+"""
+
+EquivJob = collections.namedtuple(
+    "EquivJob", ["profile", "options", "workdir", "cache_dir"])
+
+# status is PASS if the profile is equivalent to the uninstrumented core
+# and no bigger, AREA if it's equivalent but bigger, FAIL if it isn't
+# equivalent, and ERROR if yosys didn't get that far.
+EquivResult = collections.namedtuple(
+    "EquivResult",
+    ["profile", "status", "gold_cells", "gate_cells", "unproven", "log"])
+
+
+def _cells(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["design"]["num_cells"]
+
+
+def _names(job):
+    """Returns the names of a job's uninstrumented and instrumented cores.
+    Jobs run at once, so each gets its own copy of the uninstrumented
+    core."""
+    return "Z80_{}_gold".format(job.profile), "Z80_{}".format(job.profile)
+
+
+def run_job(job):
+    """Checks one z80fi profile against the uninstrumented core."""
+    cache = None if job.cache_dir is None else RTLILCache(job.cache_dir)
+    gold, gate = _names(job)
+    builds = {
+        gold: dict(job.options, include_z80fi=False),
+        gate: dict(job.options,
+                   include_z80fi=job.profile,
+                   z80fi_ports=False),
+    }
+    for name, options in builds.items():
+        with open(os.path.join(job.workdir, name + ".il"), "w") as f:
+            f.write(module_rtlil("Z80", options, cache))
+
+    proc = subprocess.run([YOSYS, "-p",
+                           EQUIV_SCRIPT.format(gold=gold, gate=gate)],
+                          cwd=job.workdir,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+    log = os.path.join(job.workdir, gate + ".equiv.log")
+    with open(log, "w") as f:
+        f.write(proc.stdout)
+
+    gold_cells = _cells(os.path.join(job.workdir, gold + ".stat.json"))
+    gate_cells = _cells(os.path.join(job.workdir, gate + ".stat.json"))
+    # equiv_simple and equiv_induct report what's unproven as they go, so
+    # only equiv_status' count is the final one.
+    match = re.search(r"Of those cells \d+ are proven and (\d+) are "
+                      r"unproven", proc.stdout)
+    unproven = int(match.group(1)) if match is not None else None
+    if proc.returncode == 0:
+        status = "PASS" if gate_cells == gold_cells else "AREA"
+    elif unproven:
+        status = "FAIL"
+    else:
+        status = "ERROR"
+    return EquivResult(job.profile, status, gold_cells, gate_cells, unproven,
+                       log)
+
+
+def error_result(job, message):
+    """Returns the result of a job that raised, with message in its log."""
+    _, gate = _names(job)
+    return pool.error_result(EquivResult,
+                             os.path.join(job.workdir, gate + ".equiv.log"),
+                             message, profile=job.profile)
+
+
+def run_jobs(jobs, max_workers=None):
+    """Runs jobs on a process pool, yielding results as they complete. A
+    job that raises gives an ERROR result rather than ending the run."""
+    return pool.run_jobs(run_job, jobs, error_result, max_workers)
+
+
+def _fmt(value):
+    return "-" if value is None else value
+
+
+def summarize(results, out=sys.stdout):
+    """Prints a summary table. Returns True if every profile passed."""
+    results = sorted(results, key=lambda r: r.profile)
+    out.write("{:<10} {:<6} {:>6} {:>6} {:>8}\n".format(
+        "profile", "status", "gold", "gate", "unproven"))
+    for r in results:
+        out.write("{:<10} {:<6} {:>6} {:>6} {:>8}\n".format(
+            r.profile, r.status, _fmt(r.gold_cells), _fmt(r.gate_cells),
+            _fmt(r.unproven)))
+    failed = [r for r in results if r.status != "PASS"]
+    for r in failed:
+        out.write("  {}: see {}\n".format(r.profile, r.log))
+    return len(failed) == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that z80fi instrumentation costs the core "
+        "nothing when its record isn't used.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of profiles to check at once "
+                        "(default: %(default)s)")
+    parser.add_argument("--profile", action="append",
+                        choices=sorted(Z80FI_PROFILES),
+                        help="z80fi profile to check (default: all but "
+                        "off)")
+    parser.add_argument("--option", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="Z80 option to build both sides with, e.g. "
+                        "microcoded=True")
+    parser.add_argument("--workdir", default="equiv",
+                        help="directory for generated files "
+                        "(default: %(default)s)")
+    parser.add_argument("--cache-dir", default=RTLILCache().directory,
+                        help="RTLIL cache directory (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always elaborate from scratch")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    cache_dir = None if args.no_cache else args.cache_dir
+    options = dict(parse_option(option) for option in args.option)
+    profiles = args.profile or [p for p in Z80FI_PROFILES if p != "off"]
+
+    jobs = [
+        EquivJob(profile, options, args.workdir, cache_dir)
+        for profile in profiles
+    ]
+    results = []
+    for result in run_jobs(jobs, max_workers=args.jobs):
+        print("{}: {}".format(result.profile, result.status))
+        results.append(result)
+
+    sys.exit(0 if summarize(results) else 1)
@@ -0,0 +1,127 @@
+import inspect
+
+from nmigen import *
+from nmigen.hdl.ast import SignalSet
+from nmigen.hdl.rec import Record
+
+from ..core.addralu import AddrALU
+from ..core.alu import ALU
+from ..core.arch import Registers
+from ..core.decode import Decoder
+from ..core.incdec import IncDec
+from ..core.ir import IR
+from ..core.mcycler import MCycler
+from ..core.multicore import MultiZ80
+from ..core.sequencer import Sequencer
+from ..core.z80 import Z80
+
+# The core and its submodules, by name, as they are built inside Z80.
+MODULES = {
+    "Z80": Z80,
+    "Registers": Registers,
+    "Sequencer": Sequencer,
+    "Decoder": Decoder,
+    "MCycler": MCycler,
+    "ALU": ALU,
+    "AddrALU": AddrALU,
+    "IncDec": lambda: IncDec(16),
+    "IR": IR,
+}
+
+# Designs built out of several cores. They can be synthesized by name, like
+# MODULES, but aren't by default.
+TOPS = {
+    "MultiZ80": MultiZ80,
+}
+
+
+def module_ports(elaboratable):
+    """Returns the signals of an elaboratable's interface.
+
+    That's every Signal or Record held in an attribute, which is how the
+    core's modules declare their interfaces, plus anything in ports(). Some
+    ports() leave out the controls, which would let synthesis optimize the
+    whole module away.
+    """
+    ports = list(elaboratable.ports()) if hasattr(elaboratable,
+                                                  "ports") else []
+    for value in vars(elaboratable).values():
+        if isinstance(value, Record):
+            ports.extend(_record_signals(value))
+        elif isinstance(value, Signal):
+            ports.append(value)
+    return list(SignalSet(ports))
+
+
+def _record_signals(record):
+    for field in record.fields.values():
+        if isinstance(field, Record):
+            yield from _record_signals(field)
+        else:
+            yield field
+
+
+def _factory(name):
+    return MODULES[name] if name in MODULES else TOPS[name]
+
+
+def accepts(name, option):
+    """Returns whether a module in MODULES or TOPS takes an option. One
+    that passes any other keyword arguments on to Z80 takes what Z80
+    takes."""
+    factory = _factory(name)
+    if isinstance(factory, type):
+        factory = factory.__init__
+    parameters = inspect.signature(factory).parameters
+    if option in parameters:
+        return True
+    return (any(p.kind == p.VAR_KEYWORD for p in parameters.values())
+            and accepts("Z80", option))
+
+
+def cores(name, options):
+    """Returns how many Z80 cores a module in MODULES or TOPS has when built
+    with options, or None if it isn't made of whole cores."""
+    if name == "Z80":
+        return 1
+    if name not in TOPS:
+        return None
+    return options.get(
+        "cores", inspect.signature(TOPS[name]).parameters["cores"].default)
+
+
+def harness(name, z80fi_ports=True, **options):
+    """Returns (design, ports) for a module in MODULES or TOPS, with the pos
+    and neg clock domains of z80.py.
+
+    options are passed to the module's constructor, skipping any it doesn't
+    take, so that e.g. microcoded=True applies to Z80 and Sequencer alike.
+
+    Without z80fi_ports, the module's z80fi record, if it has one, is left
+    unconnected, as in a design that only uses the core's pins.
+    """
+    clk = Signal(name="clk")
+    rst = Signal(name="rst")
+
+    pos = ClockDomain("pos")
+    pos.clk = clk
+    pos.rst = rst
+
+    neg = ClockDomain("neg", clk_edge="neg")
+    neg.clk = clk
+    neg.rst = rst
+
+    dut = _factory(name)(**{
+        option: value
+        for option, value in options.items() if accepts(name, option)
+    })
+
+    m = Module()
+    m.domains.pos = pos
+    m.domains.neg = neg
+    m.submodules.dut = dut
+    ports = module_ports(dut)
+    if not z80fi_ports and hasattr(dut, "z80fi"):
+        unconnected = SignalSet(_record_signals(dut.z80fi))
+        ports = [port for port in ports if port not in unconnected]
+    return m, [clk, rst] + ports
@@ -0,0 +1,28 @@
+import concurrent.futures
+import traceback
+
+
+def error_result(result_class, log, message, **fields):
+    """Writes message to log, and returns a result_class, a namedtuple
+    with status and log fields, for a job that raised. Fields not given
+    are None."""
+    with open(log, "w") as f:
+        f.write(message)
+    values = dict.fromkeys(result_class._fields)
+    values.update(fields, status="ERROR", log=log)
+    return result_class(**values)
+
+
+def run_jobs(run_job, jobs, on_error, max_workers=None):
+    """Runs run_job(job) for every job on a process pool, yielding results
+    as they complete. A job that raises gives on_error(job, traceback)
+    rather than ending the run."""
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                result = on_error(futures[future], traceback.format_exc())
+            yield result
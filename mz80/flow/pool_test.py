@@ -0,0 +1,27 @@
+import collections
+import os
+
+from mz80.flow import pool
+
+Result = collections.namedtuple("Result", ["n", "status", "value", "log"])
+
+
+def _run(n):
+    if n == 2:
+        raise ValueError("job {} failed".format(n))
+    return Result(n, "PASS", n * n, None)
+
+
+def test_run_jobs(tmpdir):
+    def on_error(n, message):
+        return pool.error_result(Result,
+                                 os.path.join(str(tmpdir), "{}.log".format(n)),
+                                 message, n=n)
+
+    results = sorted(pool.run_jobs(_run, range(4), on_error, max_workers=2))
+    assert [r.status for r in results] == ["PASS", "PASS", "ERROR", "PASS"]
+    assert [r.value for r in results] == [0, 1, None, 9]
+    failed = results[2]
+    assert failed.log == os.path.join(str(tmpdir), "2.log")
+    with open(failed.log) as f:
+        assert "ValueError: job 2 failed" in f.read()
@@ -0,0 +1,84 @@
+import hashlib
+import os
+
+import nmigen
+from nmigen.back import rtlil
+
+# Packages whose sources go into every cache key. Anything the core
+# elaborates from lives here; specs and harnesses are added per entry.
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIRS = [
+    os.path.join(_ROOT, "core"),
+    os.path.join(_ROOT, "z80fi"),
+]
+
+CACHE_DIR = os.environ.get("MZ80_RTLIL_CACHE", ".rtlil_cache")
+
+
+def source_files(modules=()):
+    """Returns the source files that a cache key depends on.
+
+    That's every .py file in SOURCE_DIRS, plus the files of the given
+    modules.
+    """
+    files = []
+    for d in SOURCE_DIRS:
+        files.extend(
+            os.path.join(d, f) for f in sorted(os.listdir(d))
+            if f.endswith(".py"))
+    files.extend(os.path.abspath(module.__file__) for module in modules)
+    return files
+
+
+def cache_key(params, modules=()):
+    """Returns a hash of the relevant sources and the build parameters.
+
+    params is a dict of everything else that affects elaboration, e.g.
+    include_z80fi, the spec name and the platform.
+    """
+    h = hashlib.sha256()
+    h.update(nmigen.__version__.encode())
+    for path in source_files(modules):
+        h.update(os.path.relpath(path, _ROOT).encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+class RTLILCache(object):
+    """A content-addressed store of generated RTLIL.
+
+    Entries are never invalidated, only superseded: a change to any
+    relevant source or parameter gives a new key.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".il")
+
+    def get(self, params, build, modules=()):
+        """Returns the RTLIL for a design, elaborating it only on a miss.
+
+        build is called with no arguments on a miss, and must return the
+        design and its ports.
+        """
+        path = self.path(cache_key(params, modules))
+        if os.path.exists(path):
+            with open(path) as f:
+                return f.read()
+
+        design, ports = build()
+        text = rtlil.convert(
+            design, platform=params.get("platform"), ports=ports)
+
+        # Write to a temporary file first so that parallel runs never see
+        # a partial entry.
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+        return text
@@ -0,0 +1,348 @@
+import argparse
+import ast
+import collections
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from nmigen.back import rtlil
+
+from ..sim.bench import git_commit
+from ..sim.cxxrtl import YOSYS
+from . import pool
+from .modules import MODULES, TOPS, cores, harness
+from .rtlil_cache import RTLILCache
+
+# Per target: yosys synthesis command, nextpnr binary and arguments, the
+# cell types that count as flip-flops, LUTs, carry and RAM, and the LUTs
+# on the device that nextpnr is given.
+TARGETS = {
+    "ice40": {
+        "synth": "synth_ice40 -top top",
+        "nextpnr": "nextpnr-ice40",
+        "nextpnr_args": ["--hx8k", "--package", "ct256",
+                         "--pcf-allow-unconstrained", "--freq", "12"],
+        "ff": re.compile(r"SB_DFF"),
+        "lut": re.compile(r"SB_LUT4$"),
+        "carry": re.compile(r"SB_CARRY$"),
+        "ram": re.compile(r"SB_RAM"),
+        "device_luts": 7680,
+    },
+    "ecp5": {
+        "synth": "synth_ecp5 -top top",
+        "nextpnr": "nextpnr-ecp5",
+        "nextpnr_args": ["--25k", "--package", "CABGA381",
+                         "--out-of-context", "--freq", "25"],
+        "ff": re.compile(r"TRELLIS_FF$"),
+        "lut": re.compile(r"LUT4$"),
+        "carry": re.compile(r"CCU2C$"),
+        "ram": re.compile(r"DP16KD$|TRELLIS_DPR16X4$"),
+        "device_luts": 24288,
+    },
+}
+
+SynthJob = collections.namedtuple(
+    "SynthJob",
+    ["module", "target", "options", "workdir", "cache_dir", "pnr"])
+
+SynthResult = collections.namedtuple(
+    "SynthResult", [
+        "module", "target", "options", "status", "cells", "ffs", "luts",
+        "carries", "rams", "logic_depth", "fmax_mhz", "synth_time",
+        "pnr_time", "log"
+    ])
+
+
+def module_rtlil(module, options=None, cache=None):
+    """Returns the RTLIL for a module in MODULES or TOPS, built with
+    options, using the cache if given."""
+    options = options or {}
+    if cache is None:
+        design, ports = harness(module, **options)
+        return rtlil.convert(design, ports=ports)
+    params = {
+        "top": "synth_" + module,
+        "options": sorted(options.items()),
+        "platform": None,
+    }
+    return cache.get(params, lambda: harness(module, **options),
+                     [sys.modules[harness.__module__]])
+
+
+def cell_counts(stat, target):
+    """Sums yosys' stat -json cell counts into the categories of a
+    target."""
+    design = stat["design"]
+    by_type = design.get("num_cells_by_type", design.get("cells", {}))
+    counts = {"ff": 0, "lut": 0, "carry": 0, "ram": 0}
+    for cell, n in by_type.items():
+        for kind in counts:
+            if TARGETS[target][kind].match(cell):
+                counts[kind] += n
+    counts["cells"] = sum(
+        n for cell, n in by_type.items() if not cell.startswith("$"))
+    return counts
+
+
+def logic_depth(ltp_output):
+    """Extracts the longest topological path from yosys' ltp -noff. A
+    rough stand-in for Fmax when nextpnr isn't available."""
+    match = re.search(r"Longest topological path in \S+ \(length=(\d+)\)",
+                      ltp_output)
+    return int(match.group(1)) if match is not None else None
+
+
+def fmax(report):
+    """Returns the lowest achieved Fmax, in MHz, over all clocks in a
+    nextpnr --report file."""
+    achieved = [
+        clock["achieved"] for clock in report.get("fmax", {}).values()
+    ]
+    return min(achieved) if achieved else None
+
+
+def job_name(job):
+    """Returns the name a job's files are written under."""
+    return "{}_{}".format(job.module, job.target)
+
+
+def run_job(job):
+    """Synthesizes, and optionally places and routes, one module for one
+    target."""
+    target = TARGETS[job.target]
+    name = job_name(job)
+    prefix = os.path.join(job.workdir, name)
+
+    start = time.monotonic()
+    cache = None if job.cache_dir is None else RTLILCache(job.cache_dir)
+    with open(prefix + ".il", "w") as f:
+        f.write(module_rtlil(job.module, dict(job.options), cache))
+    log = prefix + ".log"
+    # yosys writes its own log, since the console output of some builds
+    # stops short when ABC runs. ROM inference is off because it turns FSM
+    # next-state switches into ROMs, which hides the FSMs from the fsm pass.
+    proc = subprocess.run([
+        YOSYS, "-q", "-l", name + ".log", "-p",
+        "read_rtlil {0}.il; proc -norom; {1}; "
+        "tee -q -o {0}.stat.json stat -json; "
+        "ltp -noff; write_json {0}.json".format(name, target["synth"])
+    ], cwd=job.workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    synth_time = time.monotonic() - start
+    if proc.returncode != 0:
+        return SynthResult(job.module, job.target, job.options, "ERROR", None,
+                           None, None, None, None, None, None, synth_time,
+                           0.0, log)
+
+    with open(prefix + ".stat.json") as f:
+        counts = cell_counts(json.load(f), job.target)
+    with open(log) as f:
+        depth = logic_depth(f.read())
+
+    status = "OK"
+    fmax_mhz = None
+    start = time.monotonic()
+    if job.pnr:
+        try:
+            pnr = subprocess.run(
+                [target["nextpnr"], "--json", name + ".json", "--report",
+                 name + ".report.json"] + target["nextpnr_args"],
+                cwd=job.workdir, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, universal_newlines=True)
+        except FileNotFoundError:
+            status = "NO_PNR"
+        else:
+            with open(log, "a") as f:
+                f.write(pnr.stdout)
+            if pnr.returncode != 0:
+                status = "PNR_ERROR"
+            else:
+                with open(prefix + ".report.json") as f:
+                    fmax_mhz = fmax(json.load(f))
+    pnr_time = time.monotonic() - start
+
+    return SynthResult(job.module, job.target, job.options, status,
+                       counts["cells"],
+                       counts["ff"], counts["lut"], counts["carry"],
+                       counts["ram"], depth, fmax_mhz, synth_time, pnr_time,
+                       log)
+
+
+def error_result(job, message):
+    """Returns the result of a job that raised, with message in its log."""
+    return pool.error_result(SynthResult,
+                             os.path.join(job.workdir, job_name(job) + ".log"),
+                             message, module=job.module, target=job.target,
+                             options=job.options, synth_time=0.0,
+                             pnr_time=0.0)
+
+
+def run_jobs(jobs, max_workers=None):
+    """Runs jobs on a process pool, yielding results as they complete. A
+    job that raises gives an ERROR result rather than ending the run."""
+    return pool.run_jobs(run_job, jobs, error_result, max_workers)
+
+
+def parse_option(text):
+    """Parses a NAME=VALUE option, where VALUE is a Python literal or else
+    a string."""
+    name, _, value = text.partition("=")
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def report(results, options=None):
+    """Returns the results as a JSON-able dict, keyed by target and
+    module."""
+    out = {"commit": git_commit(), "options": options or {}, "results": {}}
+    for r in results:
+        out["results"].setdefault(r.target, {})[r.module] = {
+            field: getattr(r, field)
+            for field in SynthResult._fields
+            if field not in ("module", "target", "options", "log")
+        }
+    return out
+
+
+def parse_sweep(text):
+    """Parses a NAME=VALUE,VALUE,... sweep into a list of option dicts."""
+    name, _, values = text.partition("=")
+    return [dict([parse_option("{}={}".format(name, value))])
+            for value in values.split(",")]
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def summarize(results, baseline=None, out=sys.stdout):
+    """Prints a table of results. With a baseline report, also prints the
+    change in cells, FFs and LUTs."""
+    results = sorted(results, key=lambda r: (r.target, r.module))
+    out.write("{:<6} {:<10} {:<9} {:>6} {:>6} {:>6} {:>6} {:>5} {:>8}\n"
+              .format("target", "module", "status", "cells", "ffs", "luts",
+                      "carry", "depth", "fmax"))
+    for r in results:
+        out.write(
+            "{:<6} {:<10} {:<9} {:>6} {:>6} {:>6} {:>6} {:>5} {:>8}".format(
+                r.target, r.module, r.status, _fmt(r.cells, "d"),
+                _fmt(r.ffs, "d"), _fmt(r.luts, "d"), _fmt(r.carries, "d"),
+                _fmt(r.logic_depth, "d"), _fmt(r.fmax_mhz, ".1f")))
+        base = (baseline or {}).get("results", {}).get(r.target, {}).get(
+            r.module)
+        if base is not None and r.cells is not None:
+            out.write("  ({:+d} cells, {:+d} ffs, {:+d} luts)".format(
+                r.cells - base["cells"], r.ffs - base["ffs"],
+                r.luts - base["luts"]))
+        out.write("\n")
+
+
+def summarize_fit(results, out=sys.stdout):
+    """Prints the LUTs per core of the results that are made of whole
+    cores, and about how many cores fit on the device at that rate."""
+    rows = []
+    for r in sorted(results, key=lambda r: (r.target, r.module)):
+        n = cores(r.module, dict(r.options))
+        if n is None or r.luts is None:
+            continue
+        per_core = r.luts / n
+        rows.append((r.target, r.module, n, per_core,
+                     int(TARGETS[r.target]["device_luts"] // per_core)))
+    if not rows:
+        return
+    out.write("{:<6} {:<10} {:>5} {:>9} {:>5}\n".format(
+        "target", "module", "cores", "luts/core", "fit"))
+    for row in rows:
+        out.write("{:<6} {:<10} {:>5d} {:>9.0f} {:>5d}\n".format(*row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Synthesize the core and its submodules, and report "
+        "resource use and Fmax.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of modules to synthesize at once "
+                        "(default: %(default)s)")
+    parser.add_argument("--target", action="append", choices=sorted(TARGETS),
+                        help="FPGA family (default: all)")
+    parser.add_argument("--module", action="append",
+                        choices=list(MODULES) + list(TOPS),
+                        help="module to synthesize (default: all in "
+                        "MODULES)")
+    parser.add_argument("--option", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="constructor option for the modules that take "
+                        "it, e.g. microcoded=True")
+    parser.add_argument("--sweep", metavar="NAME=VALUE,VALUE,...",
+                        help="synthesize once per value of an option, on "
+                        "top of any --option, and compare each against the "
+                        "first, e.g. fsm_encoding=binary,gray,one-hot")
+    parser.add_argument("--no-pnr", action="store_true",
+                        help="skip place and route, so no Fmax")
+    parser.add_argument("--workdir", default="synth",
+                        help="directory for generated files "
+                        "(default: %(default)s)")
+    parser.add_argument("--cache-dir", default=RTLILCache().directory,
+                        help="RTLIL cache directory (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always elaborate from scratch")
+    parser.add_argument("--output", "-o",
+                        help="JSON file to write the report to")
+    parser.add_argument("--compare",
+                        help="earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    cache_dir = None if args.no_cache else args.cache_dir
+    options = dict(parse_option(option) for option in args.option)
+    sweep = parse_sweep(args.sweep) if args.sweep else [{}]
+
+    # Each point of the sweep gets its own directory, so that their files
+    # don't overwrite each other.
+    points = []
+    jobs = []
+    for extra in sweep:
+        point = tuple(sorted(dict(options, **extra).items()))
+        workdir = os.path.join(
+            args.workdir,
+            *["{}={}".format(name, value) for name, value in extra.items()])
+        os.makedirs(workdir, exist_ok=True)
+        points.append(point)
+        jobs.extend(
+            SynthJob(module, target, point, workdir, cache_dir,
+                     not args.no_pnr)
+            for target in args.target or sorted(TARGETS)
+            for module in args.module or list(MODULES))
+
+    results = collections.defaultdict(list)
+    for result in run_jobs(jobs, max_workers=args.jobs):
+        print("{} {}: {}".format(result.module, result.target, result.status))
+        results[result.options].append(result)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    reports = []
+    for point in points:
+        if args.sweep:
+            print("\n" + ", ".join(
+                "{}={}".format(name, value) for name, value in point))
+        summarize(results[point], baseline)
+        summarize_fit(results[point])
+        reports.append(report(results[point], dict(point)))
+        # The rest of a sweep is compared against its first point.
+        if args.sweep and not args.compare:
+            baseline = reports[0]
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports if args.sweep else reports[0], f, indent=2,
+                      sort_keys=True)
+            f.write("\n")
+    sys.exit(0 if all(r.status != "ERROR" for point in points
+                      for r in results[point]) else 1)
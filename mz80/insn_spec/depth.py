@@ -0,0 +1,68 @@
+from nmigen import *
+
+from .formal_test import RESET_TSTATES, spec_class
+from .simulate import SpecSimulator
+
+# The T-states before the first instruction's M1: reset, then one in the
+# sequencer's RESET state.
+LEAD_IN = RESET_TSTATES + 1
+
+# An indexed instruction's DD or FD prefix is an M1 cycle of its own, which
+# the spec's mcycles don't count.
+PREFIX_TSTATES = 4
+
+# After the instruction, the next M1_T1 sets valid, and the snapshot shows
+# it a T-state later. The checks need one more step to see it on.
+LEAD_OUT = 2
+
+# (useIX, useIY) for the plain, DD and FD forms of every opcode.
+INDEXING = [(0, 0), (1, 0), (0, 1)]
+
+
+def spec_tstates(insn):
+    """Returns the T-states the named spec expects of every instruction it
+    is valid for, as {(instr, useIX, useIY): tstates}.
+
+    The spec is simulated on its own for every opcode, with the rest of the
+    actual state zero. So a spec whose cycle counts depend on more than
+    the opcode, such as the flags of a conditional jump, is only sized for
+    the cycles it takes with them zero.
+    """
+    sim = SpecSimulator(spec_class(insn)())
+    actual, spec = sim.actual, sim.test.spec
+    keys = [(instr, useIX, useIY)
+            for useIX, useIY in INDEXING for instr in range(256)]
+    states = [[(actual.valid, 1), (actual.instr, instr),
+               (actual.useIX, useIX), (actual.useIY, useIY)]
+              for instr, useIX, useIY in keys]
+    outputs = [spec.valid, spec.mcycles.num] + [
+        spec.mcycles["tcycles{}".format(i)]
+        for i in range(1, spec.depths["mcycles"] + 1)
+    ]
+    tstates = {}
+    for key, (valid, num, *tcycles) in zip(keys, sim.run(states, outputs)):
+        if valid:
+            tstates[key] = sum(tcycles[:num])
+    return tstates
+
+
+def longest_tstates(insn):
+    """Returns the T-states of the named spec's longest instruction,
+    prefix included."""
+    return max(
+        tstates + (PREFIX_TSTATES if useIX or useIY else 0)
+        for (_, useIX, useIY), tstates in spec_tstates(insn).items())
+
+
+def min_depth(insn):
+    """Returns the smallest BMC depth at which the named spec's longest
+    instruction, prefix included, retires after reset and is checked."""
+    return LEAD_IN + longest_tstates(insn) + LEAD_OUT
+
+
+def induction_depth(insn):
+    """Returns the k for proving the named spec by k-induction: enough to
+    see its longest instruction run from its first fetch until it's
+    checked. No reset to get through first."""
+    return longest_tstates(insn) + LEAD_OUT
+
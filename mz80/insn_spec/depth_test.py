@@ -0,0 +1,30 @@
+from mz80.insn_spec.depth import (LEAD_IN, LEAD_OUT, PREFIX_TSTATES,
+                                  induction_depth, min_depth, spec_tstates)
+from mz80.insn_spec.formal_sweep import job_depth
+
+
+def test_ld_reg_n_tstates():
+    tstates = spec_tstates("ld_reg_n")
+    assert len(tstates) == 8 * 3
+    assert tstates[(0x06, 0, 0)] == 7  # LD B, n
+    assert tstates[(0x36, 0, 0)] == 10  # LD (HL), n
+    assert tstates[(0x36, 1, 0)] == 15  # LD (IX+d), n
+    assert tstates[(0x36, 0, 1)] == 15  # LD (IY+d), n
+
+
+def test_ld_reg_reg_tstates():
+    tstates = spec_tstates("ld_reg_reg")
+    assert len(tstates) == 64 * 3
+    assert tstates[(0x41, 0, 0)] == 4  # LD B, C
+    assert tstates[(0x46, 0, 0)] == 7  # LD B, (HL)
+    assert tstates[(0x70, 0, 1)] == 15  # LD (IY+d), B
+    assert tstates[(0x76, 0, 0)] == 8  # HALT
+
+
+def test_depths():
+    longest = 15 + PREFIX_TSTATES
+    for insn in ("ld_reg_n", "ld_reg_reg"):
+        assert min_depth(insn) == LEAD_IN + longest + LEAD_OUT
+        assert induction_depth(insn) == longest + LEAD_OUT
+        assert job_depth(insn, "bmc") == min_depth(insn)
+        assert job_depth(insn, "prove") == induction_depth(insn)
@@ -0,0 +1,349 @@
+import argparse
+import collections
+import importlib
+import json
+import os
+import pkgutil
+import re
+import subprocess
+import sys
+import time
+
+from nmigen import *
+
+from ..flow import pool
+from ..flow.rtlil_cache import RTLILCache
+from ..sim.cxxrtl import YOSYS
+from .depth import induction_depth, min_depth
+from .formal_test import formal_rtlil
+from .incremental import IncrementalBMC, smt2_model
+
+SBY = os.environ.get("SBY", "sby")
+
+# Fixed depths, as used by bmc.sby and cover.sby. Sweeps size bmc and
+# cover to each spec with min_depth(), and prove with induction_depth(),
+# unless asked not to. For incremental, the depth to give up at if the
+# Covers still haven't all been hit.
+DEPTHS = {
+    "bmc": 31,
+    "cover": 61,
+    "incremental": 61,
+    "prove": 20,
+}
+
+# The modes run unless asked otherwise. incremental proves what bmc and
+# cover do together, so it's an alternative to them.
+DEFAULT_MODES = ["bmc", "cover"]
+
+ENGINES = ["smtbmc boolector"]
+
+# The engines raced against each other with --portfolio. sby runs every
+# engine of a job at once and goes with the first conclusive answer. Only
+# smtbmc can cover.
+PORTFOLIOS = {
+    "bmc": [
+        "smtbmc boolector", "smtbmc yices", "smtbmc z3", "abc bmc3"
+    ],
+    "cover": ["smtbmc boolector", "smtbmc yices", "smtbmc z3"],
+    "incremental": ENGINES,
+    "prove": ["smtbmc boolector", "smtbmc yices", "abc pdr"],
+}
+
+# sliced builds the core with only the spec's instructions, see formal_top().
+FormalJob = collections.namedtuple("FormalJob", [
+    "insn", "mode", "depth", "engines", "workdir", "cache_dir", "sliced"
+])
+
+# depth is how deep the proof went: the job's depth, except for
+# incremental, which stops as soon as it can. engine is the engine whose
+# answer was taken, or None if none answered.
+FormalResult = collections.namedtuple("FormalResult", [
+    "insn", "mode", "status", "depth", "engine", "elab_time", "solve_time",
+    "log"
+])
+
+
+def discover_specs():
+    """Returns the names of all instruction specs in mz80.insn_spec.
+
+    A spec is a module containing an Elaboratable class with the same name
+    as the module, e.g. mz80.insn_spec.ld_reg_n.ld_reg_n.
+    """
+    package = importlib.import_module("mz80.insn_spec")
+    specs = []
+    for info in pkgutil.iter_modules(package.__path__):
+        module = importlib.import_module(
+            "." + info.name, package="mz80.insn_spec")
+        klass = getattr(module, info.name, None)
+        if isinstance(klass, type) and issubclass(klass, Elaboratable):
+            specs.append(info.name)
+    return sorted(specs)
+
+
+def sby_config(name, mode, depth, engines=ENGINES):
+    """Returns the contents of an .sby file proving name.il."""
+    return "\n".join([
+        "[options]",
+        "mode {}".format(mode),
+        "depth {}".format(depth),
+        "multiclock off",
+        "",
+        "[engines]",
+    ] + list(engines) + [
+        "",
+        "[script]",
+        "read_ilang {}.il".format(name),
+        "prep -top top",
+        # A memory's init only holds in the first step, so induction could
+        # start from any table contents. As logic, the ROMs are constant.
+        "memory_map",
+        "",
+        "[files]",
+        "{}.il".format(name),
+        "",
+    ])
+
+
+def job_name(job):
+    """Returns the name a job's files are written under."""
+    name = "{}_{}".format(job.insn, job.mode)
+    if job.sliced:
+        name += "_sliced"
+    return name
+
+
+def generate(job):
+    """Writes the RTLIL and .sby files for a job. Returns the job name.
+
+    incremental doesn't go through sby, so it only gets the RTLIL.
+    """
+    name = job_name(job)
+    cache = None if job.cache_dir is None else RTLILCache(job.cache_dir)
+    il = formal_rtlil(job.insn,
+                      cover=job.mode in ("cover", "incremental"),
+                      cache=cache,
+                      prove=job.mode == "prove",
+                      sliced=job.sliced)
+    with open(os.path.join(job.workdir, name + ".il"), "w") as f:
+        f.write(il)
+    if job.mode != "incremental":
+        with open(os.path.join(job.workdir, name + ".sby"), "w") as f:
+            f.write(sby_config(name, job.mode, job.depth, job.engines))
+    return name
+
+
+def sby_status(returncode, output):
+    """Extracts the final status (PASS, FAIL, ...) from sby's output."""
+    match = re.search(r"DONE \((\w+), rc=\d+\)", output)
+    if match is not None:
+        return match.group(1)
+    return "PASS" if returncode == 0 else "ERROR"
+
+
+def sby_engine(engines, output):
+    """Extracts the engine whose answer sby went with from its output."""
+    match = re.search(r"summary: engine_(\d+) \(.*\) returned (pass|fail)",
+                      output, re.IGNORECASE)
+    if match is None:
+        return None
+    return engines[int(match.group(1))]
+
+
+def job_depth(insn, mode, fixed=False):
+    """Returns the depth to run a spec at in a mode: just deep enough for
+    its longest instruction, or the one in DEPTHS if fixed.
+
+    A cover run at that depth fails if some variant can't retire in time,
+    so running cover alongside bmc also checks the sizing.
+    """
+    if fixed or mode == "incremental":
+        return DEPTHS[mode]
+    if mode == "prove":
+        return induction_depth(insn)
+    return min_depth(insn)
+
+
+def run_incremental(job):
+    """Proves a single spec with IncrementalBMC, only as deep as its
+    Covers need."""
+    start = time.monotonic()
+    name = generate(job)
+    smt2_model(job.workdir, name)
+    elab_time = time.monotonic() - start
+
+    start = time.monotonic()
+    # The solver is that of the first of sby's smtbmc engines, e.g.
+    # "smtbmc boolector". A single solver is kept alive, so there is no
+    # racing several of them.
+    smtbmc = [e for e in job.engines if e.split()[0] == "smtbmc"]
+    if not smtbmc:
+        raise ValueError("incremental needs an smtbmc engine")
+    engine = smtbmc[0]
+    solver = engine.split()[-1]
+    lines = []
+    bmc = IncrementalBMC(os.path.join(job.workdir, name + ".smt2"), solver)
+    try:
+        status, depth = bmc.run(job.depth, log=lines.append)
+    finally:
+        bmc.close()
+    solve_time = time.monotonic() - start
+    if status == "FAIL":
+        lines.append("assertion failed at step {}".format(depth))
+
+    log = os.path.join(job.workdir, name + ".log")
+    with open(log, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    return FormalResult(job.insn, job.mode, status, depth, engine,
+                        elab_time, solve_time, log)
+
+
+def run_job(job):
+    """Elaborates and proves a single spec in a single mode."""
+    if job.mode == "incremental":
+        return run_incremental(job)
+
+    start = time.monotonic()
+    name = generate(job)
+    elab_time = time.monotonic() - start
+
+    start = time.monotonic()
+    proc = subprocess.run([SBY, "-f", name + ".sby"],
+                          cwd=job.workdir,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+    solve_time = time.monotonic() - start
+
+    log = os.path.join(job.workdir, name + ".log")
+    with open(log, "w") as f:
+        f.write(proc.stdout)
+
+    return FormalResult(job.insn, job.mode,
+                        sby_status(proc.returncode, proc.stdout), job.depth,
+                        sby_engine(job.engines, proc.stdout), elab_time,
+                        solve_time, log)
+
+
+def error_result(job, message):
+    """Returns the result of a job that raised, with message in its log."""
+    return pool.error_result(FormalResult,
+                             os.path.join(job.workdir, job_name(job) + ".log"),
+                             message, insn=job.insn, mode=job.mode,
+                             depth=job.depth, elab_time=0.0, solve_time=0.0)
+
+
+def run_jobs(jobs, max_workers=None):
+    """Runs jobs on a process pool, yielding results as they complete. A
+    job that raises gives an ERROR result rather than ending the sweep."""
+    return pool.run_jobs(run_job, jobs, error_result, max_workers)
+
+
+def formal_cells(workdir, name):
+    """Returns how many cells name.il in workdir comes to once prepared and
+    flattened, as the solvers see it."""
+    subprocess.run([
+        YOSYS, "-q", "-p",
+        "read_ilang {0}.il; prep -flatten -top top; memory_map; "
+        "tee -q -o {0}.stat.json stat -json".format(name)
+    ], cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(workdir, name + ".stat.json")) as f:
+        return json.load(f)["design"]["num_cells"]
+
+
+def slice_report(insns, workdir, cache_dir=None, out=sys.stdout):
+    """Prints the cells in each spec's bmc harness, with the whole core and
+    sliced down to the spec's instructions."""
+    cache = None if cache_dir is None else RTLILCache(cache_dir)
+    out.write("{:<16} {:>8} {:>8} {:>7}\n".format("insn", "full", "sliced",
+                                                  "saved"))
+    for insn in insns:
+        cells = []
+        for sliced in (False, True):
+            name = "{}_cells{}".format(insn, "_sliced" if sliced else "")
+            il = formal_rtlil(insn, cache=cache, sliced=sliced)
+            with open(os.path.join(workdir, name + ".il"), "w") as f:
+                f.write(il)
+            cells.append(formal_cells(workdir, name))
+        full, sliced = cells
+        out.write("{:<16} {:>8} {:>8} {:>6.1f}%\n".format(
+            insn, full, sliced, 100 * (full - sliced) / full))
+
+
+def summarize(results, out=sys.stdout):
+    """Prints a summary table. Returns True if everything passed."""
+    results = sorted(results, key=lambda r: (r.insn, r.mode))
+    out.write("{:<16} {:<11} {:<9} {:>5} {:<18} {:>8} {:>8}\n".format(
+        "insn", "mode", "status", "depth", "engine", "elab(s)", "solve(s)"))
+    for r in results:
+        out.write(
+            "{:<16} {:<11} {:<9} {:>5} {:<18} {:>8.1f} {:>8.1f}\n".format(
+                r.insn, r.mode, r.status, r.depth, r.engine or "-",
+                r.elab_time, r.solve_time))
+    failed = [r for r in results if r.status != "PASS"]
+    out.write("{} passed, {} failed\n".format(
+        len(results) - len(failed), len(failed)))
+    for r in failed:
+        out.write("  {} {}: see {}\n".format(r.insn, r.mode, r.log))
+    return len(failed) == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run every instruction spec through SymbiYosys.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of proofs to run at once "
+                        "(default: %(default)s)")
+    parser.add_argument("--mode", action="append", choices=sorted(DEPTHS),
+                        help="proof mode to run (default: {})".format(
+                            ", ".join(DEFAULT_MODES)))
+    parser.add_argument("--insn", action="append",
+                        help="spec to run (default: all)")
+    parser.add_argument("--workdir", default="formal_sweep",
+                        help="directory for generated files "
+                        "(default: %(default)s)")
+    parser.add_argument("--cache-dir", default=RTLILCache().directory,
+                        help="RTLIL cache directory (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always elaborate from scratch")
+    parser.add_argument("--engine", action="append",
+                        help="sby engine line to run, e.g. \"smtbmc "
+                        "yices\"; several are raced (default: {})".format(
+                            ", ".join(ENGINES)))
+    parser.add_argument("--portfolio", action="store_true",
+                        help="race the engines in PORTFOLIOS for each mode; "
+                        "each job then takes a core per engine")
+    parser.add_argument("--fixed-depths", action="store_true",
+                        help="run at the depths in DEPTHS rather than "
+                        "sizing them per spec")
+    parser.add_argument("--slice", action="store_true",
+                        help="build the core with only each spec's "
+                        "instructions, and report the cells saved")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    insns = args.insn or discover_specs()
+    modes = args.mode or DEFAULT_MODES
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    def engines(mode):
+        if args.engine:
+            return args.engine
+        return PORTFOLIOS[mode] if args.portfolio else ENGINES
+
+    if args.slice:
+        slice_report(insns, args.workdir, cache_dir)
+
+    jobs = [
+        FormalJob(insn, mode, job_depth(insn, mode, args.fixed_depths),
+                  engines(mode), args.workdir, cache_dir, args.slice)
+        for insn in insns for mode in modes
+    ]
+
+    results = []
+    for result in run_jobs(jobs, max_workers=args.jobs):
+        print("{} {}: {} ({})".format(result.insn, result.mode,
+                                      result.status, result.engine))
+        results.append(result)
+
+    sys.exit(0 if summarize(results) else 1)
@@ -1,135 +1,213 @@
 import importlib
+import sys
 
 from nmigen import *
+from nmigen.back import rtlil
 from nmigen.cli import main_parser, main_runner
 from nmigen.asserts import *
+from ..core.decode import InstrClass
 from ..core.z80 import Z80
+from ..flow.rtlil_cache import RTLILCache
 from ..z80fi.z80fi import *
 
 
-if __name__ == "__main__":
-    parser = main_parser()
-    parser.add_argument("--cover", action="store_true")
-    parser.add_argument("--bmc", action="store_true")
-    parser.add_argument("--insn")
-    args = parser.parse_args()
-
+# How many T-states reset is held for at the start of a proof.
+RESET_TSTATES = 4
+
+
+def spec_class(insn):
+    """Returns the spec class for the named instruction spec.
+
+    Specs live in a module of the same name under mz80.insn_spec, e.g.
+    mz80.insn_spec.ld_reg_n.ld_reg_n.
+    """
+    insn_spec = importlib.import_module("." + insn, package="mz80.insn_spec")
+    return getattr(insn_spec, insn)
+
+
+# The registers whose regs_out the harness checks, in order.
+CHECKED_REGS = [
+    "A1", "A2", "F1", "F2", "B1", "B2", "C1", "C2", "D1", "D2", "E1", "E2",
+    "H1", "H2", "L1", "L2", "IX", "IY", "SP", "PC"
+]
+
+
+def spec_checks(spec, actual, cycles=False):
+    """Returns what has to hold whenever spec.valid, as a list of (name,
+    guard, check). check only has to hold while guard does, if guard isn't
+    None.
+
+    With cycles, the type and length of each M-cycle and every memory
+    write are checked too, rather than just how many there are. As many of
+    them are checked as spec holds.
+    """
+    checks = [("regs_out." + name, None,
+               spec.regs_out[name] == actual.regs_out[name])
+              for name in CHECKED_REGS]
+    checks += [
+        ("mcycles.num", None, spec.mcycles.num == actual.mcycles.num),
+        ("memwrs.num", None, spec.memwrs.num == actual.memwrs.num),
+    ]
+    if not cycles:
+        return checks
+
+    for i in range(1, spec.depths["mcycles"] + 1):
+        guard = spec.mcycles.num >= i
+        for field in ("tcycles", "type"):
+            name = "{}{}".format(field, i)
+            checks.append(("mcycles." + name, guard,
+                           spec.mcycles[name] == actual.mcycles[name]))
+    for i in range(spec.depths["memwrs"]):
+        guard = spec.memwrs.num >= i + 1
+        for field in ("addr", "data"):
+            name = "{}{}".format(field, i)
+            checks.append(("memwrs." + name, guard,
+                           spec.memwrs[name] == actual.memwrs[name]))
+    return checks
+
+
+def formal_top(insn, cover=False, prove=False, sliced=False):
+    """Builds the top-level formal harness for the named instruction spec.
+
+    With prove, the harness is for k-induction: the core asserts its
+    invariants, and so does the harness, so that the induction step only
+    starts from states that could have been reached.
+
+    With sliced, only the spec's OPCODES (and the DD/FD prefixes) are ever
+    fetched, and the core is built without the rest of the instructions.
+    Yosys doesn't optimize on assumptions, so the slicing is done when the
+    core is elaborated, and the assumption keeps the proof honest about it.
+
+    Returns the module and the ports to pass to the backend.
+    """
     clk = Signal()
     rst = Signal()
 
-    pos = ClockDomain()
+    pos = ClockDomain("pos")
     pos.clk = clk
     pos.rst = rst
 
-    neg = ClockDomain(clk_edge="neg")
+    neg = ClockDomain("neg", clk_edge="neg")
     neg.clk = clk
     neg.rst = rst
 
     m = Module()
     m.domains.pos = pos
     m.domains.neg = neg
-    m.submodules.z80 = z80 = Z80(include_z80fi=True)
-    m.submodules.state = state = Z80fiInstrState()
-
-    assert args.insn is not None, "No --insn specified"
+    opcodes = spec_class(insn).OPCODES if sliced else None
+    m.submodules.z80 = z80 = Z80(include_z80fi=True, invariants=prove,
+                                 opcodes=opcodes)
+    m.submodules.test = test = spec_class(insn)()
 
-    insn_spec = importlib.import_module("." + args.insn, package="mz80.insn_spec")
-    klass = getattr(insn_spec, args.insn)
+    # Only as much z80fi state is recorded as the spec needs.
+    depths = test.actual.depths
+    m.submodules.state = state = Z80fiInstrState(depths)
 
-    m.submodules.test = test = klass()
+    actual = Z80fiState(depths=depths)
+    spec = Z80fiState(depths=depths)
+    count = Signal.range(0, RESET_TSTATES + 1, reset_less=True)
 
-    actual = Z80fiState()
-    spec = Z80fiState()
-    count = Signal.range(0, 61, reset_less=True)
-
-    with m.If(count < 60):
+    with m.If(count < RESET_TSTATES):
         m.d.pos += count.eq(count + 1)
 
     m.d.comb += Assume(z80.nBUSRQ == 1)
     m.d.comb += Assume(z80.nINTRQ == 1)
-    m.d.comb += Assume(ResetSignal("pos") == (count < 4))
+    # Z80 doesn't drive the MCycler's intreq, which leaves it free.
+    m.d.comb += Assume(~z80.mcycler.intreq)
+    m.d.comb += Assume(z80.nWAIT == 1)
+    m.d.comb += Assume(ResetSignal("pos") == (count < RESET_TSTATES))
+
+    if sliced:
+        control = z80.z80fi.control
+        with m.If(control.save_instruction):
+            m.d.comb += Assume(
+                control.instr.matches(opcodes) | (control.instr == 0xDD) |
+                (control.instr == 0xFD))
+
+    if prove:
+        # An opcode the core doesn't implement leaves the sequencer in
+        # M1_T4 for good, out of step with the MCycler, so the invariants
+        # only hold while every opcode fetched is implemented.
+        with m.If(z80.z80fi.control.save_instruction):
+            m.d.comb += Assume(
+                z80.sequencer.decoder.decoded.klass != InstrClass.NONE)
+        # The MCycler registers the inputs assumed idle above. They reset
+        # idle too, so they're never anything else.
+        m.d.comb += [
+            Assert(~z80.mcycler.busrequested),
+            Assert(~z80.mcycler.intrequested),
+            Assert(~z80.mcycler.waitstated),
+        ]
 
     m.d.comb += z80.z80fi.connect(state.iface)
     m.d.comb += actual.connect(state.data)
     m.d.comb += test.actual.connect(state.data)
     m.d.comb += spec.connect(test.spec)
 
-    if args.cover:
+    if cover:
         m.d.comb += test.coverage(m)
-    # m.d.comb += Cover((count == 59) & spec.valid)
     with m.If(spec.valid):
-        m.d.comb += [
-            Assert(spec.regs_out.A1 == actual.regs_out.A1),
-            Assert(spec.regs_out.A2 == actual.regs_out.A2),
-            Assert(spec.regs_out.F1 == actual.regs_out.F1),
-            Assert(spec.regs_out.F2 == actual.regs_out.F2),
-            Assert(spec.regs_out.B1 == actual.regs_out.B1),
-            Assert(spec.regs_out.B2 == actual.regs_out.B2),
-            Assert(spec.regs_out.C1 == actual.regs_out.C1),
-            Assert(spec.regs_out.C2 == actual.regs_out.C2),
-            Assert(spec.regs_out.D1 == actual.regs_out.D1),
-            Assert(spec.regs_out.D2 == actual.regs_out.D2),
-            Assert(spec.regs_out.E1 == actual.regs_out.E1),
-            Assert(spec.regs_out.E2 == actual.regs_out.E2),
-            Assert(spec.regs_out.H1 == actual.regs_out.H1),
-            Assert(spec.regs_out.H2 == actual.regs_out.H2),
-            Assert(spec.regs_out.L1 == actual.regs_out.L1),
-            Assert(spec.regs_out.L2 == actual.regs_out.L2),
-            Assert(spec.regs_out.IX == actual.regs_out.IX),
-            Assert(spec.regs_out.IY == actual.regs_out.IY),
-            Assert(spec.regs_out.SP == actual.regs_out.SP),
-            Assert(spec.regs_out.PC == actual.regs_out.PC),
-            Assert(spec.mcycles.num == actual.mcycles.num),
-            Assert(spec.memwrs.num == actual.memwrs.num),
-        ]
+        for _, guard, check in spec_checks(spec, actual, cycles=cover):
+            if guard is None:
+                m.d.comb += Assert(check)
+            else:
+                with m.If(guard):
+                    m.d.comb += Assert(check)
+
+    return m, [clk, rst] + z80.ports()
+
+
+def formal_rtlil(insn, cover=False, cache=None, prove=False, sliced=False):
+    """Returns the RTLIL for the formal harness of the named spec.
+
+    If an RTLILCache is given, elaboration is skipped when neither the core,
+    the harness, the spec nor the parameters changed since the last run.
+    """
+    if cache is None:
+        m, ports = formal_top(insn, cover=cover, prove=prove, sliced=sliced)
+        return rtlil.convert(m, ports=ports)
+
+    params = {
+        "top": "formal_test",
+        "insn": insn,
+        "cover": cover,
+        "prove": prove,
+        "sliced": sliced,
+        "include_z80fi": True,
+        "platform": None,
+    }
+    modules = [
+        sys.modules[__name__],
+        importlib.import_module("." + insn, package="mz80.insn_spec"),
+    ]
+    return cache.get(
+        params,
+        lambda: formal_top(insn, cover=cover, prove=prove, sliced=sliced),
+        modules)
+
+
+if __name__ == "__main__":
+    parser = main_parser()
+    parser.add_argument("--cover", action="store_true")
+    parser.add_argument("--bmc", action="store_true")
+    parser.add_argument("--prove", action="store_true")
+    parser.add_argument("--slice", action="store_true")
+    parser.add_argument("--insn")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    assert args.insn is not None, "No --insn specified"
 
-        if args.cover:
-            with m.If(spec.mcycles.num >= 1):
-                m.d.comb += [
-                    Assert(spec.mcycles.tcycles1 == actual.mcycles.tcycles1),
-                    Assert(spec.mcycles.type1 == actual.mcycles.type1),
-                ]
-            with m.If(spec.mcycles.num >= 2):
-                m.d.comb += [
-                    Assert(spec.mcycles.tcycles2 == actual.mcycles.tcycles2),
-                    Assert(spec.mcycles.type2 == actual.mcycles.type2),
-                ]
-            with m.If(spec.mcycles.num >= 3):
-                m.d.comb += [
-                    Assert(spec.mcycles.tcycles3 == actual.mcycles.tcycles3),
-                    Assert(spec.mcycles.type3 == actual.mcycles.type3),
-                ]
-            with m.If(spec.mcycles.num >= 4):
-                m.d.comb += [
-                    Assert(spec.mcycles.tcycles4 == actual.mcycles.tcycles4),
-                    Assert(spec.mcycles.type4 == actual.mcycles.type4),
-                ]
-            with m.If(spec.mcycles.num >= 5):
-                m.d.comb += [
-                    Assert(spec.mcycles.tcycles5 == actual.mcycles.tcycles5),
-                    Assert(spec.mcycles.type5 == actual.mcycles.type5),
-                ]
-            with m.If(spec.mcycles.num >= 6):
-                m.d.comb += [
-                    Assert(spec.mcycles.tcycles6 == actual.mcycles.tcycles6),
-                    Assert(spec.mcycles.type6 == actual.mcycles.type6),
-                ]
-
-            with m.If(spec.memwrs.num >= 1):
-                m.d.comb += [
-                    Assert(spec.memwrs.addr0 == actual.memwrs.addr0),
-                    Assert(spec.memwrs.data0 == actual.memwrs.data0),
-                ]
-            with m.If(spec.memwrs.num >= 2):
-                m.d.comb += [
-                    Assert(spec.memwrs.addr1 == actual.memwrs.addr1),
-                    Assert(spec.memwrs.data1 == actual.memwrs.data1),
-                ]
-            with m.If(spec.memwrs.num >= 3):
-                m.d.comb += [
-                    Assert(spec.memwrs.addr2 == actual.memwrs.addr2),
-                    Assert(spec.memwrs.data2 == actual.memwrs.data2),
-                ]
-
-    main_runner(parser, args, m, ports=[clk, rst] + z80.ports())
+    if args.action == "generate" and args.generate_type == "il":
+        cache = None if args.no_cache else RTLILCache()
+        output = formal_rtlil(args.insn, cover=args.cover, cache=cache,
+                              prove=args.prove, sliced=args.slice)
+        if args.generate_file:
+            args.generate_file.write(output)
+        else:
+            print(output)
+    else:
+        m, ports = formal_top(args.insn, cover=args.cover, prove=args.prove,
+                              sliced=args.slice)
+        main_runner(parser, args, m, ports=ports)
     # main(m, ports=[clk, rst] + z80.ports())
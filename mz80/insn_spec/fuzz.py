@@ -0,0 +1,419 @@
+import argparse
+import collections
+import json
+import random
+import sys
+import time
+
+from nmigen import *
+from nmigen.back import rtlil
+
+from ..sim.cxxrtl import CompiledZ80, compile_rtlil
+from ..sim.events import read_instr_state
+from ..sim.memory import MEM_SIZE, Bus
+from ..sim.refmodel import RefZ80, UnimplementedInstruction
+from ..sim.top import INPUTS, SimTop
+from ..z80fi.z80fi import DEPTHS
+from .formal_sweep import discover_specs
+from .formal_test import spec_checks, spec_class
+
+PREFIXES = (0xDD, 0xFD)
+
+# The FSMs whose transitions are tracked, by their path in FuzzTop.
+FSMS = {
+    "mcycler": ("z80", "mcycler"),
+    "sequencer": ("z80", "sequencer"),
+}
+
+# A fuzzing case. program is a list of instructions, each a list of bytes,
+# run from address 0 with NOPs after it. Memory and I/O cycles get
+# mem_wait and io_wait wait states, as with Bus, and nBUSRQ is toggled at
+# the start of a T-state with probability busrq, from a generator seeded
+# with seed.
+FuzzCase = collections.namedtuple(
+    "FuzzCase", ["program", "mem_wait", "io_wait", "busrq", "seed"])
+
+# An instruction that failed its spec. checks are the names of the checks
+# from spec_checks() that failed, and state is the z80fi snapshot, as an
+# InstrState.
+FuzzFailure = collections.namedtuple(
+    "FuzzFailure", ["case", "edge", "insn", "checks", "state"])
+
+
+def instructions():
+    """Returns every instruction the reference model implements, except
+    HALT, as (prefix, opcode, operand count). prefix is None, 0xDD or
+    0xFD."""
+    found = []
+    mem = bytearray(MEM_SIZE)
+    for prefix in (None, ) + PREFIXES:
+        for op in range(256):
+            if op in PREFIXES:
+                continue
+            code = [op] if prefix is None else [prefix, op]
+            mem[:len(code)] = bytes(code)
+            model = RefZ80(mem)
+            try:
+                model.step()
+            except UnimplementedInstruction:
+                continue
+            if not model.halted:
+                found.append((prefix, op, model.regs.PC - len(code)))
+    return found
+
+
+class FuzzTop(SimTop):
+    """SimTop with z80fi, checked against every instruction spec.
+
+    Each spec's checks (see spec_checks()) are brought out as outputs named
+    "{insn}__fail{N}", which are high while the spec is valid and check N
+    doesn't hold. "{insn}__fail" is any of them, "{insn}__valid" the spec's
+    valid, and "{insn}__cover{N}" the test of the spec's Nth Cover.
+
+    The specs are built to hold as much z80fi state as SimTop records,
+    rather than just what they need.
+
+    Any other keyword arguments are passed on to Z80.
+    """
+
+    def __init__(self, specs=None, **core_options):
+        super().__init__(include_z80fi=True, **core_options)
+        self.specs = collections.OrderedDict(
+            (insn, spec_class(insn)(depths=DEPTHS))
+            for insn in (specs if specs is not None else discover_specs()))
+        # The names of the checks of each spec, and how many Covers it has.
+        self.checks = {}
+        self.covers = {}
+        # (output, value) for everything above, filled in by elaborate().
+        self._spec_outputs = []
+
+        for insn in self.specs:
+            for name in self._spec_output_names(insn):
+                signal = Signal(name=name)
+                setattr(self, name, signal)
+                self.output_signals.append((name, signal))
+
+    def _spec_output_names(self, insn):
+        # The checks and Covers are only known once there are Records to
+        # build them from, so count them on throwaway ones.
+        test = spec_class(insn)(depths=DEPTHS)
+        checks = spec_checks(test.spec, test.actual, cycles=True)
+        covers = test.coverage(Module())
+        self.checks[insn] = [name for name, _, _ in checks]
+        self.covers[insn] = len(covers)
+        return ["{}__valid".format(insn), "{}__fail".format(insn)] + [
+            "{}__fail{}".format(insn, i) for i in range(len(checks))
+        ] + ["{}__cover{}".format(insn, i) for i in range(len(covers))]
+
+    @property
+    def outputs(self):
+        """The (name, width) of every output, for CompiledZ80's pins."""
+        return [(name, len(signal)) for name, signal in self.output_signals]
+
+    def elaborate(self, platform):
+        m = super().elaborate(platform)
+
+        for insn, test in self.specs.items():
+            m.submodules[insn] = test
+            m.d.comb += test.actual.connect(self.z80fi)
+
+            valid = test.spec.valid
+            fails = []
+            checks = spec_checks(test.spec, test.actual, cycles=True)
+            for i, (_, guard, check) in enumerate(checks):
+                fail = getattr(self, "{}__fail{}".format(insn, i))
+                if guard is None:
+                    m.d.comb += fail.eq(valid & ~check)
+                else:
+                    m.d.comb += fail.eq(valid & guard & ~check)
+                fails.append(fail)
+            for i, cover in enumerate(test.coverage(m)):
+                m.d.comb += getattr(self, "{}__cover{}".format(
+                    insn, i)).eq(cover.test)
+            m.d.comb += [
+                getattr(self, insn + "__valid").eq(valid),
+                getattr(self, insn + "__fail").eq(Cat(*fails).any()),
+            ]
+
+        return m
+
+
+def random_instruction(rng, table):
+    """Returns a random instruction from instructions(), with random
+    operands, as a list of bytes. Now and then it gets an extra prefix,
+    which the one after it overrides."""
+    prefix, op, operands = rng.choice(table)
+    code = [] if prefix is None else [prefix]
+    if rng.random() < 0.05:
+        code.insert(0, rng.choice(PREFIXES))
+    return code + [op] + [rng.randrange(256) for _ in range(operands)]
+
+
+class Fuzzer(object):
+    """Runs random instruction streams through FuzzTop on CXXRTL, checking
+    every instruction that retires against the specs.
+
+    Coverage is every spec's Covers, and the states and transitions of the
+    FSMs in FSMS, sampled on every rising edge. A case that hits anything
+    new goes into the corpus, and later cases are mostly mutations of
+    corpus entries, the rest fresh random streams.
+
+    Each case runs for tstates T-states from reset, with a fresh instance
+    of the design. specs are spec names, all of them by default. Any other
+    keyword arguments are passed on to Z80.
+    """
+
+    def __init__(self, specs=None, tstates=400, seed=0, max_wait=2,
+                 **core_options):
+        self.top = FuzzTop(specs, **core_options)
+        self.library = compile_rtlil(
+            rtlil.convert(self.top, ports=self.top.ports()))
+        self.tstates = tstates
+        self.rng = random.Random(seed)
+        self.max_wait = max_wait
+        self.table = instructions()
+
+        # Elaboration has filled in the FSMs' decodings.
+        self.fsms = collections.OrderedDict()
+        for name, path in FSMS.items():
+            module = self.top
+            for attr in path:
+                module = getattr(module, attr)
+            self.fsms[name] = (" ".join(path + (module.fsm.state.name, )),
+                               dict(module.fsm.decoding))
+
+        self.cover_hits = {
+            insn: [0] * n
+            for insn, n in self.top.covers.items()
+        }
+        self.retired = collections.Counter()
+        self.states = {name: collections.Counter() for name in self.fsms}
+        self.transitions = {name: collections.Counter() for name in self.fsms}
+        self.corpus = []
+        self.failures = []
+        self.cases = 0
+        self.edges = 0
+
+    def random_case(self):
+        rng = self.rng
+        count = self.tstates // 6
+        return FuzzCase(
+            [random_instruction(rng, self.table) for _ in range(count)],
+            rng.randint(0, self.max_wait), rng.randint(0, self.max_wait),
+            rng.choice([0, 0, 0.02, 0.1]), rng.randrange(1 << 32))
+
+    def mutate(self, case):
+        """Returns a copy of a case with a few random changes."""
+        rng = self.rng
+        program = [list(code) for code in case.program]
+        mem_wait, io_wait, busrq, seed = case[1:]
+        for _ in range(rng.randint(1, 3)):
+            what = rng.randrange(6)
+            at = rng.randrange(len(program) + 1)
+            if what == 0 and program:
+                del program[min(at, len(program) - 1)]
+            elif what == 1:
+                program.insert(at, random_instruction(rng, self.table))
+            elif what == 2 and program:
+                program[min(at, len(program) - 1)] = random_instruction(
+                    rng, self.table)
+            elif what == 3:
+                mem_wait = rng.randint(0, self.max_wait)
+                io_wait = rng.randint(0, self.max_wait)
+            elif what == 4:
+                busrq = rng.choice([0, 0.02, 0.1, 0.3])
+            else:
+                seed = rng.randrange(1 << 32)
+        return FuzzCase(program, mem_wait, io_wait, busrq, seed)
+
+    def next_case(self):
+        if self.corpus and self.rng.random() < 0.75:
+            return self.mutate(self.rng.choice(self.corpus))
+        return self.random_case()
+
+    def run_case(self, case):
+        """Runs a case. Returns whether it hit anything new. Failures are
+        added to failures, and end the case."""
+        mem = bytearray(MEM_SIZE)
+        image = bytes(b for code in case.program for b in code)
+        mem[:len(image)] = image[:MEM_SIZE]
+        bus = Bus(mem, mem_wait=case.mem_wait, io_wait=case.io_wait)
+        rng = random.Random(case.seed)
+
+        z80 = CompiledZ80(self.library, pins=(INPUTS, self.top.outputs))
+        fsms = [(name, z80.object(path).curr, decoding,
+                 self.states[name], self.transitions[name])
+                for name, (path, decoding) in self.fsms.items()]
+        last_state = {name: None for name in self.fsms}
+        new = False
+        try:
+            z80.reset()
+            last_valid = 0
+            first = True
+            for _ in range(self.tstates):
+                if case.busrq and rng.random() < case.busrq:
+                    z80.nBUSRQ ^= 1
+                for rising in (True, False):
+                    bus.serve(z80)
+                    z80.edge()
+                    self.edges += 1
+                    if rising:
+                        for name, curr, decoding, states, transitions in fsms:
+                            state = decoding.get(curr[0], curr[0])
+                            new |= state not in states
+                            states[state] += 1
+                            edge = (last_state[name], state)
+                            if last_state[name] is not None:
+                                new |= edge not in transitions
+                                transitions[edge] += 1
+                            last_state[name] = state
+
+                    valid = z80.z80fi("valid")
+                    if valid and not last_valid:
+                        if first:
+                            first = False
+                        else:
+                            new |= self._check(case, z80)
+                            if self.failures and \
+                                    self.failures[-1].case is case:
+                                return new
+                    last_valid = valid
+            return new
+        finally:
+            z80.close()
+            self.cases += 1
+
+    def _check(self, case, z80):
+        new = False
+        for insn, checks in self.top.checks.items():
+            if not z80._get(insn + "__valid"):
+                continue
+            self.retired[insn] += 1
+            hits = self.cover_hits[insn]
+            for i in range(len(hits)):
+                if z80._get("{}__cover{}".format(insn, i)):
+                    new |= hits[i] == 0
+                    hits[i] += 1
+            if z80._get(insn + "__fail"):
+                failed = [
+                    name for i, name in enumerate(checks)
+                    if z80._get("{}__fail{}".format(insn, i))
+                ]
+                self.failures.append(
+                    FuzzFailure(case, z80.edges, insn, failed,
+                                read_instr_state(z80)))
+        return new
+
+    def run(self, cases=None, seconds=None, stop_on_failure=True):
+        """Runs cases until there have been a number of them, or a number
+        of seconds have passed, or one fails if stop_on_failure. Returns
+        report()."""
+        start = time.perf_counter()
+        done = 0
+        while cases is None or done < cases:
+            if seconds is not None and time.perf_counter() - start > seconds:
+                break
+            case = self.next_case()
+            if self.run_case(case):
+                self.corpus.append(case)
+            done += 1
+            if stop_on_failure and self.failures:
+                break
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed=None):
+        """Returns the coverage so far, as a JSON-able dict."""
+        fsms = {}
+        for name, (_, decoding) in self.fsms.items():
+            states = self.states[name]
+            fsms[name] = {
+                "states": len(states),
+                "of_states": len(decoding),
+                "unvisited": sorted(set(decoding.values()) - set(states)),
+                "transitions": len(self.transitions[name]),
+            }
+        results = {
+            "cases": self.cases,
+            "corpus": len(self.corpus),
+            "tstates": self.edges // 2,
+            "retired": dict(self.retired),
+            "covers": self.cover_hits,
+            "fsms": fsms,
+            "failures": len(self.failures),
+        }
+        if elapsed is not None:
+            results["seconds"] = elapsed
+            results["tstates_per_s"] = self.edges / 2 / elapsed
+        return results
+
+
+def describe(failure):
+    """Returns a human-readable description of a failure."""
+    case, st = failure.case, failure.state
+    prefix = "DD " if st.useIX else "FD " if st.useIY else ""
+    lines = [
+        "{}: {}0x{:02X} at PC=0x{:04X}, edge {}, failed {}".format(
+            failure.insn, prefix, st.instr, st.regs_in.PC, failure.edge,
+            ", ".join(failure.checks)),
+        "  mem_wait={} io_wait={} busrq={} seed={}".format(*case[1:]),
+        "  program: {}".format(" ".join(
+            "".join("{:02X}".format(b) for b in code)
+            for code in case.program)),
+        "  {!r}".format(st),
+    ]
+    return "\n".join(lines)
+
+
+def case_json(case):
+    return dict(case._asdict())
+
+
+if __name__ == "__main__":
+    from ..flow.synth import parse_option
+
+    parser = argparse.ArgumentParser(
+        description="Fuzz the core with random instruction streams, "
+        "checking every retired instruction against the specs, and report "
+        "coverage as JSON.")
+    parser.add_argument("--specs", help="comma-separated (default: all)")
+    parser.add_argument("--cases", type=int, default=None)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--tstates", type=int, default=400,
+                        help="T-states per case (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-wait", type=int, default=2,
+                        help="most wait states per cycle (default: "
+                        "%(default)s)")
+    parser.add_argument("--keep-going", action="store_true",
+                        help="don't stop at the first failure")
+    parser.add_argument("--replay", help="run only the case in this JSON "
+                        "file, as written by --failures")
+    parser.add_argument("--failures", help="write failing cases to this "
+                        "JSON file")
+    parser.add_argument("--option", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="core option, e.g. microcoded=True")
+    args = parser.parse_args()
+
+    options = dict(parse_option(option) for option in args.option)
+    specs = args.specs.split(",") if args.specs else None
+    fuzzer = Fuzzer(specs, tstates=args.tstates, seed=args.seed,
+                    max_wait=args.max_wait, **options)
+    if args.replay:
+        with open(args.replay) as f:
+            for case in json.load(f):
+                fuzzer.run_case(FuzzCase(**case))
+        results = fuzzer.report()
+    else:
+        results = fuzzer.run(args.cases, args.seconds,
+                             stop_on_failure=not args.keep_going)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    for failure in fuzzer.failures:
+        print(describe(failure), file=sys.stderr)
+    if args.failures and fuzzer.failures:
+        with open(args.failures, "w") as f:
+            json.dump([case_json(failure.case)
+                       for failure in fuzzer.failures], f, indent=2)
+    if fuzzer.failures:
+        sys.exit(1)
@@ -0,0 +1,183 @@
+import os
+import subprocess
+import sys
+
+from ..sim.cxxrtl import YOSYS, YOSYS_CONFIG
+
+# The solver is checked after every STEP new T-states: the length of the
+# shortest instruction, a bare M1 cycle.
+STEP = 4
+
+# Turns the formal harness into the SMT-LIBv2 model that yosys-smtbmc
+# reads, the way sby prepares it for mode bmc with multiclock off.
+SMT2_SCRIPT = """\
+read_ilang {name}.il
+prep -top top
+async2sync
+dffunmap
+chformal -assume -early
+opt_clean
+write_smt2 -wires {name}.smt2
+"""
+
+
+def smtio():
+    """Imports the smtio module that yosys-smtbmc is built on. It ships
+    with Yosys, outside of site-packages."""
+    datdir = subprocess.check_output([YOSYS_CONFIG, "--datdir"],
+                                     universal_newlines=True).strip()
+    path = os.path.join(datdir, "python3")
+    if path not in sys.path:
+        sys.path.append(path)
+    import smtio
+    return smtio
+
+
+def smt2_model(workdir, name):
+    """Converts name.il in workdir into name.smt2. Returns Yosys' output."""
+    proc = subprocess.run([YOSYS, "-q", "-p", SMT2_SCRIPT.format(name=name)],
+                          cwd=workdir,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT,
+                          universal_newlines=True,
+                          check=True)
+    return proc.stdout
+
+
+class IncrementalBMC(object):
+    """Bounded model checking that deepens one solver instance.
+
+    yosys-smtbmc solves a single depth, so proving deeper means starting
+    over and re-solving every shallower step. Here the model is unrolled
+    step by step into one solver, and once a step's assertions are proved
+    they are asserted as facts, so the deeper checks build on the shallower
+    ones instead of repeating them.
+
+    Each Cover is looked for as the model deepens. Once they're all hit,
+    every variant of the spec has retired, the longest included, and
+    nothing deeper is needed.
+
+    smt2 is the path of a model from smt2_model(). solver is any solver
+    yosys-smtbmc supports.
+    """
+
+    def __init__(self, smt2, solver="boolector", top="top"):
+        module = smtio()
+        opts = module.SmtOpts()
+        opts.solver = solver
+        # Solvers without uninterpreted sorts need the state unrolled into
+        # plain variables, as sby asks of yosys-smtbmc for them.
+        opts.unroll = solver in ("boolector", "bitwuzla")
+        self.smt = module.SmtIo(opts=opts)
+        self.top = top
+        with open(smt2) as f:
+            for line in f:
+                self.smt.write(line.rstrip())
+
+        # The expression of every Cover, with {state} for the state.
+        self.covers = self._cover_exprs(top, "{state}")
+        # The depth of the increment each Cover was first hit in, or None.
+        self.cover_depths = [None] * len(self.covers)
+        # How many steps are unrolled, and how many of them are proved.
+        self.depth = 0
+        self.proved = 0
+
+    def _cover_exprs(self, module, state):
+        info = self.smt.modinfo[module]
+        exprs = [
+            "(|{}| {})".format(cover, state)
+            for cover in sorted(info.covers)
+        ]
+        for cell, submodule in sorted(info.cells.items()):
+            exprs += self._cover_exprs(
+                submodule, "(|{}_h {}| {})".format(module, cell, state))
+        return exprs
+
+    def _check(self, expr):
+        """Returns whether expr can hold, given everything asserted so
+        far."""
+        self.smt.write("(push 1)")
+        self.smt.write("(assert {})".format(expr))
+        result = self.smt.check_sat()
+        self.smt.write("(pop 1)")
+        if result not in ("sat", "unsat"):
+            raise RuntimeError("solver returned {}".format(result))
+        return result == "sat"
+
+    def unroll(self, depth):
+        """Adds steps to the model until it is depth steps deep."""
+        smt, top = self.smt, self.top
+        for step in range(self.depth, depth):
+            smt.write("(declare-fun s{} () |{}_s|)".format(step, top))
+            smt.write("(assert (|{}_u| s{}))".format(top, step))
+            smt.write("(assert (|{}_h| s{}))".format(top, step))
+            if step == 0:
+                smt.write("(assert (|{}_i| s0))".format(top))
+                smt.write("(assert (|{}_is| s0))".format(top))
+            else:
+                smt.write("(assert (|{}_t| s{} s{}))".format(
+                    top, step - 1, step))
+                smt.write("(assert (not (|{}_is| s{})))".format(top, step))
+        self.depth = max(self.depth, depth)
+
+    def prove(self):
+        """Proves the assertions in every unrolled step not yet proved.
+        Returns the first step that fails, or None."""
+        steps = range(self.proved, self.depth)
+        if not steps:
+            return None
+        holds = ["(|{}_a| s{})".format(self.top, step) for step in steps]
+        if self._check("(not (and {}))".format(" ".join(holds))):
+            # Narrow it down. Everything before the failing step holds, so
+            # stop there.
+            for step, hold in zip(steps, holds):
+                if self._check("(not {})".format(hold)):
+                    return step
+                self.smt.write("(assert {})".format(hold))
+                self.proved = step + 1
+        for hold in holds:
+            self.smt.write("(assert {})".format(hold))
+        self.proved = self.depth
+        return None
+
+    def cover(self, first):
+        """Looks for the Covers not yet hit in steps first and on. Returns
+        whether every Cover has been hit."""
+        for i, expr in enumerate(self.covers):
+            if self.cover_depths[i] is not None:
+                continue
+            steps = range(first, self.depth)
+            reached = " ".join(
+                expr.format(state="s{}".format(step)) for step in steps)
+            if steps and self._check("(or {})".format(reached)):
+                self.cover_depths[i] = self.depth
+        return None not in self.cover_depths
+
+    def run(self, max_depth, step=STEP, log=None):
+        """Deepens the model step T-states at a time, up to max_depth,
+        until every Cover is hit or an assertion fails.
+
+        Returns (status, depth). status is PASS if every Cover was hit
+        with every assertion holding up to depth, FAIL if an assertion
+        failed at step depth, or UNCOVERED if max_depth was reached first.
+        log is called with a line of progress after each increment.
+        """
+        while self.depth < max_depth:
+            first = self.depth
+            self.unroll(min(self.depth + step, max_depth))
+            failed = self.prove()
+            if failed is not None:
+                return "FAIL", failed
+            covered = self.cover(first)
+            if log is not None:
+                log("depth {}: assertions hold, {} of {} covers hit".format(
+                    self.depth,
+                    len(self.covers) - self.cover_depths.count(None),
+                    len(self.covers)))
+            if covered:
+                return "PASS", self.depth
+        return "UNCOVERED", self.depth
+
+    def close(self):
+        self.smt.write("(exit)")
+        self.smt.wait()
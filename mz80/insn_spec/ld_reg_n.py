@@ -6,9 +6,25 @@ from ..z80fi.z80fi import *
 
 
 class ld_reg_n(Elaboratable):
-    def __init__(self):
-        self.actual = Z80fiState(name="actual")
-        self.spec = Z80fiState(name="spec")
+    # The opcodes this spec covers, as a pattern for Value.matches().
+    OPCODES = "00---110"
+
+    # How much the spec's instructions need of the z80fi state, see
+    # Z80fiState.
+    DEPTHS = {
+        "operands": 2,
+        "memrds": 0,
+        "memwrs": 1,
+        "iords": 0,
+        "iowrs": 0,
+        "mcycles": 4,
+    }
+
+    def __init__(self, depths=None):
+        if depths is None:
+            depths = self.DEPTHS
+        self.actual = Z80fiState(name="actual", depths=depths)
+        self.spec = Z80fiState(name="spec", depths=depths)
 
     def elaborate(self, platform):
         m = Module()
@@ -17,7 +33,7 @@ class ld_reg_n(Elaboratable):
         n = self.actual.operands.data0
 
         m.d.comb += self.spec.valid.eq(
-            self.actual.valid & self.actual.instr.matches("00---110"))
+            self.actual.valid & self.actual.instr.matches(self.OPCODES))
 
         m.d.comb += [
             self.spec.regs_out.eq(self.actual.regs_out),
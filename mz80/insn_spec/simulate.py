@@ -0,0 +1,55 @@
+from nmigen import *
+from nmigen.back.pysim import Delay, Simulator
+from nmigen.hdl.ast import SignalDict, SignalSet
+
+from ..z80fi.z80fi import Z80fiState
+
+
+class SpecSimulator(Elaboratable):
+    """Simulates an instruction spec on its own, with pysim.
+
+    actual is a Z80fiState, with the spec's depths, that drives the spec's
+    actual state.
+    """
+
+    def __init__(self, test):
+        self.test = test
+        self.actual = Z80fiState(name="driven", depths=test.actual.depths)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.test = self.test
+        m.d.comb += self.test.actual.connect(self.actual)
+        return m
+
+    def run(self, states, outputs):
+        """Settles the spec in each of states, a list of (signal, value) for
+        signals of actual, with the rest of actual zero. Returns, for each
+        state, a list of the values of outputs, which are expressions over
+        the spec's signals.
+        """
+        results = []
+
+        def process():
+            # Only the signals a state sets are ever off zero, so they're
+            # all that the next state has to clear.
+            held = SignalSet()
+            for state in states:
+                state = SignalDict(state)
+                for signal in held:
+                    if signal not in state:
+                        yield signal.eq(0)
+                for signal, value in state.items():
+                    yield signal.eq(value)
+                held = SignalSet(state.keys())
+                # The spec is combinational, so a moment settles it.
+                yield Delay(1e-9)
+                values = []
+                for output in outputs:
+                    values.append((yield output))
+                results.append(values)
+
+        with Simulator(self) as sim:
+            sim.add_process(process())
+            sim.run()
+        return results
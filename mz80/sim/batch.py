@@ -0,0 +1,527 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+import numpy as np
+
+from .bench import PROGRAMS
+from .cxxrtl import YOSYS, sim_top_rtlil
+from .memory import MEM_SIZE
+from .top import INPUTS, Z80Bus, outputs
+
+BUILD_DIR = os.environ.get("MZ80_BATCH_DIR", ".batch")
+
+# Lowers the design to single-bit gates and flops. Sync resets and enables
+# become logic in front of plain flops, so every flop is a $_DFF_P_ or a
+# $_DFF_N_ and the rest is a handful of gate types. memory_map leaves the
+# words past the end of a memory undriven, which the optimizer may turn
+# into anything, so they're tied to 0, as the other simulators read them.
+SYNTH_SCRIPT = (
+    "read_rtlil {il}; hierarchy -top top; proc; flatten; memory_map; "
+    "setundef -undriven -zero; opt; techmap; opt -fast; "
+    "dfflegalize -cell $_DFF_P_ 01 -cell $_DFF_N_ 01; "
+    "abc -g AND,OR,XOR,MUX; opt_clean; write_json {json}")
+
+# Gate types and the names of their input ports, in operand order.
+GATES = {
+    "$_BUF_": ("A",),
+    "$_NOT_": ("A",),
+    "$_AND_": ("A", "B"),
+    "$_OR_": ("A", "B"),
+    "$_XOR_": ("A", "B"),
+    "$_MUX_": ("A", "B", "S"),
+}
+
+# Cells that don't compute anything.
+IGNORED = {"$scopeinfo"}
+
+LANES_PER_WORD = 64
+
+
+def build_netlist(il, build_dir=BUILD_DIR):
+    """Synthesizes the RTLIL of a design whose top module is "top" into a
+    gate-level JSON netlist. Returns the netlist's path.
+
+    Like compile_rtlil(), the netlist is named after a hash of its RTLIL,
+    so it is only rebuilt when the design changes.
+    """
+    name = hashlib.sha256(il.encode()).hexdigest()[:16]
+    netlist = os.path.abspath(os.path.join(build_dir, name + ".json"))
+    if os.path.exists(netlist):
+        return netlist
+
+    os.makedirs(build_dir, exist_ok=True)
+    il_file = os.path.join(build_dir, name + ".il")
+    with open(il_file, "w") as f:
+        f.write(il)
+    tmp = "{}.{}.tmp".format(os.path.join(build_dir, name + ".json"),
+                             os.getpid())
+    subprocess.check_call(
+        [YOSYS, "-q", "-p",
+         SYNTH_SCRIPT.format(il=il_file, json=tmp)])
+    os.replace(tmp, netlist)
+    return netlist
+
+
+def _init_bits(netnames):
+    """Returns {bit: 0 or 1} for every bit of every wire with an init
+    value."""
+    init = {}
+    for wire in netnames.values():
+        value = wire["attributes"].get("init")
+        if value is None:
+            continue
+        if isinstance(value, int):
+            value = format(value, "0{}b".format(len(wire["bits"])))
+        # init is MSB first, and may be shorter than the wire.
+        for i, bit in enumerate(wire["bits"]):
+            if i < len(value) and isinstance(bit, int):
+                init[bit] = 1 if value[len(value) - 1 - i] == "1" else 0
+    return init
+
+
+class _Netlist(object):
+    """A gate-level netlist, levelized and laid out as rows of a bit-plane
+    array.
+
+    Row 0 is constant 0 and row 1 constant 1. Then come the inputs, the
+    flops and anything else that isn't driven by a gate, then the gates,
+    one contiguous run of rows per type per level, so that each run is
+    computed by a single NumPy operation into a slice.
+    """
+
+    def __init__(self, module):
+        cells = [
+            cell for cell in module["cells"].values()
+            if cell["type"] not in IGNORED
+        ]
+        for cell in cells:
+            if cell["type"] not in GATES and cell["type"] not in (
+                    "$_DFF_P_", "$_DFF_N_"):
+                raise ValueError("Can't simulate a {} cell".format(
+                    cell["type"]))
+
+        gates = [cell for cell in cells if cell["type"] in GATES]
+        flops = {
+            edge: [cell for cell in cells if cell["type"] == edge]
+            for edge in ("$_DFF_P_", "$_DFF_N_")
+        }
+        driver = {gate["connections"]["Y"][0]: gate for gate in gates}
+        ports = module["ports"]
+        clk = ports["clk"]["bits"][0]
+        for cell in flops["$_DFF_P_"] + flops["$_DFF_N_"]:
+            if cell["connections"]["C"][0] != clk:
+                raise ValueError("Only flops clocked by clk are supported")
+
+        self.rows = {}
+        # The rows of bits that nothing drives, with the values they keep.
+        self.constants = {}
+        init = _init_bits(module["netnames"])
+
+        def add(bit):
+            self.rows[bit] = len(self.rows) + 2
+
+        for port in ports.values():
+            if port["direction"] == "input":
+                for bit in port["bits"]:
+                    if isinstance(bit, int) and bit not in self.rows:
+                        add(bit)
+        self.flops = {}
+        for edge, cells in flops.items():
+            start = len(self.rows) + 2
+            for cell in cells:
+                add(cell["connections"]["Q"][0])
+            self.flops[edge] = (start, len(self.rows) + 2, [
+                cell["connections"]["D"][0] for cell in cells
+            ])
+        self.init = {
+            self.rows[bit]: init.get(bit, 0)
+            for cell in flops["$_DFF_P_"] + flops["$_DFF_N_"]
+            for bit in cell["connections"]["Q"]
+        }
+
+        # Every bit that's read but driven by nothing keeps its init value.
+        read = [
+            bit for gate in gates for port in GATES[gate["type"]]
+            for bit in gate["connections"][port]
+        ] + [
+            bit for port in ports.values() if port["direction"] == "output"
+            for bit in port["bits"]
+        ]
+        for _, _, ds in self.flops.values():
+            read.extend(ds)
+        for bit in read:
+            if (isinstance(bit, int) and bit not in self.rows and
+                    bit not in driver):
+                add(bit)
+                self.constants[self.rows[bit]] = init.get(bit, 0)
+
+        level = {}
+        for bit in self.rows:
+            level[bit] = 0
+        for gate in gates:
+            self._level(gate, driver, level)
+
+        groups = {}
+        for gate in gates:
+            y = gate["connections"]["Y"][0]
+            groups.setdefault((level[y], gate["type"]), []).append(gate)
+        self.levels = max([lvl for lvl, _ in groups] or [0])
+        self.ops = []
+        for key in sorted(groups):
+            start = len(self.rows) + 2
+            for gate in groups[key]:
+                add(gate["connections"]["Y"][0])
+            self.ops.append((key[1], start, len(self.rows) + 2))
+        # Operands can only be resolved once every gate has a row.
+        self.ops = [(kind, start, stop, [
+            np.array([self.row(gate["connections"][port][0])
+                      for gate in groups[key]], dtype=np.intp)
+            for port in GATES[kind]
+        ]) for key, (kind, start, stop) in zip(sorted(groups), self.ops)]
+        self.flops = {
+            edge: (start, stop,
+                   np.array([self.row(d) for d in ds], dtype=np.intp))
+            for edge, (start, stop, ds) in self.flops.items()
+        }
+
+        self.ports = {
+            name: np.array([self.row(bit) for bit in port["bits"]],
+                           dtype=np.intp)
+            for name, port in ports.items()
+        }
+        self.gates = len(gates)
+        self.size = len(self.rows) + 2
+
+    def row(self, bit):
+        if isinstance(bit, str):
+            return 1 if bit == "1" else 0
+        return self.rows[bit]
+
+    def _level(self, gate, driver, level):
+        # Iterative, since the logic can be deeper than Python's recursion
+        # limit.
+        stack = [(gate, False)]
+        visiting = set()
+        while stack:
+            cell, expanded = stack.pop()
+            y = cell["connections"]["Y"][0]
+            if y in level:
+                continue
+            inputs = [
+                bit for port in GATES[cell["type"]]
+                for bit in cell["connections"][port] if isinstance(bit, int)
+            ]
+            if expanded:
+                visiting.discard(y)
+                level[y] = 1 + max(
+                    [level.get(bit, 0) for bit in inputs] or [0])
+                continue
+            if y in visiting:
+                raise ValueError("Combinatorial loop through {}".format(y))
+            visiting.add(y)
+            stack.append((cell, True))
+            for bit in inputs:
+                if bit not in level and bit in driver:
+                    stack.append((driver[bit], False))
+
+
+class BatchZ80(Z80Bus):
+    """Z80Bus on many independent copies of SimTop at once, as NumPy
+    operations on a gate-level netlist.
+
+    Each copy is a lane. Every net is a row of 64-bit words holding one bit
+    per lane, so a gate is a bitwise operation on rows, and each clock edge
+    advances all lanes together. Pins read as arrays with one value per
+    lane, and can be written with a scalar, for every lane, or such an
+    array. Use BatchBus rather than Bus to serve memory.
+
+    include_z80fi and core_options are as for SimTop. The netlist is built
+    with yosys on first use and kept in BUILD_DIR.
+    """
+
+    def __init__(self, lanes, include_z80fi=False, core_options=None,
+                 netlist=None):
+        if lanes < 1:
+            raise ValueError("Need at least one lane, not {}".format(lanes))
+        if netlist is None:
+            netlist = build_netlist(
+                sim_top_rtlil(include_z80fi=include_z80fi,
+                              core_options=core_options))
+        with open(netlist) as f:
+            self._net = _Netlist(json.load(f)["modules"]["top"])
+        self.lanes = lanes
+        self.include_z80fi = include_z80fi
+        self.core_options = core_options or {}
+        self.words = -(-lanes // LANES_PER_WORD)
+        self.edges = 0
+
+        net = self._net
+        self._values = np.zeros((net.size, self.words), dtype="<u8")
+        self._values[1] = ~np.uint64(0)
+        for row, value in list(net.init.items()) + list(
+                net.constants.items()):
+            if value:
+                self._values[row] = ~np.uint64(0)
+        self._clk = 0
+        for name, _, idle in INPUTS:
+            self._set(name, idle)
+        self._settle()
+        self._dirty = False
+
+    def rows(self, name):
+        """Returns the bit-planes of a pin: an array of (width, words) with
+        bit N of every lane in row N. Lane L is bit L % 64 of word L // 64.
+        """
+        return self._values[self._net.ports[name]]
+
+    def lanes_in(self, mask):
+        """Returns the indices of the lanes whose bit is set in mask, a row
+        of words such as one from rows()."""
+        bits = np.unpackbits(mask.view(np.uint8), bitorder="little")
+        return np.flatnonzero(bits[:self.lanes])
+
+    def _settle(self):
+        values = self._values
+        for kind, start, stop, operands in self._net.ops:
+            out = values[start:stop]
+            if kind == "$_AND_":
+                np.bitwise_and(values[operands[0]], values[operands[1]],
+                               out=out)
+            elif kind == "$_OR_":
+                np.bitwise_or(values[operands[0]], values[operands[1]],
+                              out=out)
+            elif kind == "$_XOR_":
+                np.bitwise_xor(values[operands[0]], values[operands[1]],
+                               out=out)
+            elif kind == "$_NOT_":
+                np.invert(values[operands[0]], out=out)
+            elif kind == "$_MUX_":
+                a = values[operands[0]]
+                b = values[operands[1]]
+                np.bitwise_xor(a, b, out=b)
+                np.bitwise_and(b, values[operands[2]], out=b)
+                np.bitwise_xor(a, b, out=out)
+            else:
+                out[...] = values[operands[0]]
+
+    def edge(self):
+        # Inputs written since the last edge have to reach the flops' D
+        # first.
+        if self._dirty:
+            self._settle()
+        self._clk ^= 1
+        self._set("clk", self._clk)
+        start, stop, d = self._net.flops[
+            "$_DFF_P_" if self._clk else "$_DFF_N_"]
+        self._values[start:stop] = self._values[d]
+        self._settle()
+        self._dirty = False
+        self.edges += 1
+
+    def _get(self, name):
+        rows = self.rows(name)
+        bits = np.unpackbits(rows.view(np.uint8), axis=1,
+                             bitorder="little")[:, :self.lanes]
+        value = np.zeros(self.lanes, dtype=np.int64)
+        for i in range(len(rows)):
+            value |= bits[i].astype(np.int64) << i
+        return value
+
+    def _set(self, name, value):
+        rows = self._net.ports[name]
+        value = np.asarray(value, dtype=np.int64)
+        shifts = np.arange(len(rows), dtype=np.int64)
+        if value.ndim == 0:
+            bits = (value >> shifts) & 1
+            self._values[rows] = np.where(bits, ~np.uint64(0),
+                                          np.uint64(0))[:, None]
+        else:
+            bits = ((value[None, :] >> shifts[:, None]) & 1).astype(np.uint8)
+            padded = np.zeros((len(rows), self.words * LANES_PER_WORD),
+                              dtype=np.uint8)
+            padded[:, :self.lanes] = bits
+            self._values[rows] = np.packbits(
+                padded, axis=1, bitorder="little").view("<u8")
+        self._dirty = True
+
+
+class BatchBus(object):
+    """Answers memory cycles for every lane of a BatchZ80, as Bus does for
+    a single Z80Bus.
+
+    mems is an array of (lanes, 64K) bytes, one memory per lane. Call
+    serve(z80) before every edge. Like Bus, each read or write is
+    delivered once per cycle. There are no wait states, I/O reads return
+    0xFF and I/O writes go nowhere.
+    """
+
+    def __init__(self, mems):
+        self.mems = mems
+        words = -(-len(mems) // LANES_PER_WORD)
+        # Bus's _active and _done, a bit per lane.
+        self._active = np.zeros(words, dtype="<u8")
+        self._done = np.zeros(words, dtype="<u8")
+        self._din = np.zeros(len(mems), dtype=np.int64)
+
+    def serve(self, z80):
+        nMREQ, nIORQ, nRD, nWR = (z80.rows(name)[0]
+                                  for name in ("nMREQ", "nIORQ", "nRD",
+                                               "nWR"))
+        tcycle = z80.rows("tcycle")
+        requesting = ~(nMREQ & nIORQ)
+        # Cycles start in T1 or T2, as in Bus.
+        early = ~(tcycle[3] | tcycle[2]) & ~(tcycle[1] & tcycle[0])
+        starting = requesting & ~self._active & early
+        self._done &= ~starting
+        self._active = (self._active | starting) & requesting
+
+        pending = self._active & ~self._done
+        reading = pending & ~nRD
+        writing = pending & nRD & ~nWR & ~nMREQ
+        self._done |= reading | (pending & ~nWR)
+        if not (reading.any() or writing.any()):
+            return
+
+        A = z80.A
+        lanes = z80.lanes_in(reading)
+        if len(lanes):
+            is_mem = np.isin(lanes, z80.lanes_in(~nMREQ))
+            din = np.full(len(lanes), 0xFF, dtype=np.int64)
+            din[is_mem] = self.mems[lanes[is_mem], A[lanes[is_mem]]]
+            self._din[lanes] = din
+            z80.Din = self._din
+        lanes = z80.lanes_in(writing)
+        if len(lanes):
+            self.mems[lanes, A[lanes]] = z80.Dout[lanes]
+
+
+def run_batch(z80, mems, tstates):
+    """Runs a BatchZ80 for a number of T-states. mems is a BatchBus, or an
+    array of per-lane memories for one. Returns the number of M1 cycles
+    each lane started, prefixes included."""
+    bus = mems if isinstance(mems, BatchBus) else BatchBus(mems)
+    fetches = np.zeros(z80.lanes, dtype=np.int64)
+    last = z80.rows("nM1")[0].copy()
+    for _ in range(2 * tstates):
+        bus.serve(z80)
+        z80.edge()
+        nM1 = z80.rows("nM1")[0]
+        fell = last & ~nM1
+        if fell.any():
+            fetches[z80.lanes_in(fell)] += 1
+        last = nM1.copy()
+    return fetches
+
+
+def random_programs(lanes, seed=0):
+    """Returns (lanes, 64K) bytes of random memory, one per lane."""
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 256, size=(lanes, MEM_SIZE), dtype=np.uint8)
+
+
+def check(z80, mems, tstates, lanes=(0,), backend="cxxrtl"):
+    """Runs lanes of a fresh BatchZ80 alongside the named backend, each from
+    its own copy of its memory, and compares every output after every edge.
+
+    Returns None if they all agree, otherwise (lane, edge, pin, batch
+    value, backend value) for the first difference.
+    """
+    from .memory import Bus
+    from .run import make_z80
+
+    batch = BatchBus(mems.copy())
+    singles = []
+    for lane in lanes:
+        single = make_z80(backend, include_z80fi=z80.include_z80fi,
+                          **z80.core_options)
+        single.reset()
+        singles.append((lane, single, Bus(bytearray(mems[lane].tobytes()))))
+    z80.reset()
+    names = [name for name, _ in outputs(z80.include_z80fi)]
+    try:
+        for edge in range(2 * tstates):
+            batch.serve(z80)
+            z80.edge()
+            values = {name: z80._get(name) for name in names}
+            for lane, single, bus in singles:
+                bus.serve(single)
+                single.edge()
+                for name in names:
+                    mine = int(values[name][lane])
+                    theirs = single._get(name)
+                    if mine != theirs:
+                        return lane, edge, name, mine, theirs
+        return None
+    finally:
+        for _, single, _ in singles:
+            if hasattr(single, "close"):
+                single.close()
+
+
+def throughput(lanes, program, tstates, seed=0, **core_options):
+    """Runs a program from PROGRAMS, or "random" for a different random
+    memory per lane, on every lane. Returns the results as a JSON-able
+    dict."""
+    z80 = BatchZ80(lanes, core_options=core_options)
+    if program == "random":
+        mems = random_programs(lanes, seed)
+    else:
+        mems = np.tile(np.frombuffer(bytes(PROGRAMS[program]), np.uint8),
+                       (lanes, 1))
+    z80.reset()
+    start = time.perf_counter()
+    fetches = run_batch(z80, mems, tstates)
+    elapsed = time.perf_counter() - start
+    return {
+        "lanes": lanes,
+        "program": program,
+        "options": core_options,
+        "gates": z80._net.gates,
+        "levels": z80._net.levels,
+        "tstates": tstates,
+        "seconds": elapsed,
+        "tstates_per_s": tstates / elapsed,
+        "lane_tstates_per_s": lanes * tstates / elapsed,
+        "m1_cycles": int(fetches.sum()),
+        "m1_per_s": int(fetches.sum()) / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    from ..flow.synth import parse_option
+
+    parser = argparse.ArgumentParser(
+        description="Run many copies of the core at once, one program per "
+        "lane, and report the throughput as JSON.")
+    parser.add_argument("--lanes", type=int, default=4096)
+    parser.add_argument("--program", choices=list(PROGRAMS) + ["random"],
+                        default="random")
+    parser.add_argument("--tstates", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0,
+                        help="for --program random (default: %(default)s)")
+    parser.add_argument("--option", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="core option, e.g. microcoded=True")
+    parser.add_argument("--check", type=int, default=0, metavar="N",
+                        help="instead, compare the first N lanes against "
+                        "cxxrtl, edge by edge")
+    args = parser.parse_args()
+
+    options = dict(parse_option(option) for option in args.option)
+    if args.check:
+        mems = random_programs(args.lanes, args.seed)
+        z80 = BatchZ80(args.lanes, core_options=options)
+        diff = check(z80, mems, args.tstates, range(args.check))
+        if diff is not None:
+            print("Lane {}, edge {}: {} is {}, cxxrtl has {}".format(*diff))
+            raise SystemExit(1)
+        print("{} lanes agree with cxxrtl for {} T-states".format(
+            args.check, args.tstates))
+    else:
+        results = throughput(args.lanes, args.program, args.tstates,
+                             args.seed, **options)
+        print(json.dumps(results, indent=2, sort_keys=True))
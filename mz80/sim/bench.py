@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import nmigen
+from nmigen.back import rtlil
+
+from ..flow.modules import harness
+from .refmodel import RefZ80
+from .run import make_z80, run
+
+ELABORATED = ["Z80", "Sequencer", "MCycler"]
+
+
+def _sled(pattern):
+    mem = bytearray(pattern * (0x10000 // len(pattern)))
+    assert len(mem) == 0x10000
+    return mem
+
+
+# Programs are sleds that fill all of memory and run through it forever,
+# since the core doesn't have jumps yet.
+PROGRAMS = {
+    # NOP
+    "nop": _sled(bytes([0x00])),
+    # LD B,C; LD D,E; LD H,L; LD A,B
+    "ld_r_r": _sled(bytes([0x41, 0x53, 0x65, 0x78])),
+    # LD (IX+2),2. IX is 0 out of reset, so each one stores 2 over the 2
+    # at address 2, leaving the sled intact.
+    "ld_ix_d_n": _sled(bytes([0xDD, 0x36, 0x02, 0x02])),
+}
+
+# Default T-states to run per program. pysim is a few hundred times slower.
+TSTATES = {
+    "cxxrtl": 200000,
+    "pysim": 2000,
+}
+
+
+def peak_rss_kb():
+    """Returns the process' peak resident set size so far, in KiB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB.
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def elaboration_time(name, repeat=3):
+    """Returns the best time, in seconds, to elaborate a module from MODULES
+    and convert it to RTLIL."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        design, ports = harness(name)
+        rtlil.convert(design, ports=ports)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def instructions_in(mem, tstates):
+    """Returns how many instructions of a program complete in a number of
+    T-states, according to the reference model.
+
+    The model doesn't count the M1 cycle of a DD or FD prefix, so that's
+    added back in.
+    """
+    model = RefZ80(bytearray(mem))
+    count = 0
+    elapsed = 0
+    while True:
+        st = model.step()
+        elapsed += sum(t for _, t in st.mcycles)
+        if st.useIX or st.useIY:
+            elapsed += 4
+        if elapsed > tstates:
+            return count
+        count += 1
+
+
+def simulation_speed(backend, mem, tstates):
+    """Runs a program on a backend. Returns a dict of the results."""
+    z80 = make_z80(backend)
+    z80.reset()
+    start = time.perf_counter()
+    run(z80, bytearray(mem), tstates)
+    elapsed = time.perf_counter() - start
+    if hasattr(z80, "close"):
+        z80.close()
+    instructions = instructions_in(mem, tstates)
+    return {
+        "tstates": tstates,
+        "seconds": elapsed,
+        "tstates_per_s": tstates / elapsed,
+        "instructions": instructions,
+        "instructions_per_s": instructions / elapsed,
+    }
+
+
+def git_commit():
+    """Returns the commit the package was run from, or None outside a git
+    checkout."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(backends, programs, tstates=None, elaborate=ELABORATED):
+    """Runs the benchmarks. Returns the results as a JSON-able dict.
+
+    tstates overrides the per-backend default in TSTATES.
+    """
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "nmigen": nmigen.__version__,
+        "elaboration_s": {},
+        "simulation": {},
+    }
+    for name in elaborate:
+        results["elaboration_s"][name] = elaboration_time(name)
+    results["peak_rss_kb_after_elaboration"] = peak_rss_kb()
+
+    for backend in backends:
+        n = tstates if tstates is not None else TSTATES[backend]
+        # Build (or find) the backend before the clock starts.
+        make_z80(backend)
+        results["simulation"][backend] = {
+            name: simulation_speed(backend, PROGRAMS[name], n)
+            for name in programs
+        }
+    results["peak_rss_kb"] = peak_rss_kb()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure elaboration time and simulation speed of the "
+        "core, as JSON.")
+    parser.add_argument("--backends", default="cxxrtl,pysim",
+                        help="comma-separated (default: %(default)s)")
+    parser.add_argument("--programs", default=",".join(PROGRAMS),
+                        help="comma-separated (default: %(default)s)")
+    parser.add_argument("--tstates", type=int, default=None,
+                        help="T-states per program (default: per backend)")
+    parser.add_argument("--output", "-o", help="JSON file to write "
+                        "(default: stdout)")
+    args = parser.parse_args()
+
+    results = bench(args.backends.split(","), args.programs.split(","),
+                    args.tstates)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,175 @@
+import argparse
+import sys
+import time
+
+from .events import EventStream
+from .memory import Bus, load_image
+from .refmodel import REG_NAMES, RefZ80
+from .run import make_z80
+
+
+class Divergence(Exception):
+    """The RTL and the reference model disagree about an instruction."""
+
+    def __init__(self, index, expected, actual, diffs):
+        super().__init__(index, expected, actual, diffs)
+        self.index = index
+        self.expected = expected
+        self.actual = actual
+        self.diffs = diffs
+
+    def __str__(self):
+        return self.report()
+
+    def report(self):
+        """Returns a compact, human-readable description."""
+        lines = [
+            "Divergence at instruction #{}: {}0x{:02X} at PC=0x{:04X}".format(
+                self.index, _prefix(self.actual), self.actual.instr,
+                self.actual.regs_in.PC)
+        ]
+        for field, expected, actual in self.diffs:
+            lines.append("  {}: expected {}, got {}".format(
+                field, _format(expected), _format(actual)))
+        return "\n".join(lines)
+
+
+class Stalled(Exception):
+    """The RTL went a number of T-states without retiring an
+    instruction."""
+
+    def __init__(self, retired, tstates, idle):
+        super().__init__(retired, tstates, idle)
+        self.retired = retired
+        self.tstates = tstates
+        self.idle = idle
+
+    def __str__(self):
+        return self.report()
+
+    def report(self):
+        """Returns a compact, human-readable description."""
+        return ("Stalled after {} instructions: nothing retired in the {} "
+                "T-states up to T-state {}".format(self.retired, self.idle,
+                                                  self.tstates))
+
+
+def _prefix(st):
+    return "DD " if st.useIX else "FD " if st.useIY else ""
+
+
+def _format(value):
+    if isinstance(value, int):
+        return "0x{:X}".format(value)
+    return repr(value)
+
+
+def compare(expected, actual):
+    """Returns a list of (field, expected, actual) for every field of two
+    InstrStates that differs."""
+    diffs = []
+    for field in ("instr", "useIX", "useIY"):
+        if getattr(expected, field) != getattr(actual, field):
+            diffs.append((field, getattr(expected, field),
+                          getattr(actual, field)))
+    for field in ("regs_in", "regs_out"):
+        e, a = getattr(expected, field), getattr(actual, field)
+        for name in REG_NAMES:
+            if getattr(e, name) != getattr(a, name):
+                diffs.append(("{}.{}".format(field, name), getattr(e, name),
+                              getattr(a, name)))
+    for field in ("operands", "memrds", "memwrs", "iords", "iowrs",
+                  "mcycles"):
+        if getattr(expected, field) != getattr(actual, field):
+            diffs.append((field, getattr(expected, field),
+                          getattr(actual, field)))
+    return diffs
+
+
+# No instruction takes anywhere near this long, even with wait states.
+IDLE_TSTATES = 1000
+
+
+class CoSim(object):
+    """Runs the RTL and RefZ80 in lockstep, one retired instruction at a
+    time.
+
+    z80 is a Z80Bus built with include_z80fi. Its bus is served from mem,
+    a Bus or a 64K bytearray; the model runs on its own copy of the memory.
+    Wait states don't change what z80fi records, so they don't need to be
+    modelled. The model takes its starting
+    registers from the first instruction the RTL retires, so it doesn't
+    have to know the RTL's reset values.
+    """
+
+    def __init__(self, z80, mem):
+        self.z80 = z80
+        self.stream = EventStream(z80, mem)
+        self.model = RefZ80(bytearray(self.stream.bus.mem))
+        self.retired = 0
+
+    @property
+    def edges(self):
+        return self.stream.edges
+
+    def run(self, instructions, tstates, idle=IDLE_TSTATES):
+        """Compares up to a number of instructions, within a number of
+        T-states. Raises Divergence on the first mismatch, and Stalled if
+        idle T-states go by without an instruction retiring. Returns the
+        number of instructions compared."""
+        end = self.edges + 2 * tstates
+        for event in self.stream.events(tstates, idle):
+            actual = event.state
+            if self.retired == 0:
+                self.model.regs = actual.regs_in.copy()
+                # regs_in.PC is past any prefix, which the model has to
+                # see to decode the instruction the same way.
+                if actual.useIX or actual.useIY:
+                    self.model.regs.PC = (actual.regs_in.PC - 1) & 0xFFFF
+            expected = self.model.step()
+            diffs = compare(expected, actual)
+            if diffs:
+                raise Divergence(self.retired, expected, actual, diffs)
+            self.retired += 1
+            if self.retired >= instructions:
+                break
+        else:
+            if self.edges < end:
+                raise Stalled(self.retired, self.edges // 2, idle)
+        return self.retired
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a Z80 binary on the RTL and the reference model in "
+        "lockstep, stopping at the first difference.")
+    parser.add_argument("image", help=".bin, .com or .hex image")
+    parser.add_argument("--backend", choices=["pysim", "cxxrtl"],
+                        default="cxxrtl")
+    parser.add_argument("--instructions", type=int, default=1000000)
+    parser.add_argument("--tstates", type=int, default=10000000)
+    parser.add_argument("--mem-wait", type=int, default=0,
+                        help="wait states per memory cycle")
+    parser.add_argument("--idle", type=int, default=IDLE_TSTATES,
+                        help="T-states without a retired instruction before "
+                        "the RTL counts as stalled (default: %(default)s)")
+    args = parser.parse_args()
+
+    mem = Bus(load_image(args.image), mem_wait=args.mem_wait)
+
+    z80 = make_z80(args.backend, include_z80fi=True)
+    z80.reset()
+    cosim = CoSim(z80, mem)
+    start = time.monotonic()
+    try:
+        cosim.run(args.instructions, args.tstates, args.idle)
+    except (Divergence, Stalled) as e:
+        print(e.report())
+        sys.exit(1)
+    elapsed = time.monotonic() - start
+    if cosim.retired < args.instructions:
+        print("Only {} of {} instructions retired in {} T-states".format(
+            cosim.retired, args.instructions, cosim.edges // 2))
+        sys.exit(1)
+    print("{} instructions, {} T-states matched in {:.2f}s".format(
+        cosim.retired, cosim.edges // 2, elapsed))
@@ -0,0 +1,82 @@
+import pytest
+
+from mz80.sim.cosim import CoSim, Stalled
+from mz80.sim.memory import Bus
+from mz80.sim.run import make_z80
+
+
+# Programs, as (bytes, instructions), that between them take operands,
+# read and write memory through (HL) and (IX+d)/(IY+d), and use DD/FD
+# prefixes on H and L.
+PROGRAMS = {
+    "operands": ([
+        0x06, 0x05,  # LD B,5
+        0x0E, 0x77,  # LD C,77h
+        0x3E, 0xA5,  # LD A,A5h
+        0x48,  # LD C,B
+        0x67,  # LD H,A
+    ], 5),
+    "memory": ([
+        0x26, 0x80,  # LD H,80h
+        0x2E, 0x10,  # LD L,10h
+        0x36, 0x55,  # LD (HL),55h
+        0x7E,  # LD A,(HL)
+        0x71,  # LD (HL),C
+        0x46,  # LD B,(HL)
+    ], 6),
+    "indexed": ([
+        0xDD, 0x26, 0x80,  # LD IXH,80h
+        0xFD, 0x2E, 0x20,  # LD IYL,20h
+        0xDD, 0x36, 0x01, 0x07,  # LD (IX+1),7
+        0xDD, 0x7E, 0x01,  # LD A,(IX+1)
+        0xFD, 0x36, 0xFE, 0x09,  # LD (IY-2),9
+        0xFD, 0x46, 0xFE,  # LD B,(IY-2)
+        0xDD, 0x70, 0x02,  # LD (IX+2),B
+        0xDD, 0x44,  # LD B,IXH
+    ], 8),
+}
+
+
+def _cosim(mem):
+    z80 = make_z80("pysim", include_z80fi=True)
+    z80.reset()
+    return CoSim(z80, mem)
+
+
+@pytest.mark.parametrize("mem_wait", [0, 2])
+@pytest.mark.parametrize("name", sorted(PROGRAMS))
+def test_program(name, mem_wait):
+    program, instructions = PROGRAMS[name]
+    mem = bytearray(65536)
+    mem[:len(program)] = bytes(program)
+    cosim = _cosim(Bus(mem, mem_wait=mem_wait))
+    assert cosim.run(instructions, 2000, idle=100) == instructions
+
+
+def test_nops():
+    cosim = _cosim(bytearray(65536))
+    assert cosim.run(10, 1000, idle=100) == 10
+
+
+def test_prefixed_start():
+    # The first instruction retired is LD (IX+1),7, whose regs_in.PC is
+    # past the DD.
+    mem = bytearray(65536)
+    mem[:4] = bytes([0xDD, 0x36, 0x01, 0x07])
+    cosim = _cosim(mem)
+    assert cosim.run(3, 1000, idle=100) == 3
+
+
+def test_stall():
+    mem = bytearray(65536)
+    mem[4] = 0xF0  # RET P, which the core doesn't implement.
+    cosim = _cosim(mem)
+    with pytest.raises(Stalled) as e:
+        cosim.run(10, 1000, idle=100)
+    assert e.value.retired == 4
+    assert cosim.edges < 2 * 1000
+
+
+def test_out_of_tstates():
+    cosim = _cosim(bytearray(65536))
+    assert cosim.run(10, 20, idle=100) < 10
@@ -0,0 +1,216 @@
+import ctypes
+import hashlib
+import os
+import subprocess
+import sys
+
+from ..flow.rtlil_cache import RTLILCache
+from .top import INPUTS, SimTop, Z80Bus, outputs
+
+YOSYS = os.environ.get("YOSYS", "yosys")
+YOSYS_CONFIG = os.environ.get("YOSYS_CONFIG", "yosys-config")
+CXX = os.environ.get("CXX", "c++")
+CXXFLAGS = os.environ.get("CXXFLAGS", "-O2").split()
+
+BUILD_DIR = os.environ.get("MZ80_CXXRTL_DIR", ".cxxrtl")
+
+
+def runtime_dir():
+    """Returns the include directory of the CXXRTL runtime shipped with
+    Yosys."""
+    datdir = subprocess.check_output([YOSYS_CONFIG, "--datdir"],
+                                     universal_newlines=True).strip()
+    return os.path.join(datdir, "include", "backends", "cxxrtl", "runtime")
+
+
+def sim_top_rtlil(include_z80fi=False, cache=None, core_options=None):
+    """Returns the RTLIL for SimTop, using the cache if given."""
+    if cache is None:
+        cache = RTLILCache()
+    core_options = core_options or {}
+    params = {
+        "top": "sim_top",
+        "include_z80fi": include_z80fi,
+        "core_options": sorted(core_options.items()),
+        "platform": None,
+    }
+
+    def build():
+        top = SimTop(include_z80fi=include_z80fi, **core_options)
+        return top, top.ports()
+
+    return cache.get(params, build, [sys.modules[SimTop.__module__]])
+
+
+def build(include_z80fi=False, build_dir=BUILD_DIR, cache=None,
+          core_options=None):
+    """Compiles SimTop into a shared library. Returns the library's path.
+
+    The library is named after a hash of its RTLIL, so it is only rebuilt
+    when the design changes. core_options are passed on to Z80.
+    """
+    il = sim_top_rtlil(include_z80fi=include_z80fi, cache=cache,
+                       core_options=core_options)
+    return compile_rtlil(il, build_dir)
+
+
+def compile_rtlil(il, build_dir=BUILD_DIR):
+    """Compiles the RTLIL of a design whose top module is "top" into a
+    shared library, as build() does for SimTop. Returns the library's
+    path."""
+    name = hashlib.sha256(il.encode()).hexdigest()[:16]
+    library = os.path.abspath(os.path.join(build_dir, name + ".so"))
+    if os.path.exists(library):
+        return library
+
+    os.makedirs(build_dir, exist_ok=True)
+    il_file = os.path.join(build_dir, name + ".il")
+    cc_file = os.path.join(build_dir, name + ".cc")
+    with open(il_file, "w") as f:
+        f.write(il)
+
+    # Flattening lets CXXRTL inline across what used to be module
+    # boundaries, which is most of the design.
+    subprocess.check_call([
+        YOSYS, "-q", "-p",
+        "read_rtlil {}; hierarchy -top top; proc; flatten; opt_clean; "
+        "write_cxxrtl {}".format(il_file, cc_file)
+    ])
+
+    tmp = "{}.{}.tmp".format(library, os.getpid())
+    subprocess.check_call([
+        CXX, "-std=c++14", "-shared", "-fPIC", "-DCXXRTL_INCLUDE_CAPI_IMPL",
+        "-I", runtime_dir()
+    ] + CXXFLAGS + [cc_file, "-o", tmp])
+    os.replace(tmp, library)
+    return library
+
+
+# Values of cxxrtl_object.type.
+CXXRTL_OUTLINE = 4
+
+
+class _CxxrtlObject(ctypes.Structure):
+    # The leading fields of struct cxxrtl_object in cxxrtl_capi.h. We only
+    # ever access it through a pointer, so the rest can be left out.
+    _fields_ = [
+        ("type", ctypes.c_uint32),
+        ("flags", ctypes.c_uint32),
+        ("width", ctypes.c_size_t),
+        ("lsb_at", ctypes.c_size_t),
+        ("depth", ctypes.c_size_t),
+        ("zero_at", ctypes.c_size_t),
+        ("curr", ctypes.POINTER(ctypes.c_uint32)),
+        ("next", ctypes.POINTER(ctypes.c_uint32)),
+        ("outline", ctypes.c_void_p),
+    ]
+
+
+class CompiledZ80(Z80Bus):
+    """Z80Bus on a CXXRTL-compiled model of SimTop.
+
+    Use build() to get a library. Pins are accessed through the CXXRTL C
+    API, so every access is a pointer dereference rather than a trip
+    through the Python simulator.
+
+    A library of some other top, such as MultiSimTop, can be loaded by
+    giving its pins as (inputs, outputs), in the form of INPUTS and
+    outputs().
+    """
+
+    def __init__(self, library=None, include_z80fi=False, core_options=None,
+                 pins=None):
+        if library is None:
+            library = build(include_z80fi=include_z80fi,
+                            core_options=core_options)
+        lib = self._lib = ctypes.CDLL(library)
+        lib.cxxrtl_design_create.restype = ctypes.c_void_p
+        lib.cxxrtl_create.restype = ctypes.c_void_p
+        lib.cxxrtl_create.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_destroy.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_eval.restype = ctypes.c_int
+        lib.cxxrtl_eval.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_commit.restype = ctypes.c_int
+        lib.cxxrtl_commit.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_outline_eval.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_get_parts.restype = ctypes.POINTER(_CxxrtlObject)
+        lib.cxxrtl_get_parts.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p,
+            ctypes.POINTER(ctypes.c_size_t)
+        ]
+
+        self._handle = lib.cxxrtl_create(lib.cxxrtl_design_create())
+        self._curr = {}
+        self._next = {}
+        # Outputs CXXRTL computes on demand rather than storing are only
+        # valid once their outline has been evaluated, after every settle.
+        self._outlines = set()
+        inputs, outs = pins or (INPUTS, outputs(include_z80fi))
+        for name in ["clk", "rst"] + [pin[0] for pin in inputs + outs]:
+            obj = self.object(name)
+            self._curr[name] = obj.curr
+            self._next[name] = obj.next
+
+        self.edges = 0
+        self._clk = 0
+        # Top-level inputs have no reset value in RTLIL, so drive them to
+        # their idle values explicitly.
+        for name, _, idle in inputs:
+            self._set(name, idle)
+        self._dirty = False
+        self._settle()
+
+    def object(self, name):
+        """Returns the CXXRTL object for a signal.
+
+        name is the hierarchical name with levels separated by spaces, e.g.
+        "A" or "z80 mcycler mcycle". If the object is an outline, it is kept
+        up to date from then on.
+        """
+        parts = ctypes.c_size_t()
+        obj = self._lib.cxxrtl_get_parts(self._handle, name.encode(),
+                                         ctypes.byref(parts))
+        if not obj:
+            raise KeyError(name)
+        if parts.value != 1:
+            raise ValueError("{} is split into {} parts".format(
+                name, parts.value))
+        if obj.contents.type == CXXRTL_OUTLINE:
+            self._outlines.add(obj.contents.outline)
+            self._lib.cxxrtl_outline_eval(obj.contents.outline)
+        return obj.contents
+
+    def close(self):
+        if self._handle is not None:
+            self._lib.cxxrtl_destroy(self._handle)
+            self._handle = None
+
+    def _settle(self):
+        """Runs deltas until a commit changes nothing, then evaluates the
+        outlines."""
+        # cxxrtl_step stops early when the design claims to converge in one
+        # eval, which leaves outputs computed from flops a delta behind.
+        while True:
+            self._lib.cxxrtl_eval(self._handle)
+            if not self._lib.cxxrtl_commit(self._handle):
+                break
+        for outline in self._outlines:
+            self._lib.cxxrtl_outline_eval(outline)
+
+    def edge(self):
+        # CXXRTL samples inputs as they were before the step, so let any
+        # inputs written since the last edge settle first.
+        if self._dirty:
+            self._settle()
+            self._dirty = False
+        self._clk ^= 1
+        self._next["clk"][0] = self._clk
+        self._settle()
+        self.edges += 1
+
+    def _get(self, name):
+        return self._curr[name][0]
+
+    def _set(self, name, value):
+        self._next[name][0] = value
+        self._dirty = True
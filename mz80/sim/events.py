@@ -0,0 +1,204 @@
+import argparse
+import queue
+import threading
+
+from ..core.muxing import MCycle
+from .memory import load_image
+from .refmodel import REG_NAMES, InstrState, Registers
+from .run import as_bus, make_z80
+from ..z80fi.z80fi import DEPTHS
+
+
+def _mcycle(value):
+    try:
+        return MCycle(value)
+    except ValueError:
+        return value
+
+
+def _num(f, name):
+    # num counts one past what's held when there were too many to hold.
+    return min(f(name + "__num"), DEPTHS[name])
+
+
+def _accesses(f, name):
+    return [(f("{}__addr{}".format(name, i)), f("{}__data{}".format(name, i)))
+            for i in range(_num(f, name))]
+
+
+def read_instr_state(z80):
+    """Reads the RTL's Z80fiInstrState snapshot into an InstrState."""
+    f = z80.z80fi
+    st = InstrState(f("instr"), f("useIX"), f("useIY"),
+                    Registers(**{n: f("regs_in__" + n) for n in REG_NAMES}))
+    st.regs_out = Registers(**{n: f("regs_out__" + n) for n in REG_NAMES})
+    st.operands = [
+        f("operands__data{}".format(i)) for i in range(_num(f, "operands"))
+    ]
+    st.memrds = _accesses(f, "memrds")
+    st.memwrs = _accesses(f, "memwrs")
+    st.iords = _accesses(f, "iords")
+    st.iowrs = _accesses(f, "iowrs")
+    st.mcycles = [(_mcycle(f("mcycles__type{}".format(i))),
+                   f("mcycles__tcycles{}".format(i)))
+                  for i in range(1, _num(f, "mcycles") + 1)]
+    return st
+
+
+class Retired(object):
+    """An instruction retired. state is its InstrState, index counts
+    retirements from 0, and edge is the edge its snapshot became valid on.
+    """
+    __slots__ = ("edge", "index", "state")
+
+    def __init__(self, edge, index, state):
+        self.edge = edge
+        self.index = index
+        self.state = state
+
+    def __repr__(self):
+        return "Retired(edge={}, index={}, {!r})".format(
+            self.edge, self.index, self.state)
+
+
+class MCycleDone(object):
+    """An M-cycle finished. edge is the edge it started on, type its
+    MCycle, and tstates how many T-states it took."""
+    __slots__ = ("edge", "type", "tstates")
+
+    def __init__(self, edge, type, tstates):
+        self.edge = edge
+        self.type = type
+        self.tstates = tstates
+
+    def __repr__(self):
+        return "MCycleDone(edge={}, type={}, tstates={})".format(
+            self.edge, self.type, self.tstates)
+
+
+class EventStream(object):
+    """Runs a Z80Bus against mem, a Bus or a 64K bytearray, and turns what
+    it sees into events.
+
+    Retired events are derived from the z80fi snapshot, so need a Z80Bus
+    built with include_z80fi. They fire when valid rises, which is when
+    Z80fiInstrState has latched regs_out. The snapshot taken at the very
+    first fetch after reset doesn't describe any instruction, and is
+    skipped.
+
+    MCycleDone events come from the mcycle and tcycle probes, and work on
+    any Z80Bus.
+
+    Only the signals needed for the requested kinds of event are read on
+    each edge; the z80fi snapshot is only read out when valid rises.
+    """
+
+    def __init__(self, z80, mem, retirements=True, mcycles=False,
+                 on_write=None):
+        self.z80 = z80
+        self.bus = as_bus(mem, on_write)
+        self.retirements = retirements
+        self.mcycles = mcycles
+        self.edges = 0
+        self.retired = 0
+
+    def events(self, tstates, idle=None):
+        """Yields events for at most a number of T-states. Stop consuming
+        to stop the simulation early. If idle is given, also stops once that
+        many T-states go by without an event, since a core that has hung
+        may never produce another."""
+        z80 = self.z80
+        serve = self.bus.serve
+        retirements = self.retirements
+        mcycles = self.mcycles
+
+        last_valid = 0
+        first = True
+        cycle_type = None
+        cycle_start = 0
+        last_tcycle = 0
+        last_event = self.edges
+
+        for _ in range(2 * tstates):
+            serve(z80)
+            z80.edge()
+            edge = self.edges
+            self.edges += 1
+            if idle is not None and edge - last_event >= 2 * idle:
+                return
+
+            if mcycles:
+                tcycle = z80.tcycle
+                mcycle = z80.mcycle
+                if tcycle == 0 or mcycle != cycle_type or (
+                        tcycle == 1 and last_tcycle != 1):
+                    if cycle_type is not None:
+                        last_event = edge
+                        yield MCycleDone(cycle_start, _mcycle(cycle_type),
+                                         (edge - cycle_start) // 2)
+                    cycle_type = mcycle if tcycle != 0 else None
+                    cycle_start = edge
+                last_tcycle = tcycle
+
+            if retirements:
+                valid = z80.z80fi("valid")
+                if valid and not last_valid:
+                    if first:
+                        first = False
+                    else:
+                        last_event = edge
+                        yield Retired(edge, self.retired,
+                                      read_instr_state(z80))
+                        self.retired += 1
+                last_valid = valid
+
+    def run(self, tstates, callback):
+        """Calls callback(event) for every event, for at most a number of
+        T-states. The callback can return True to stop early. Returns the
+        number of events delivered."""
+        count = 0
+        for event in self.events(tstates):
+            count += 1
+            if callback(event):
+                break
+        return count
+
+    def start(self, tstates, maxsize=1024):
+        """Runs the simulation on a background thread, putting events on a
+        queue.Queue, which is returned. None is put on the queue when the
+        run is over.
+
+        A bounded queue keeps the simulation from running far ahead of a
+        slow consumer.
+        """
+        events = queue.Queue(maxsize)
+
+        def produce():
+            try:
+                for event in self.events(tstates):
+                    events.put(event)
+            finally:
+                events.put(None)
+
+        threading.Thread(target=produce, daemon=True).start()
+        return events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print the instructions a Z80 binary retires, and "
+        "optionally its M-cycles.")
+    parser.add_argument("image", help=".bin, .com or .hex image")
+    parser.add_argument("--backend", choices=["pysim", "cxxrtl"],
+                        default="cxxrtl")
+    parser.add_argument("--tstates", type=int, default=1000)
+    parser.add_argument("--mcycles", action="store_true",
+                        help="also print M-cycles")
+    args = parser.parse_args()
+
+    mem = load_image(args.image)
+
+    z80 = make_z80(args.backend, include_z80fi=True)
+    z80.reset()
+    stream = EventStream(z80, mem, mcycles=args.mcycles)
+    stream.run(args.tstates, print)
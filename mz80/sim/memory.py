@@ -0,0 +1,188 @@
+import mmap
+import os
+
+MEM_SIZE = 0x10000
+
+# Where each kind of image is loaded by default. CP/M .com files run at
+# 0x100; .hex files carry their own addresses.
+LOAD_ADDRS = {
+    ".bin": 0x0000,
+    ".com": 0x0100,
+}
+
+
+def read_hex(f):
+    """Yields (addr, data) for every data record of an Intel HEX file."""
+    base = 0
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise ValueError("Line {}: not an Intel HEX record".format(lineno))
+        record = bytes.fromhex(line[1:])
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError("Line {}: bad record length".format(lineno))
+        if sum(record) & 0xFF:
+            raise ValueError("Line {}: bad checksum".format(lineno))
+        count, addr, kind = record[0], (record[1] << 8) | record[2], record[3]
+        data = record[4:4 + count]
+        if kind == 0x00:
+            yield base + addr, data
+        elif kind == 0x01:
+            return
+        elif kind == 0x02:
+            base = ((data[0] << 8) | data[1]) << 4
+        elif kind == 0x04:
+            base = ((data[0] << 8) | data[1]) << 16
+        # 0x03 and 0x05 are start addresses, which don't matter here.
+
+
+def load_image(path, mem=None, addr=None):
+    """Loads a .bin, .com or .hex image into mem, a 64K bytearray, which is
+    created if not given. Returns mem.
+
+    Binary images are copied in with a single slice assignment, at addr or
+    their default load address.
+    """
+    if mem is None:
+        mem = bytearray(MEM_SIZE)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".hex":
+        with open(path) as f:
+            for record_addr, data in read_hex(f):
+                start = record_addr if addr is None else addr + record_addr
+                if start + len(data) > len(mem):
+                    raise ValueError("{}: data at 0x{:X} is outside memory"
+                                     .format(path, start))
+                mem[start:start + len(data)] = data
+        return mem
+
+    start = LOAD_ADDRS.get(ext, 0) if addr is None else addr
+    with open(path, "rb") as f:
+        image = f.read(len(mem) - start + 1)
+    if start + len(image) > len(mem):
+        raise ValueError("{}: image doesn't fit in memory at 0x{:X}".format(
+            path, start))
+    mem[start:start + len(image)] = image
+    return mem
+
+
+def map_image(path):
+    """Maps a 64K memory dump copy-on-write. Writes go to private pages and
+    never reach the file. Nothing is read until it's touched, so this is
+    the cheapest way to start from a full memory image."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size != MEM_SIZE:
+            raise ValueError("{}: only 64K images can be mapped".format(path))
+        return mmap.mmap(f.fileno(), MEM_SIZE, access=mmap.ACCESS_COPY)
+
+
+class IODevice(object):
+    """A device on the I/O bus. addr is the full 16-bit address on A."""
+
+    def read(self, addr):
+        return 0xFF
+
+    def write(self, addr, data):
+        pass
+
+
+class Latch(IODevice):
+    """A port that reads back whatever was last written to it."""
+
+    def __init__(self, value=0xFF):
+        self.value = value
+
+    def read(self, addr):
+        return self.value
+
+    def write(self, addr, data):
+        self.value = data
+
+
+class Console(IODevice):
+    """An output-only port that collects the bytes written to it."""
+
+    def __init__(self):
+        self.output = bytearray()
+
+    def write(self, addr, data):
+        self.output.append(data)
+
+
+class Bus(object):
+    """Answers memory and I/O cycles for a Z80Bus.
+
+    Call serve(z80) before every edge. Memory is mem, a 64K bytearray or
+    anything indexable like one, such as a map_image(). I/O devices are
+    looked up by the low byte of the address, as on most Z80 systems;
+    unmapped ports read as 0xFF.
+
+    mem_wait and io_wait are the number of wait states to add to each
+    memory and I/O cycle, by holding nWAIT low. The I/O cycle's own
+    automatic wait state is not counted. Each read or write is delivered
+    once per cycle, however long the cycle is, so devices with side
+    effects see exactly one access.
+    """
+
+    def __init__(self, mem=None, devices=None, mem_wait=0, io_wait=0,
+                 on_write=None):
+        self.mem = mem if mem is not None else bytearray(MEM_SIZE)
+        self.devices = dict(devices or {})
+        self.mem_wait = mem_wait
+        self.io_wait = io_wait
+        self.on_write = on_write
+        self._active = False
+        self._done = False
+        self._waits = 0
+        self._waiting = False
+
+    def serve(self, z80):
+        mreq = not z80.nMREQ
+        if not mreq and z80.nIORQ:
+            self._active = False
+            if self._waiting:
+                self._waiting = False
+                z80.nWAIT = 1
+            return
+
+        # Memory cycles show MREQ from the middle of T1, I/O cycles show
+        # IORQ from T2. MREQ in T3 of an M1 cycle is a refresh, which
+        # takes no wait states.
+        if not self._active and z80.tcycle <= 2:
+            self._active = True
+            self._done = False
+            # nWAIT is sampled on every falling edge from T2 on. An I/O
+            # cycle ignores the one in T2, since it waits anyway.
+            self._waits = (self.mem_wait if mreq else
+                           self.io_wait + 1 if self.io_wait else 0)
+
+        if z80.edges & 1:
+            # The next edge is a falling one, which samples nWAIT.
+            waiting = self._waits > 0
+            if waiting:
+                self._waits -= 1
+            if waiting != self._waiting:
+                self._waiting = waiting
+                z80.nWAIT = 0 if waiting else 1
+
+        if self._done or not self._active:
+            return
+        if not z80.nRD:
+            self._done = True
+            if mreq:
+                z80.Din = self.mem[z80.A]
+            else:
+                device = self.devices.get(z80.A & 0xFF)
+                z80.Din = device.read(z80.A) if device is not None else 0xFF
+        elif not z80.nWR:
+            self._done = True
+            if mreq:
+                self.mem[z80.A] = z80.Dout
+                if self.on_write is not None:
+                    self.on_write(z80.A, z80.Dout)
+            else:
+                device = self.devices.get(z80.A & 0xFF)
+                if device is not None:
+                    device.write(z80.A, z80.Dout)
@@ -0,0 +1,250 @@
+import argparse
+import json
+import sys
+import time
+
+from nmigen import *
+from nmigen.utils import bits_for
+
+from ..core.multicore import BUS_OUTPUTS, MultiZ80
+from ..flow.rtlil_cache import RTLILCache
+from ..flow.synth import parse_option
+from .bench import PROGRAMS
+from .memory import Bus
+from .top import INPUTS, OUTPUTS, PROBES, Z80Bus
+
+
+def prefix(core):
+    """Returns the prefix of a core's pins in MultiSimTop, e.g. "c0__"."""
+    return "c{}__".format(core)
+
+
+def pins(cores=2, shared_bus=False):
+    """Returns MultiSimTop's pins as (inputs, outputs), in the form of
+    INPUTS and OUTPUTS, without elaborating anything."""
+    if shared_bus:
+        inputs = [pin for pin in INPUTS if pin[0] in ("Din", "nWAIT")] + [
+            (prefix(i) + "nINTRQ", 1, 1) for i in range(cores)
+        ]
+        outputs = [pin for pin in OUTPUTS if pin[0] in BUS_OUTPUTS]
+        outputs += PROBES + [("owner", bits_for(cores - 1))]
+        outputs += [(prefix(i) + name, 1) for i in range(cores)
+                    for name in ("nM1", "nBUSAK")]
+    else:
+        inputs = [(prefix(i) + name, width, idle) for i in range(cores)
+                  for name, width, idle in INPUTS]
+        outputs = [(prefix(i) + name, width) for i in range(cores)
+                   for name, width in OUTPUTS + PROBES]
+    return inputs, outputs
+
+
+class MultiSimTop(Elaboratable):
+    """MultiZ80 with its clock domains, for simulation.
+
+    Like SimTop, every pin gets an explicitly named top-level signal. The
+    pins of core N are named after the SimTop pins, prefixed with "cN__".
+    With shared_bus, the bus pins, mcycle and tcycle are unprefixed, and
+    are the owner's. Each core then only has its nINTRQ, nM1 and nBUSAK
+    brought out, and owner tells which core has the bus.
+
+    Any other keyword arguments are passed on to MultiZ80.
+    """
+
+    def __init__(self, cores=2, shared_bus=False, split_clocks=False,
+                 **options):
+        self.clk = Signal(name="clk")
+        self.clk_neg = Signal(name="clk_neg") if split_clocks else self.clk
+        self.rst = Signal(name="rst")
+        self.multi = MultiZ80(cores=cores, shared_bus=shared_bus, **options)
+        # (name, width, idle value) for every input, (name, width) for every
+        # output.
+        self.inputs, self.outputs = pins(cores, shared_bus)
+
+        for name, width, idle in self.inputs:
+            setattr(self, name, Signal(width, name=name, reset=idle))
+        for name, width in self.outputs:
+            setattr(self, name, Signal(width, name=name))
+        # (name, signal) for every output, in outputs order.
+        self.output_signals = [(name, getattr(self, name))
+                               for name, _ in self.outputs]
+
+    def ports(self):
+        return [self.clk, self.rst] + [
+            getattr(self, name) for name, _, _ in self.inputs
+        ] + [signal for _, signal in self.output_signals]
+
+    def _pin(self, name):
+        """Returns the signal in MultiZ80 behind a pin."""
+        core, _, pin = name.rpartition("__")
+        if not core:
+            return getattr(self.multi, pin)
+        z80 = self.multi.cores[int(core[1:])]
+        if pin in (name for name, _ in PROBES):
+            return getattr(z80.mcycler, pin)
+        return getattr(z80, pin)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pos = ClockDomain("pos")
+        pos.clk = self.clk
+        pos.rst = self.rst
+
+        neg = ClockDomain("neg", clk_edge="neg")
+        neg.clk = self.clk_neg
+        neg.rst = self.rst
+
+        m.domains.pos = pos
+        m.domains.neg = neg
+
+        m.submodules.multi = self.multi
+        for name, _, _ in self.inputs:
+            m.d.comb += self._pin(name).eq(getattr(self, name))
+        for name, _ in self.outputs:
+            m.d.comb += getattr(self, name).eq(self._pin(name))
+
+        return m
+
+
+class CoreBus(Z80Bus):
+    """The pins of one core of a multi-core simulation, as a Z80Bus, so
+    that a Bus can serve it. With a shared bus, use an empty prefix for the
+    bus itself.
+
+    Edges are for the whole simulation, so they're made by sim, not here.
+    """
+
+    def __init__(self, sim, prefix):
+        self.sim = sim
+        self.prefix = prefix
+
+    @property
+    def edges(self):
+        return self.sim.edges
+
+    def _get(self, name):
+        return self.sim._get(self.prefix + name)
+
+    def _set(self, name, value):
+        self.sim._set(self.prefix + name, value)
+
+
+def make_multi(backend, cores=2, shared_bus=False, **options):
+    """Returns a simulation of MultiSimTop on the named backend ("pysim" or
+    "cxxrtl"). Reset and clock it like any Z80Bus; its pins are only
+    reachable through CoreBus views. options are passed on to MultiZ80."""
+    if backend == "pysim":
+        if shared_bus:
+            raise ValueError("pysim can't clock the per-core domains of a "
+                             "shared bus, use cxxrtl")
+        from .pysim_z80 import PysimZ80
+        return PysimZ80(MultiSimTop(cores=cores, shared_bus=shared_bus,
+                                    split_clocks=True, **options))
+    if backend == "cxxrtl":
+        from .cxxrtl import CompiledZ80, compile_rtlil
+        params = {
+            "top": "multi_sim_top",
+            "cores": cores,
+            "shared_bus": shared_bus,
+            "options": sorted(options.items()),
+            "platform": None,
+        }
+
+        def build():
+            top = MultiSimTop(cores=cores, shared_bus=shared_bus, **options)
+            return top, top.ports()
+
+        il = RTLILCache().get(params, build, [sys.modules[__name__]])
+        return CompiledZ80(compile_rtlil(il),
+                           pins=pins(cores, shared_bus))
+    raise ValueError("Unknown backend {}".format(backend))
+
+
+def run_multi(sim, cores, mems, tstates, shared_bus=False):
+    """Runs a multi-core simulation for a number of T-states.
+
+    mems is a Bus, or a 64K bytearray holding the program, per core, or a
+    single one with shared_bus. Returns the number of M1 cycles each core
+    started, prefixes included.
+    """
+    if shared_bus:
+        views = [CoreBus(sim, "")]
+    else:
+        views = [CoreBus(sim, prefix(i)) for i in range(cores)]
+    buses = [mem if isinstance(mem, Bus) else Bus(mem) for mem in mems]
+    serves = [(bus.serve, view) for bus, view in zip(buses, views)]
+    m1_pins = [prefix(i) + "nM1" for i in range(cores)]
+
+    fetches = [0] * cores
+    last = [1] * cores
+    for _ in range(2 * tstates):
+        for serve, view in serves:
+            serve(view)
+        sim.edge()
+        for i, pin in enumerate(m1_pins):
+            nM1 = sim._get(pin)
+            if last[i] and not nM1:
+                fetches[i] += 1
+            last[i] = nM1
+    return fetches
+
+
+def throughput(backend, cores, program, tstates, shared_bus=False,
+               **options):
+    """Runs a program from PROGRAMS on every core, each with its own copy
+    of memory unless the bus is shared. Returns the results as a JSON-able
+    dict."""
+    sim = make_multi(backend, cores=cores, shared_bus=shared_bus, **options)
+    sim.reset()
+    if shared_bus:
+        mems = [bytearray(PROGRAMS[program])]
+    else:
+        mems = [bytearray(PROGRAMS[program]) for _ in range(cores)]
+    start = time.perf_counter()
+    fetches = run_multi(sim, cores, mems, tstates, shared_bus)
+    elapsed = time.perf_counter() - start
+    if hasattr(sim, "close"):
+        sim.close()
+    return {
+        "backend": backend,
+        "cores": cores,
+        "shared_bus": shared_bus,
+        "options": options,
+        "program": program,
+        "tstates": tstates,
+        "seconds": elapsed,
+        "tstates_per_s": tstates / elapsed,
+        "per_core": [{
+            "m1_cycles": n,
+            "m1_per_tstate": n / tstates,
+            "m1_per_s": n / elapsed,
+        } for n in fetches],
+        "m1_per_s": sum(fetches) / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a program on several cores in one simulation, and "
+        "report the throughput of each, as JSON.")
+    parser.add_argument("--backend", choices=["pysim", "cxxrtl"],
+                        default="cxxrtl")
+    parser.add_argument("--cores", type=int, default=2)
+    parser.add_argument("--shared-bus", action="store_true",
+                        help="share one bus and memory between the cores")
+    parser.add_argument("--quantum", type=int, default=64,
+                        help="T-states each core keeps a shared bus for "
+                        "(default: %(default)s)")
+    parser.add_argument("--program", choices=list(PROGRAMS), default="nop")
+    parser.add_argument("--tstates", type=int, default=100000)
+    parser.add_argument("--option", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="core option, e.g. microcoded=True")
+    args = parser.parse_args()
+
+    options = dict(parse_option(option) for option in args.option)
+    if args.shared_bus:
+        options["quantum"] = args.quantum
+    results = throughput(args.backend, args.cores, args.program, args.tstates,
+                         shared_bus=args.shared_bus, **options)
+    print(json.dumps(results, indent=2, sort_keys=True))
@@ -0,0 +1,74 @@
+import contextlib
+
+from nmigen import *
+from nmigen.hdl.ast import *
+from nmigen.back import pysim
+
+from .top import SimTop, Z80Bus
+
+
+class PysimZ80(Z80Bus):
+    """Z80Bus on nMigen's Python simulator.
+
+    pysim is driven by generator processes, so a single driver process
+    applies the harness' writes, toggles the clock and samples the outputs
+    once per edge. Slow, but needs nothing beyond nMigen and can write VCDs.
+
+    top is a SimTop, or anything with the same clk, clk_neg, rst, inputs
+    and output_signals attributes.
+    """
+
+    def __init__(self, top=None, period=1e-9, vcd_file=None, gtkw_file=None,
+                 traces=()):
+        self.top = top if top is not None else SimTop(split_clocks=True)
+        self.period = period
+        self.edges = 0
+        self._pending = {}
+        self._values = {name: 0 for name, _ in self.top.output_signals}
+        self._values.update({name: idle for name, _, idle in self.top.inputs})
+        self._values["rst"] = 0
+
+        # The simulator is a context manager that has to stay open between
+        # edges, and is only closed (writing out any VCD) by close().
+        self._context = contextlib.ExitStack()
+        self._sim = self._context.enter_context(pysim.Simulator(
+            self.top, vcd_file=vcd_file, gtkw_file=gtkw_file, traces=traces))
+        self._sim.add_process(self._driver())
+
+    def close(self):
+        self._context.close()
+
+    def _driver(self):
+        clk = 0
+        while True:
+            # Each edge() resumes the driver here, after the harness has
+            # made its writes. They're applied a little before the clock
+            # moves, otherwise flops would still see the old values.
+            yield Delay(self.period / 8)
+            for name, value in self._pending.items():
+                yield getattr(self.top, name).eq(value)
+            self._pending.clear()
+            yield Delay(self.period / 8)
+
+            clk ^= 1
+            yield self.top.clk.eq(clk)
+            if self.top.clk_neg is not self.top.clk:
+                yield self.top.clk_neg.eq(clk)
+            yield Delay(self.period / 4)
+
+            for name, signal in self.top.output_signals:
+                self._values[name] = yield signal
+            self.edges += 1
+
+    def edge(self):
+        # The driver moves the clock a quarter period into each edge, and
+        # samples the outputs at its end. Running up to a time in between
+        # stops right after the samples, before the next writes are applied.
+        self._sim.run_until((self.edges + 0.75) * self.period / 2)
+
+    def _get(self, name):
+        return self._values[name]
+
+    def _set(self, name, value):
+        self._values[name] = value
+        self._pending[name] = value
@@ -0,0 +1,333 @@
+import argparse
+import time
+
+from ..core.muxing import MCycle
+from ..z80fi.z80fi import RegRecordLayout
+from .memory import load_image
+
+# Register names, in Z80fiState.regs_in/regs_out order.
+REG_NAMES = list(RegRecordLayout().fields)
+
+# Index into the decode table: no prefix, DD (IX) or FD (IY).
+NO_INDEX = 0
+INDEX_IX = 1
+INDEX_IY = 2
+
+
+class UnimplementedInstruction(Exception):
+    pass
+
+
+class Registers(object):
+    """Python counterpart of RegRecordLayout."""
+    __slots__ = REG_NAMES
+
+    def __init__(self, **values):
+        for name in REG_NAMES:
+            setattr(self, name, values.pop(name, 0))
+        if values:
+            raise TypeError("Unknown registers {}".format(sorted(values)))
+
+    def copy(self):
+        regs = Registers.__new__(Registers)
+        for name in REG_NAMES:
+            setattr(regs, name, getattr(self, name))
+        return regs
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in REG_NAMES}
+
+    def __eq__(self, other):
+        return isinstance(other, Registers) and all(
+            getattr(self, name) == getattr(other, name) for name in REG_NAMES)
+
+    def __repr__(self):
+        return "Registers({})".format(", ".join(
+            "{}=0x{:X}".format(name, getattr(self, name))
+            for name in REG_NAMES))
+
+
+class InstrState(object):
+    """Python counterpart of Z80fiState: everything observed while
+    executing one instruction.
+
+    operands is a list of operand bytes. memrds, memwrs, iords and iowrs are
+    lists of (addr, data). mcycles is a list of (MCycle, tcycles). As with
+    Z80fiInstrState, prefixes are not counted: instr is the opcode after
+    any DD/FD prefix, and regs_in.PC is its address.
+    """
+    __slots__ = ("valid", "instr", "useIX", "useIY", "operands", "regs_in",
+                 "regs_out", "memrds", "memwrs", "iords", "iowrs", "mcycles")
+
+    def __init__(self, instr, useIX, useIY, regs_in):
+        self.valid = 1
+        self.instr = instr
+        self.useIX = useIX
+        self.useIY = useIY
+        self.operands = []
+        self.regs_in = regs_in
+        self.regs_out = None
+        self.memrds = []
+        self.memwrs = []
+        self.iords = []
+        self.iowrs = []
+        self.mcycles = [(MCycle.M1, 4)]
+
+    def __repr__(self):
+        return "InstrState(instr=0x{:02X}, useIX={}, useIY={}, {})".format(
+            self.instr, self.useIX, self.useIY, ", ".join(
+                "{}={!r}".format(name, getattr(self, name))
+                for name in self.__slots__[4:]))
+
+
+# Getters and setters for the 8-bit registers encoded in the r field of an
+# opcode, for each index mode. As in regs_in_r/regs_out_r, H and L become
+# the halves of IX or IY under a prefix. r=6 is never a register.
+def _getter(name):
+    return lambda regs: getattr(regs, name)
+
+
+def _setter(name):
+    return lambda regs, v: setattr(regs, name, v)
+
+
+def _index_high_getter(name):
+    return lambda regs: getattr(regs, name) >> 8
+
+
+def _index_low_getter(name):
+    return lambda regs: getattr(regs, name) & 0xFF
+
+
+def _index_high_setter(name):
+    return lambda regs, v: setattr(regs, name,
+                                   (getattr(regs, name) & 0x00FF) | (v << 8))
+
+
+def _index_low_setter(name):
+    return lambda regs, v: setattr(regs, name,
+                                   (getattr(regs, name) & 0xFF00) | v)
+
+
+def _r_accessors(ss):
+    names = ["B1", "C1", "D1", "E1", "H1", "L1", None, "A1"]
+    get = [None if n is None else _getter(n) for n in names]
+    set = [None if n is None else _setter(n) for n in names]
+    if ss != NO_INDEX:
+        index = "IX" if ss == INDEX_IX else "IY"
+        get[4], get[5] = _index_high_getter(index), _index_low_getter(index)
+        set[4], set[5] = _index_high_setter(index), _index_low_setter(index)
+    return get, set
+
+
+def _sext(d):
+    return d - 0x100 if d & 0x80 else d
+
+
+class RefZ80(object):
+    """Instruction-level reference model of the Z80.
+
+    Executes one instruction per step() and returns its InstrState, computed
+    as the insn_spec modules specify it. Decoding is a lookup into a table of
+    handlers, built once per index mode, so the per-instruction cost is a
+    couple of list indexings and a call.
+
+    mem is a 64K bytearray, regs a Registers.
+    """
+
+    def __init__(self, mem=None, regs=None):
+        self.mem = mem if mem is not None else bytearray(0x10000)
+        self.regs = regs if regs is not None else Registers()
+        self.halted = False
+
+    def step(self):
+        """Executes the instruction at PC. Returns its InstrState."""
+        mem = self.mem
+        regs = self.regs
+        ss = NO_INDEX
+        op = mem[regs.PC]
+        # Prefixes are M1 cycles of their own, and aren't part of the
+        # instruction as far as z80fi is concerned. The last one wins.
+        while op == 0xDD or op == 0xFD:
+            ss = INDEX_IX if op == 0xDD else INDEX_IY
+            regs.PC = (regs.PC + 1) & 0xFFFF
+            op = mem[regs.PC]
+
+        st = InstrState(op, int(ss == INDEX_IX), int(ss == INDEX_IY),
+                        regs.copy())
+        handler = _DECODE[ss][op]
+        if handler is None:
+            raise UnimplementedInstruction(
+                "Opcode 0x{:02X} at 0x{:04X}".format(op, regs.PC))
+        handler(self, st)
+        st.regs_out = regs.copy()
+        return st
+
+    def run(self, count):
+        """Executes up to count instructions, stopping early on HALT.
+        Returns the number of instructions executed."""
+        step = self.step
+        for n in range(count):
+            step()
+            if self.halted:
+                return n + 1
+        return count
+
+    # Helpers for handlers. Each also records what it did in st.
+
+    def _operand(self, st):
+        regs = self.regs
+        regs.PC = (regs.PC + 1) & 0xFFFF
+        data = self.mem[regs.PC]
+        st.operands.append(data)
+        st.mcycles.append((MCycle.MEMRD, 3))
+        return data
+
+    def _read(self, st, addr):
+        data = self.mem[addr]
+        st.memrds.append((addr, data))
+        st.mcycles.append((MCycle.MEMRD, 3))
+        return data
+
+    def _write(self, st, addr, data):
+        self.mem[addr] = data
+        st.memwrs.append((addr, data))
+        st.mcycles.append((MCycle.MEMWR, 3))
+
+    def _next(self):
+        regs = self.regs
+        regs.PC = (regs.PC + 1) & 0xFFFF
+
+    def _index_addr(self, st, index, d):
+        addr = (getattr(self.regs, index) + _sext(d)) & 0xFFFF
+        self.regs.W1 = addr >> 8
+        self.regs.Z1 = addr & 0xFF
+        return addr
+
+
+def _hl(regs):
+    return (regs.H1 << 8) | regs.L1
+
+
+def _nop(model, st):
+    model._next()
+
+
+def _halt(model, st):
+    # HALT re-executes M1 until an interrupt; z80fi sees the first two.
+    st.mcycles.append((MCycle.M1, 4))
+    model.halted = True
+    model._next()
+
+
+def _ld_r_r(get_src, set_dst):
+    def handler(model, st):
+        set_dst(model.regs, get_src(model.regs))
+        model._next()
+    return handler
+
+
+def _ld_r_hl(set_dst):
+    def handler(model, st):
+        set_dst(model.regs, model._read(st, _hl(model.regs)))
+        model._next()
+    return handler
+
+
+def _ld_hl_r(get_src):
+    def handler(model, st):
+        model._write(st, _hl(model.regs), get_src(model.regs))
+        model._next()
+    return handler
+
+
+def _ld_r_index(index, set_dst):
+    def handler(model, st):
+        addr = model._index_addr(st, index, model._operand(st))
+        st.mcycles.append((MCycle.INTERNAL, 5))
+        set_dst(model.regs, model._read(st, addr))
+        model._next()
+    return handler
+
+
+def _ld_index_r(index, get_src):
+    def handler(model, st):
+        addr = model._index_addr(st, index, model._operand(st))
+        st.mcycles.append((MCycle.INTERNAL, 5))
+        model._write(st, addr, get_src(model.regs))
+        model._next()
+    return handler
+
+
+def _ld_r_n(set_dst):
+    def handler(model, st):
+        set_dst(model.regs, model._operand(st))
+        model._next()
+    return handler
+
+
+def _ld_hl_n(model, st):
+    n = model._operand(st)
+    model._write(st, _hl(model.regs), n)
+    model._next()
+
+
+def _ld_index_n(index):
+    def handler(model, st):
+        addr = model._index_addr(st, index, model._operand(st))
+        n = model._operand(st)
+        # The address is computed during the second operand read.
+        st.mcycles[-1] = (MCycle.MEMRD, 5)
+        model._write(st, addr, n)
+        model._next()
+    return handler
+
+
+def _decode_table(ss):
+    table = [None] * 256
+    get, set = _r_accessors(ss)
+    index = {INDEX_IX: "IX", INDEX_IY: "IY"}.get(ss)
+
+    table[0x00] = _nop
+    for op in range(0x40, 0x80):
+        dst, src = (op >> 3) & 7, op & 7
+        if dst == 6 and src == 6:
+            table[op] = _halt
+        elif dst != 6 and src != 6:
+            table[op] = _ld_r_r(get[src], set[dst])
+        elif index is None:
+            table[op] = (_ld_r_hl(set[dst]) if src == 6 else
+                         _ld_hl_r(get[src]))
+        else:
+            table[op] = (_ld_r_index(index, set[dst]) if src == 6 else
+                         _ld_index_r(index, get[src]))
+    for r in range(8):
+        op = 0x06 | (r << 3)
+        if r != 6:
+            table[op] = _ld_r_n(set[r])
+        elif index is None:
+            table[op] = _ld_hl_n
+        else:
+            table[op] = _ld_index_n(index)
+    return table
+
+
+_DECODE = [_decode_table(ss) for ss in (NO_INDEX, INDEX_IX, INDEX_IY)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a Z80 binary on the reference model.")
+    parser.add_argument("image", help=".bin, .com or .hex image")
+    parser.add_argument("--count", type=int, default=1000000,
+                        help="instructions to run (default: %(default)s)")
+    args = parser.parse_args()
+
+    mem = load_image(args.image)
+
+    model = RefZ80(mem)
+    start = time.monotonic()
+    count = model.run(args.count)
+    elapsed = time.monotonic() - start
+    print("{} instructions in {:.2f}s ({:.0f} instructions/s)".format(
+        count, elapsed, count / elapsed))
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from mz80.core.decode import matches
+from mz80.insn_spec.depth import INDEXING
+from mz80.insn_spec.formal_sweep import discover_specs
+from mz80.insn_spec.formal_test import spec_checks, spec_class
+from mz80.insn_spec.simulate import SpecSimulator
+from mz80.sim.refmodel import REG_NAMES, RefZ80, Registers
+
+# Random machine states each opcode is run from.
+STATES = 4
+
+
+def _inputs(actual, st):
+    """Returns an InstrState as (signal, value) for a spec's actual
+    state."""
+    values = [
+        (actual.valid, 1),
+        (actual.instr, st.instr),
+        (actual.useIX, st.useIX),
+        (actual.useIY, st.useIY),
+    ]
+    for name in REG_NAMES:
+        values.append((actual.regs_in[name], getattr(st.regs_in, name)))
+        values.append((actual.regs_out[name], getattr(st.regs_out, name)))
+
+    def held(name, items):
+        depth = actual.depths[name]
+        assert len(items) <= depth, "{} {} held".format(len(items), name)
+        values.append((actual[name].num, len(items)))
+        return enumerate(items)
+
+    for i, data in held("operands", st.operands):
+        values.append((actual.operands["data{}".format(i)], data))
+    for name in ("memrds", "memwrs", "iords", "iowrs"):
+        for i, (addr, data) in held(name, getattr(st, name)):
+            values.append((actual[name]["addr{}".format(i)], addr))
+            values.append((actual[name]["data{}".format(i)], data))
+    for i, (mcycle, tcycles) in held("mcycles", st.mcycles):
+        values.append((actual.mcycles["type{}".format(i + 1)], mcycle.value))
+        values.append((actual.mcycles["tcycles{}".format(i + 1)], tcycles))
+    return values
+
+
+def _step(rand, prefix, opcode):
+    """Runs one instruction from a random machine state. Returns its
+    InstrState."""
+    mem = bytearray(rand.getrandbits(8 * 0x10000).to_bytes(0x10000, "little"))
+    regs = Registers(**{
+        name: rand.getrandbits(16 if name in ("IX", "IY", "SP", "PC") else 8)
+        for name in REG_NAMES
+    })
+    code = prefix + [opcode]
+    for i, byte in enumerate(code):
+        mem[(regs.PC + i) & 0xFFFF] = byte
+    return RefZ80(mem, regs).step()
+
+
+@pytest.mark.parametrize("insn", discover_specs())
+def test_spec(insn):
+    test = spec_class(insn)()
+    sim = SpecSimulator(test)
+    checks = spec_checks(test.spec, test.actual, cycles=True)
+    rand = random.Random(insn)
+
+    codes = []
+    for useIX, useIY in INDEXING:
+        prefix = [0xDD] if useIX else [0xFD] if useIY else []
+        for opcode in range(256):
+            if matches(test.OPCODES, opcode):
+                codes += [prefix + [opcode]] * STATES
+    assert codes
+
+    states = [_inputs(sim.actual, _step(rand, code[:-1], code[-1]))
+              for code in codes]
+    outputs = [test.spec.valid] + [
+        check if guard is None else ~guard | check
+        for _, guard, check in checks
+    ]
+    for code, (valid, *held) in zip(codes, sim.run(states, outputs)):
+        failed = [name for (name, _, _), ok in zip(checks, held) if not ok]
+        assert valid and not failed, "{}: {}".format(
+            " ".join("{:02X}".format(byte) for byte in code), failed)
@@ -0,0 +1,79 @@
+import argparse
+import time
+
+from .memory import Bus, load_image
+
+
+def make_z80(backend, include_z80fi=False, **core_options):
+    """Returns a Z80Bus for the named backend ("pysim" or "cxxrtl").
+    core_options are passed on to Z80."""
+    if backend == "pysim":
+        from .pysim_z80 import PysimZ80
+        from .top import SimTop
+        return PysimZ80(SimTop(include_z80fi=include_z80fi, split_clocks=True,
+                               **core_options))
+    if backend == "cxxrtl":
+        from .cxxrtl import CompiledZ80
+        return CompiledZ80(include_z80fi=include_z80fi,
+                           core_options=core_options)
+    raise ValueError("Unknown backend {}".format(backend))
+
+
+def as_bus(mem, on_write=None):
+    """Returns mem if it's a Bus, otherwise a Bus serving memory from it."""
+    if isinstance(mem, Bus):
+        return mem
+    return Bus(mem, on_write=on_write)
+
+
+def run(z80, mem, tstates, on_write=None, tracer=None):
+    """Runs a program for a number of T-states. mem is a Bus, or a 64K
+    bytearray holding the program. If given, tracer.sample() is called
+    after every edge."""
+    serve = as_bus(mem, on_write).serve
+    for _ in range(2 * tstates):
+        serve(z80)
+        z80.edge()
+        if tracer is not None:
+            tracer.sample()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a Z80 binary against the RTL.")
+    parser.add_argument("image", help=".bin, .com or .hex image")
+    parser.add_argument("--backend", choices=["pysim", "cxxrtl"],
+                        default="cxxrtl")
+    parser.add_argument("--tstates", type=int, default=1000000)
+    parser.add_argument("--mem-wait", type=int, default=0,
+                        help="wait states per memory cycle")
+    parser.add_argument("--io-wait", type=int, default=0,
+                        help="wait states per I/O cycle")
+    parser.add_argument("--trace", help="write a trace file of --signals")
+    parser.add_argument("--signals", default="A,Dout,mcycle,tcycle",
+                        help="comma-separated signals to trace "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+
+    mem = load_image(args.image)
+
+    names = args.signals.split(",")
+    include_z80fi = any(name.startswith("z80fi__") for name in names)
+    z80 = make_z80(args.backend, include_z80fi=include_z80fi)
+    z80.reset()
+    tracer = None
+    if args.trace:
+        from .top import outputs
+        from .trace import TraceWriter, Tracer
+        widths = dict(outputs(include_z80fi))
+        writer = TraceWriter(open(args.trace, "wb"),
+                             [(name, widths[name]) for name in names])
+        tracer = Tracer(z80, writer)
+    start = time.monotonic()
+    bus = Bus(mem, mem_wait=args.mem_wait, io_wait=args.io_wait)
+    run(z80, bus, args.tstates, tracer=tracer)
+    elapsed = time.monotonic() - start
+    if tracer is not None:
+        tracer.sink.close()
+    print("{} T-states in {:.2f}s ({:.0f} T-states/s)".format(
+        args.tstates, elapsed, args.tstates / elapsed))
@@ -0,0 +1,195 @@
+from nmigen import *
+from nmigen.hdl.rec import Layout
+
+from ..core.z80 import Z80
+from ..z80fi.z80fi import Z80fiInstrState, Z80fiState, z80fi_parts
+
+# The bus-level pins of the Z80, as seen by a simulation harness.
+# Inputs are driven by the harness, outputs are sampled by it. Inputs
+# start out at their idle value.
+INPUTS = [
+    ("Din", 8, 0),
+    ("nBUSRQ", 1, 1),
+    ("nINTRQ", 1, 1),
+    ("nWAIT", 1, 1),
+]
+
+OUTPUTS = [
+    ("A", 16),
+    ("Dout", 8),
+    ("hiz", 1),
+    ("nM1", 1),
+    ("nMREQ", 1),
+    ("nIORQ", 1),
+    ("nRD", 1),
+    ("nWR", 1),
+    ("nBUSAK", 1),
+]
+
+# Internal state worth watching from a harness, also brought out as outputs.
+PROBES = [
+    ("mcycle", 4),
+    ("tcycle", 4),
+]
+
+
+def _flatten(layout, prefix):
+    for name, (shape, _) in layout.fields.items():
+        if isinstance(shape, Layout):
+            yield from _flatten(shape, prefix + name + "__")
+        else:
+            yield prefix + name, shape.width
+
+
+def _signals(record):
+    for field in record.fields.values():
+        if isinstance(field, Record):
+            yield from _signals(field)
+        else:
+            yield field
+
+
+# With include_z80fi, the fields of the Z80fiInstrState snapshot are also
+# outputs, named after the record's signals, e.g. "z80fi__regs_out__PC".
+Z80FI_OUTPUTS = list(_flatten(Z80fiState().layout, "z80fi__"))
+
+
+def outputs(include_z80fi=False):
+    """Returns the (name, width) of every output of SimTop."""
+    z80fi = Z80FI_OUTPUTS if z80fi_parts(include_z80fi) else []
+    return OUTPUTS + PROBES + z80fi
+
+
+class SimTop(Elaboratable):
+    """The Z80 with its clock domains, for simulation.
+
+    The pos and neg domains are both clocked by clk, on opposite edges,
+    as in z80.py. Every pin gets an explicitly named top-level signal so
+    that backends can look pins up by name.
+
+    pysim only triggers one domain per clock signal, so with split_clocks
+    the neg domain is clocked by a separate clk_neg, which the simulator
+    must drive identically to clk.
+
+    With include_z80fi, a Z80fiInstrState collects each instruction as it
+    retires, and its fields are brought out as Z80FI_OUTPUTS.
+
+    Any other keyword arguments are passed on to Z80, e.g. microcoded.
+    """
+
+    def __init__(self, include_z80fi=False, split_clocks=False,
+                 **core_options):
+        self.clk = Signal(name="clk")
+        self.clk_neg = Signal(name="clk_neg") if split_clocks else self.clk
+        self.rst = Signal(name="rst")
+        # (name, width, idle value) for every input.
+        self.inputs = INPUTS
+        for name, width, idle in INPUTS:
+            setattr(self, name, Signal(width, name=name, reset=idle))
+        for name, width in OUTPUTS + PROBES:
+            setattr(self, name, Signal(width, name=name))
+
+        self.z80fi_parts = z80fi_parts(include_z80fi)
+        self.include_z80fi = bool(self.z80fi_parts)
+        self.z80 = Z80(include_z80fi=self.z80fi_parts, **core_options)
+        # (name, signal) for every output, in outputs() order.
+        self.output_signals = [(name, getattr(self, name))
+                               for name, _ in OUTPUTS + PROBES]
+        if self.include_z80fi:
+            self.z80fi = Z80fiState(name="z80fi")
+            self.output_signals += [(signal.name, signal)
+                                    for signal in _signals(self.z80fi)]
+
+    def ports(self):
+        return [self.clk, self.rst] + [
+            getattr(self, name) for name, _, _ in INPUTS
+        ] + [signal for _, signal in self.output_signals]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pos = ClockDomain("pos")
+        pos.clk = self.clk
+        pos.rst = self.rst
+
+        neg = ClockDomain("neg", clk_edge="neg")
+        neg.clk = self.clk_neg
+        neg.rst = self.rst
+
+        m.domains.pos = pos
+        m.domains.neg = neg
+
+        m.submodules.z80 = self.z80
+        for name, _, _ in INPUTS:
+            m.d.comb += getattr(self.z80, name).eq(getattr(self, name))
+        for name, _ in OUTPUTS:
+            m.d.comb += getattr(self, name).eq(getattr(self.z80, name))
+        for name, _ in PROBES:
+            m.d.comb += getattr(self, name).eq(
+                getattr(self.z80.mcycler, name))
+
+        if self.include_z80fi:
+            m.submodules.z80fi_state = state = Z80fiInstrState()
+            m.d.comb += self.z80.z80fi.connect(state.iface)
+            m.d.comb += self.z80fi.connect(state.data)
+
+        return m
+
+
+class Z80Bus(object):
+    """The bus-level API shared by all simulation backends.
+
+    Every pin in INPUTS and OUTPUTS, and every signal in PROBES, is an
+    attribute. Inputs written by the harness take effect at the next clock
+    edge. Outputs reflect the state after the last edge.
+
+    edges counts the edges so far. The first edge is a rising one, so the
+    next edge is a falling one when edges is odd.
+    """
+
+    def edge(self):
+        """Advances the simulation by one clock edge (half a T-state)."""
+        raise NotImplementedError
+
+    def _get(self, name):
+        raise NotImplementedError
+
+    def _set(self, name, value):
+        raise NotImplementedError
+
+    def z80fi(self, field):
+        """Returns a field of the Z80fiInstrState snapshot, e.g.
+        z80fi("regs_out__PC"). Only with include_z80fi."""
+        return self._get("z80fi__" + field)
+
+    def tick(self):
+        """Advances the simulation by one T-state: a rising, then a falling
+        edge."""
+        self.edge()
+        self.edge()
+
+    def reset(self, cycles=4):
+        """Holds reset for the given number of T-states.
+
+        Reset has to be held across both edges, see Edgelord.
+        """
+        self._set("rst", 1)
+        for _ in range(cycles):
+            self.tick()
+        self._set("rst", 0)
+
+
+def _pin(name, writable):
+    def get(self):
+        return self._get(name)
+
+    def set(self, value):
+        self._set(name, value)
+
+    return property(get, set if writable else None)
+
+
+for _name, _, _ in INPUTS:
+    setattr(Z80Bus, _name, _pin(_name, True))
+for _name, _ in OUTPUTS + PROBES:
+    setattr(Z80Bus, _name, _pin(_name, False))
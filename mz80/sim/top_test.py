@@ -0,0 +1,18 @@
+import pytest
+from nmigen.back import rtlil
+
+from mz80.sim.top import SimTop, outputs
+
+
+@pytest.mark.parametrize("include_z80fi, z80fi", [
+    (False, False),
+    ("off", False),
+    ("bus", True),
+    (True, True),
+])
+def test_outputs(include_z80fi, z80fi):
+    top = SimTop(include_z80fi=include_z80fi)
+    assert top.include_z80fi == z80fi
+    widths = [(name, len(signal)) for name, signal in top.output_signals]
+    assert widths == outputs(z80fi) == outputs(include_z80fi)
+    rtlil.convert(top, ports=top.ports())
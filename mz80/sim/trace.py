@@ -0,0 +1,217 @@
+import argparse
+import collections
+import json
+import struct
+import zlib
+
+# A trace file is a header followed by chunks:
+#
+#   header: MAGIC, u32 length, JSON {"signals": [[name, width], ...]}
+#   chunk:  u32 compressed length, u32 record count, zlib data
+#
+# Each record is a u64 edge number followed by the value of every signal,
+# little-endian, in the narrowest of u8/u16/u32/u64 that holds it. A record
+# is only written when some signal changed since the previous one, so idle
+# stretches cost nothing.
+MAGIC = b"MZ80TRC1"
+
+_HEADER = struct.Struct("<I")
+_CHUNK = struct.Struct("<II")
+
+
+def _record_struct(signals):
+    codes = []
+    for _, width in signals:
+        if width > 64:
+            raise ValueError("Can't trace signals wider than 64 bits")
+        codes.append("B" if width <= 8 else "H" if width <= 16 else
+                     "I" if width <= 32 else "Q")
+    return struct.Struct("<Q" + "".join(codes))
+
+
+class TraceWriter(object):
+    """Writes a chunked, compressed trace of selected signals to a binary
+    file.
+
+    signals is a list of (name, width). Records are buffered and compressed
+    a chunk at a time, so memory use is bounded by chunk_records no matter
+    how long the run is.
+    """
+
+    def __init__(self, f, signals, chunk_records=65536, level=6):
+        self.f = f
+        self.signals = list(signals)
+        self.chunk_records = chunk_records
+        self.level = level
+        self._record = _record_struct(self.signals)
+        self._buffer = bytearray()
+        self._count = 0
+        self._last = None
+
+        header = json.dumps({"signals": self.signals}).encode()
+        f.write(MAGIC)
+        f.write(_HEADER.pack(len(header)))
+        f.write(header)
+
+    def sample(self, edge, values):
+        """Records values (a tuple, in signal order) as of edge, unless
+        nothing changed."""
+        if values == self._last:
+            return
+        self._last = values
+        self._buffer += self._record.pack(edge, *values)
+        self._count += 1
+        if self._count >= self.chunk_records:
+            self.flush()
+
+    def flush(self):
+        if not self._count:
+            return
+        data = zlib.compress(bytes(self._buffer), self.level)
+        self.f.write(_CHUNK.pack(len(data), self._count))
+        self.f.write(data)
+        self._buffer.clear()
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class RingTrace(object):
+    """Keeps the last depth records of selected signals in memory.
+
+    Useful for long runs where only the lead-up to some event matters:
+    nothing touches the disk until dump() is called.
+    """
+
+    def __init__(self, signals, depth=1 << 20):
+        self.signals = list(signals)
+        self._records = collections.deque(maxlen=depth)
+        self._last = None
+
+    def sample(self, edge, values):
+        if values == self._last:
+            return
+        self._last = values
+        self._records.append((edge, values))
+
+    def records(self):
+        return iter(self._records)
+
+    def dump(self, f):
+        """Writes the buffered records to f as a trace file."""
+        writer = TraceWriter(f, self.signals)
+        for edge, values in self._records:
+            writer.sample(edge, values)
+        writer.flush()
+
+
+def read_trace(f):
+    """Reads a trace file. Returns (signals, records), where records yields
+    (edge, values) one chunk at a time."""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a trace file")
+    length, = _HEADER.unpack(f.read(_HEADER.size))
+    signals = [tuple(s) for s in json.loads(f.read(length))["signals"]]
+    record = _record_struct(signals)
+
+    def records():
+        while True:
+            header = f.read(_CHUNK.size)
+            if len(header) < _CHUNK.size:
+                return
+            length, count = _CHUNK.unpack(header)
+            data = zlib.decompress(f.read(length))
+            for fields in record.iter_unpack(data):
+                yield fields[0], fields[1:]
+
+    return signals, records()
+
+
+def _vcd_id(n):
+    chars = []
+    while True:
+        chars.append(chr(33 + n % 94))
+        n //= 94
+        if n == 0:
+            return "".join(chars)
+
+
+def _vcd_value(width, value, ident):
+    if width == 1:
+        return "{}{}".format(value, ident)
+    return "b{:b} {}".format(value, ident)
+
+
+def write_vcd(out, signals, records, start=0, end=None, timescale="500 ps",
+              scope="top"):
+    """Writes the records from edge start up to (not including) end as a
+    VCD, one time unit per edge. The default timescale matches a 1 GHz
+    clock, as in z80.py."""
+    ids = [_vcd_id(i) for i in range(len(signals))]
+    out.write("$timescale {} $end\n".format(timescale))
+    out.write("$scope module {} $end\n".format(scope))
+    for (name, width), ident in zip(signals, ids):
+        out.write("$var wire {} {} {} $end\n".format(width, ident, name))
+    out.write("$upscope $end\n$enddefinitions $end\n")
+
+    last = None
+    started = False
+    for edge, values in records:
+        if end is not None and edge >= end:
+            break
+        if edge < start:
+            last = values
+            continue
+        if not started:
+            # Everything as it was at the start of the window.
+            started = True
+            if last is not None and edge > start:
+                out.write("#{}\n$dumpvars\n".format(start))
+                for (_, width), ident, value in zip(signals, ids, last):
+                    out.write(_vcd_value(width, value, ident) + "\n")
+                out.write("$end\n")
+                last_written = last
+            else:
+                last_written = None
+        out.write("#{}\n".format(edge))
+        for i, ((_, width), ident) in enumerate(zip(signals, ids)):
+            if last_written is None or values[i] != last_written[i]:
+                out.write(_vcd_value(width, values[i], ident) + "\n")
+        last_written = values
+
+
+class Tracer(object):
+    """Samples named signals of a Z80Bus into a TraceWriter or RingTrace
+    after every edge.
+
+    Only the selected signals are read, so the cost per edge is a handful
+    of attribute reads plus a tuple comparison.
+    """
+
+    def __init__(self, z80, sink):
+        self.z80 = z80
+        self.sink = sink
+        self._names = [name for name, _ in sink.signals]
+
+    def sample(self):
+        get = self.z80._get
+        self.sink.sample(self.z80.edges,
+                         tuple([get(name) for name in self._names]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a window of a trace file to VCD.")
+    parser.add_argument("trace", help="trace file")
+    parser.add_argument("vcd", help="VCD file to write")
+    parser.add_argument("--start", type=int, default=0,
+                        help="first edge to convert (default: %(default)s)")
+    parser.add_argument("--end", type=int, default=None,
+                        help="edge to stop at (default: end of trace)")
+    args = parser.parse_args()
+
+    with open(args.trace, "rb") as f, open(args.vcd, "w") as out:
+        signals, records = read_trace(f)
+        write_vcd(out, signals, records, args.start, args.end)
@@ -0,0 +1,113 @@
+import io
+
+import pytest
+
+from mz80.sim.trace import RingTrace, TraceWriter, read_trace, write_vcd
+
+SIGNALS = [("clk", 1), ("A", 16), ("D", 8), ("wide", 40)]
+
+
+def _samples():
+    """Yields (edge, values), changing every fourth edge."""
+    for edge in range(100):
+        n = edge // 4
+        yield edge, (n & 1, n * 0x101 & 0xFFFF, n & 0xFF, n << 32)
+
+
+def _changes(samples):
+    last = None
+    for edge, values in samples:
+        if values != last:
+            yield edge, values
+        last = values
+
+
+def _write(samples, chunk_records):
+    f = io.BytesIO()
+    writer = TraceWriter(f, SIGNALS, chunk_records=chunk_records)
+    for edge, values in samples:
+        writer.sample(edge, values)
+    writer.flush()
+    f.seek(0)
+    return f
+
+
+@pytest.mark.parametrize("chunk_records", [1, 7, 65536])
+def test_round_trip(chunk_records):
+    f = _write(_samples(), chunk_records)
+    signals, records = read_trace(f)
+    assert signals == SIGNALS
+    assert list(records) == list(_changes(_samples()))
+
+
+def test_repeats_dropped():
+    samples = [(0, (0, 1, 2, 3)), (1, (0, 1, 2, 3)), (2, (1, 1, 2, 3))]
+    _, records = read_trace(_write(samples, 65536))
+    assert list(records) == [samples[0], samples[2]]
+
+
+def test_too_wide():
+    with pytest.raises(ValueError):
+        TraceWriter(io.BytesIO(), [("x", 65)])
+
+
+def test_not_a_trace():
+    with pytest.raises(ValueError):
+        read_trace(io.BytesIO(b"not a trace file"))
+
+
+def test_ring_trace():
+    ring = RingTrace(SIGNALS, depth=10)
+    for edge, values in _samples():
+        ring.sample(edge, values)
+    expected = list(_changes(_samples()))[-10:]
+    assert list(ring.records()) == expected
+
+    f = io.BytesIO()
+    ring.dump(f)
+    f.seek(0)
+    signals, records = read_trace(f)
+    assert signals == SIGNALS
+    assert list(records) == expected
+
+
+def _parse_vcd(text):
+    """Returns {name: [(time, value)]} for every value change in a VCD."""
+    names = {}
+    changes = {}
+    time = None
+    for line in text.splitlines():
+        words = line.split()
+        if words[0] == "$var":
+            names[words[3]] = words[4]
+            changes[words[4]] = []
+        elif line.startswith("#"):
+            time = int(line[1:])
+        elif line.startswith("b"):
+            changes[names[words[1]]].append((time, int(words[0][1:], 2)))
+        elif line[0] in "01" and time is not None:
+            changes[names[line[1:]]].append((time, int(line[0])))
+    return changes
+
+
+def _expected_vcd(start, end):
+    """Returns what _parse_vcd() should give for a window of _samples()."""
+    changes = {name: [] for name, _ in SIGNALS}
+    last = None
+    for edge, values in _samples():
+        if edge < start or edge >= end:
+            continue
+        for i, (name, _) in enumerate(SIGNALS):
+            if last is None or values[i] != last[i]:
+                changes[name].append((edge, values[i]))
+        last = values
+    return changes
+
+
+@pytest.mark.parametrize("start,end", [(0, 100), (0, 10), (9, 30), (10, 99)])
+def test_vcd(start, end):
+    f = _write(_samples(), 7)
+    signals, records = read_trace(f)
+    out = io.StringIO()
+    write_vcd(out, signals, records, start, end)
+    assert _parse_vcd(out.getvalue()) == _expected_vcd(start, end)
@@ -7,6 +7,56 @@ from enum import Enum, unique
 from ..core.muxing import MCycle
 
 
+# The parts of the z80fi instrumentation a core can be built with.
+# "registers" snapshots the registers going into and out of each
+# instruction, "bus" records its operands and memory and I/O accesses, and
+# "cycles" its M-cycles. The instruction itself, and when it's valid, come
+# with any of them.
+Z80FI_PARTS = ("registers", "bus", "cycles")
+
+# Named sets of Z80FI_PARTS, for include_z80fi.
+Z80FI_PROFILES = {
+    "off": (),
+    "full": Z80FI_PARTS,
+    "registers": ("registers",),
+    "bus": ("bus",),
+}
+
+
+def z80fi_parts(include_z80fi):
+    """Returns the set of Z80FI_PARTS a core is built with for
+    include_z80fi: True or False for all or none of them, the name of a
+    profile in Z80FI_PROFILES, or the parts themselves."""
+    if include_z80fi is True:
+        return frozenset(Z80FI_PARTS)
+    if not include_z80fi:
+        return frozenset()
+    if isinstance(include_z80fi, str):
+        if include_z80fi not in Z80FI_PROFILES:
+            raise ValueError(
+                "Unknown z80fi profile {!r}, expected one of {}".format(
+                    include_z80fi, ", ".join(Z80FI_PROFILES)))
+        return frozenset(Z80FI_PROFILES[include_z80fi])
+    parts = frozenset(include_z80fi)
+    unknown = parts - frozenset(Z80FI_PARTS)
+    if unknown:
+        raise ValueError("Unknown z80fi parts {}, expected some of {}".format(
+            ", ".join(sorted(unknown)), ", ".join(Z80FI_PARTS)))
+    return parts
+
+
+# How many operands, accesses of each kind and M-cycles a Z80fiState
+# holds unless told otherwise: enough for every instruction so far.
+DEPTHS = {
+    "operands": 3,
+    "memrds": 3,
+    "memwrs": 3,
+    "iords": 3,
+    "iowrs": 3,
+    "mcycles": 6,
+}
+
+
 class Z80fiInterface(Record):
     def __init__(self, name=None):
         super().__init__(
@@ -80,19 +130,29 @@ class RegRecordLayout(Layout):
 
 
 class Z80fiState(Record):
-    def __init__(self, name=None):
+    """Everything recorded of an instruction.
+
+    depths overrides entries of DEPTHS, to hold fewer (or more) operands,
+    accesses or M-cycles. Each num counts one past its depth, so an
+    instruction with more of them than are held doesn't look like it fits.
+    """
+
+    def __init__(self, name=None, depths=None):
+        depths = dict(DEPTHS, **(depths or {}))
         super().__init__(
             Layout([("valid", 1, DIR_FANIN), ("instr", 8, DIR_FANIN),
                     ("useIX", 1, DIR_FANIN), ("useIY", 1, DIR_FANIN),
-                    ("operands", OperandLayout(), DIR_FANIN),
+                    ("operands", OperandLayout(depths["operands"]),
+                     DIR_FANIN),
                     ("regs_in", RegRecordLayout(DIR_FANIN), DIR_FANIN),
                     ("regs_out", RegRecordLayout(DIR_FANIN), DIR_FANIN),
-                    ("memrds", AccessLayout(), DIR_FANIN),
-                    ("memwrs", AccessLayout(), DIR_FANIN),
-                    ("iords", AccessLayout(), DIR_FANIN),
-                    ("iowrs", AccessLayout(), DIR_FANIN),
-                    ("mcycles", CycleLayout(), DIR_FANIN)]),
+                    ("memrds", AccessLayout(depths["memrds"]), DIR_FANIN),
+                    ("memwrs", AccessLayout(depths["memwrs"]), DIR_FANIN),
+                    ("iords", AccessLayout(depths["iords"]), DIR_FANIN),
+                    ("iowrs", AccessLayout(depths["iowrs"]), DIR_FANIN),
+                    ("mcycles", CycleLayout(depths["mcycles"]), DIR_FANIN)]),
             name=name)
+        self.depths = depths
 
 
 def regs_in_r(spec: Z80fiState, r):
@@ -120,25 +180,34 @@ def _reg_r(spec: Z80fiState, r, regs):
 
 
 class Z80fiInstrState(Elaboratable):
-    def __init__(self):
+    """Records each instruction into a Z80fiState. depths is as for
+    Z80fiState."""
+
+    def __init__(self, depths=None):
         # The interface to set the signals
         self.iface = Z80fiInterface(name="iface")
-        self.data = Z80fiState()
-        self.instr_state = Z80fiState()
+        self.data = Z80fiState(depths=depths)
+        self.instr_state = Z80fiState(depths=depths)
+        self.depths = self.data.depths
 
     def elaborate(self, platform):
         m = Module()
+        depths = self.depths
 
-        m.submodules.operands = self.operands = Z80fiOperands()
+        m.submodules.operands = self.operands = Z80fiOperands(depths)
         m.submodules.regs_in = self.regs_in = Z80fiRegisters(
-            AccessType.REGS_IN)
+            AccessType.REGS_IN, depths)
         m.submodules.regs_out = self.regs_out = Z80fiRegisters(
-            AccessType.REGS_OUT)
-        m.submodules.mem_rds = self.mem_rds = Z80fiExtAccess(AccessType.MEMRD)
-        m.submodules.mem_wrs = self.mem_wrs = Z80fiExtAccess(AccessType.MEMWR)
-        m.submodules.io_rds = self.io_rds = Z80fiExtAccess(AccessType.IORD)
-        m.submodules.io_wrs = self.io_wrs = Z80fiExtAccess(AccessType.IOWR)
-        m.submodules.mcycles = self.mcycles = Z80fiCycles()
+            AccessType.REGS_OUT, depths)
+        m.submodules.mem_rds = self.mem_rds = Z80fiExtAccess(
+            AccessType.MEMRD, depths)
+        m.submodules.mem_wrs = self.mem_wrs = Z80fiExtAccess(
+            AccessType.MEMWR, depths)
+        m.submodules.io_rds = self.io_rds = Z80fiExtAccess(
+            AccessType.IORD, depths)
+        m.submodules.io_wrs = self.io_wrs = Z80fiExtAccess(
+            AccessType.IOWR, depths)
+        m.submodules.mcycles = self.mcycles = Z80fiCycles(depths)
 
         m.d.comb += self.iface.connect(self.operands.iface, self.regs_in.iface,
                                        self.regs_out.iface, self.mem_rds.iface,
@@ -163,53 +232,62 @@ class Z80fiInstrState(Elaboratable):
         return m
 
 
+def _num_width(depth):
+    # num counts up to one past depth.
+    return (depth + 1).bit_length()
+
+
+def _append(m, store, depth, entry, first=0):
+    """Appends entry, a dict of field name prefix to value, to the next free
+    slot of store, a record of depth slots numbered from first. Past the
+    last slot, only num counts, and only once."""
+    with m.If(store.num <= depth):
+        m.d.pos += store.num.eq(store.num + 1)
+    # The slot is picked by case rather than by indexing an Array: pysim
+    # indexes an assignment target with the value num is about to take.
+    with m.Switch(store.num):
+        for i in range(depth):
+            with m.Case(i):
+                m.d.pos += [
+                    store["{}{}".format(prefix, first + i)].eq(value)
+                    for prefix, value in entry.items()
+                ]
+
+
 class OperandLayout(Layout):
-    def __init__(self):
-        super().__init__([
-            ("num", 2, DIR_FANIN),
-            ("data0", 8, DIR_FANIN),
-            ("data1", 8, DIR_FANIN),
-            ("data2", 8, DIR_FANIN),
-        ])
+    def __init__(self, depth=DEPTHS["operands"]):
+        super().__init__([("num", _num_width(depth), DIR_FANIN)] +
+                         [("data{}".format(i), 8, DIR_FANIN)
+                          for i in range(depth)])
 
 
 class Z80fiOperands(Elaboratable):
-    def __init__(self):
+    def __init__(self, depths=None):
         self.iface = Z80fiInterface()
-        self.data = Z80fiState()
+        self.data = Z80fiState(depths=depths)
 
     def elaborate(self, platform):
         m = Module()
-        operand = self.iface.control.data
+        operands = self.data.operands
 
         with m.If(self.iface.control.add_operand):
-            with m.Switch(self.data.operands.num):
-                with m.Case(0):
-                    m.d.pos += self.data.operands.data0.eq(operand)
-                    m.d.pos += self.data.operands.num.eq(1)
-                with m.Case(1):
-                    m.d.pos += self.data.operands.data1.eq(operand)
-                    m.d.pos += self.data.operands.num.eq(2)
-                with m.Case(2):
-                    m.d.pos += self.data.operands.data2.eq(operand)
-                    m.d.pos += self.data.operands.num.eq(3)
+            _append(m, operands, self.data.depths["operands"],
+                    {"data": self.iface.control.data})
         with m.If(self.iface.control.clear):
-            m.d.pos += self.data.operands.num.eq(0)
+            m.d.pos += operands.num.eq(0)
 
         return m
 
 
 class AccessLayout(Layout):
-    def __init__(self):
-        super().__init__([
-            ("num", 2, DIR_FANIN),
-            ("addr0", 16, DIR_FANIN),
-            ("data0", 8, DIR_FANIN),
-            ("addr1", 16, DIR_FANIN),
-            ("data1", 8, DIR_FANIN),
-            ("addr2", 16, DIR_FANIN),
-            ("data2", 8, DIR_FANIN),
-        ])
+    def __init__(self, depth=DEPTHS["memrds"]):
+        fields = [("num", _num_width(depth), DIR_FANIN)]
+        for i in range(depth):
+            fields += [
+                ("addr{}".format(i), 16, DIR_FANIN),
+                ("data{}".format(i), 8, DIR_FANIN),
+            ]
+        super().__init__(fields)
 
 
 @unique
@@ -223,9 +301,9 @@ class AccessType(Enum):
 
 
 class Z80fiExtAccess(Elaboratable):
-    def __init__(self, access_type):
+    def __init__(self, access_type, depths=None):
         self.iface = Z80fiInterface()
-        self.data = Z80fiState()
+        self.data = Z80fiState(depths=depths)
         self.access_type = access_type
 
     def elaborate(self, platform):
@@ -235,31 +313,23 @@ class Z80fiExtAccess(Elaboratable):
 
         if self.access_type == AccessType.MEMRD:
             accessed = self.iface.control.add_memrd_access
-            store = self.data.memrds
+            kind = "memrds"
         elif self.access_type == AccessType.MEMWR:
             accessed = self.iface.control.add_memwr_access
-            store = self.data.memwrs
+            kind = "memwrs"
         elif self.access_type == AccessType.IORD:
             accessed = self.iface.control.add_iord_access
-            store = self.data.iords
+            kind = "iords"
         elif self.access_type == AccessType.IOWR:
             accessed = self.iface.control.add_iowr_access
-            store = self.data.iowrs
+            kind = "iowrs"
+        store = self.data[kind]
 
         with m.If(accessed):
-            with m.Switch(store.num):
-                with m.Case(0):
-                    m.d.pos += store.addr0.eq(addr)
-                    m.d.pos += store.data0.eq(data)
-                    m.d.pos += store.num.eq(1)
-                with m.Case(1):
-                    m.d.pos += store.addr1.eq(addr)
-                    m.d.pos += store.data1.eq(data)
-                    m.d.pos += store.num.eq(2)
-                with m.Case(2):
-                    m.d.pos += store.addr2.eq(addr)
-                    m.d.pos += store.data2.eq(data)
-                    m.d.pos += store.num.eq(3)
+            _append(m, store, self.data.depths[kind], {
+                "addr": addr,
+                "data": data
+            })
         with m.If(self.iface.control.clear):
             m.d.pos += store.num.eq(0)
 
@@ -267,9 +337,9 @@ class Z80fiExtAccess(Elaboratable):
 
 
 class Z80fiRegisters(Elaboratable):
-    def __init__(self, access_type):
+    def __init__(self, access_type, depths=None):
         self.iface = Z80fiInterface()
-        self.data = Z80fiState()
+        self.data = Z80fiState(depths=depths)
         self.access_type = access_type
 
     def elaborate(self, platform):
@@ -289,51 +359,37 @@ class Z80fiRegisters(Elaboratable):
 
 
 class CycleLayout(Layout):
-    def __init__(self):
-        super().__init__([
-            ("num", 3, DIR_FANIN),
-            ("type1", MCycle, DIR_FANIN),
-            ("tcycles1", 3, DIR_FANIN),
-            ("type2", MCycle, DIR_FANIN),
-            ("tcycles2", 3, DIR_FANIN),
-            ("type3", MCycle, DIR_FANIN),
-            ("tcycles3", 3, DIR_FANIN),
-            ("type4", MCycle, DIR_FANIN),
-            ("tcycles4", 3, DIR_FANIN),
-            ("type5", MCycle, DIR_FANIN),
-            ("tcycles5", 3, DIR_FANIN),
-            ("type6", MCycle, DIR_FANIN),
-            ("tcycles6", 3, DIR_FANIN),
-        ])
+    def __init__(self, depth=DEPTHS["mcycles"]):
+        fields = [("num", _num_width(depth), DIR_FANIN)]
+        for i in range(1, depth + 1):
+            fields += [
+                ("type{}".format(i), MCycle, DIR_FANIN),
+                ("tcycles{}".format(i), 3, DIR_FANIN),
+            ]
+        super().__init__(fields)
 
 
 class Z80fiCycles(Elaboratable):
-    def __init__(self):
+    def __init__(self, depths=None):
         self.iface = Z80fiInterface()
-        self.data = Z80fiState()
+        self.data = Z80fiState(depths=depths)
 
     def elaborate(self, platform):
         m = Module()
         mcycles = self.data.mcycles
         control = self.iface.control
+        depth = self.data.depths["mcycles"]
 
         with m.If(control.clear):
             m.d.pos += mcycles.num.eq(0)
 
+        # The M-cycle being run is the last one recorded.
         with m.If(control.add_tcycle):
             with m.Switch(mcycles.num):
-                with m.Case(1):
-                    m.d.pos += mcycles.tcycles1.eq(mcycles.tcycles1 + 1)
-                with m.Case(2):
-                    m.d.pos += mcycles.tcycles2.eq(mcycles.tcycles2 + 1)
-                with m.Case(3):
-                    m.d.pos += mcycles.tcycles3.eq(mcycles.tcycles3 + 1)
-                with m.Case(4):
-                    m.d.pos += mcycles.tcycles4.eq(mcycles.tcycles4 + 1)
-                with m.Case(5):
-                    m.d.pos += mcycles.tcycles5.eq(mcycles.tcycles5 + 1)
-                with m.Case(6):
-                    m.d.pos += mcycles.tcycles6.eq(mcycles.tcycles6 + 1)
+                for i in range(1, depth + 1):
+                    with m.Case(i):
+                        current = mcycles["tcycles{}".format(i)]
+                        m.d.pos += current.eq(current + 1)
 
         with m.If(control.add_mcycle != MCycle.NONE):
             # Because instruction state can only be finalized during
@@ -346,30 +402,10 @@ class Z80fiCycles(Elaboratable):
                 m.d.pos += mcycles.tcycles1.eq(initial_cycles)
                 m.d.pos += mcycles.num.eq(1)
 
-            with m.Elif(mcycles.num < 6):
-                with m.Switch(mcycles.num):
-                    with m.Case(0):
-                        # Because instruction state can only be finalized during
-                        # M1 T1 of the next instruction, we register M1 cycles
-                        # on M1 T2.
-                        m.d.pos += mcycles.type1.eq(control.add_mcycle)
-                        m.d.pos += mcycles.tcycles1.eq(initial_cycles)
-                    with m.Case(1):
-                        m.d.pos += mcycles.type2.eq(control.add_mcycle)
-                        m.d.pos += mcycles.tcycles2.eq(initial_cycles)
-                    with m.Case(2):
-                        m.d.pos += mcycles.type3.eq(control.add_mcycle)
-                        m.d.pos += mcycles.tcycles3.eq(initial_cycles)
-                    with m.Case(3):
-                        m.d.pos += mcycles.type4.eq(control.add_mcycle)
-                        m.d.pos += mcycles.tcycles4.eq(initial_cycles)
-                    with m.Case(4):
-                        m.d.pos += mcycles.type5.eq(control.add_mcycle)
-                        m.d.pos += mcycles.tcycles5.eq(initial_cycles)
-                    with m.Case(5):
-                        m.d.pos += mcycles.type6.eq(control.add_mcycle)
-                        m.d.pos += mcycles.tcycles6.eq(initial_cycles)
-
-                m.d.pos += mcycles.num.eq(mcycles.num + 1)
+            with m.Else():
+                _append(m, mcycles, depth, {
+                    "type": control.add_mcycle,
+                    "tcycles": initial_cycles
+                }, first=1)
 
         return m
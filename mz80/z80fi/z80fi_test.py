@@ -0,0 +1,28 @@
+import pytest
+
+from mz80.sim.cosim import CoSim
+from mz80.sim.memory import Bus
+from mz80.sim.run import make_z80
+
+
+def _cosim(program, mem_wait):
+    """Co-simulates program, then NOPs, on pysim. Raises Divergence if the
+    recorded instructions aren't what RefZ80 expects."""
+    mem = bytearray(0x10000)
+    mem[:len(program)] = bytes(program)
+    z80 = make_z80("pysim", include_z80fi=True)
+    z80.reset()
+    cosim = CoSim(z80, Bus(mem, mem_wait=mem_wait))
+    assert cosim.run(4, 200) == 4
+
+
+@pytest.mark.parametrize("mem_wait", [0, 2])
+def test_ld_r_n(mem_wait):
+    # NOP; LD B,5; LD C,B
+    _cosim([0x00, 0x06, 0x05, 0x48], mem_wait)
+
+
+@pytest.mark.parametrize("mem_wait", [0, 2])
+def test_ld_index_n(mem_wait):
+    # LD (IX+1),7
+    _cosim([0xDD, 0x36, 0x01, 0x07], mem_wait)